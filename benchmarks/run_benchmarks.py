@@ -0,0 +1,362 @@
+'''Module to benchmark every pipeline stage against synthetic budgets and track regressions.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --sizes small medium
+    python -m benchmarks.run_benchmarks --sizes small --save-baseline
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import multiprocessing
+from datetime import date
+from typing import Dict, Any, List
+
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_ROOT, 'benchmarks')
+WORKSPACE_DIR = os.path.join(BENCHMARK_DIR, '.workspace')
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, 'results.json')
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+RESULTS_SCHEMA_VERSION = 1
+
+DATASETS = {
+    'small': {'transactions': 10_000, 'payees': 200, 'accounts': 8, 'scheduled_transactions': 25},
+    'medium': {'transactions': 100_000, 'payees': 1_000, 'accounts': 15, 'scheduled_transactions': 100},
+    'large': {'transactions': 1_000_000, 'payees': 5_000, 'accounts': 30, 'scheduled_transactions': 500},
+}
+# the delta applied for the incremental cases, as a share of the dataset's transactions
+DELTA_SHARE = {'edits': 0.01, 'deletes': 0.001, 'new_transactions': 0.01}
+
+FULL_LOAD_FILE = '20250101000000.json'
+DELTA_LOAD_FILE = '20250102000000.json'
+
+# case name -> fixtures copied into the run directory before the case runs
+CASES = {
+    'Ingest': [],
+    'RawToBase.initial': ['raw_full'],
+    'RawToBase.incremental': ['raw_delta', 'base'],
+    'CompactBase': ['base'],
+    'TableSpecs': ['base'],
+    'DimDate': ['base'],
+    'FactSubtransactions': ['base'],
+    'FactMonthlyCategoryBudget': ['base'],
+    'FactAccountBalances': ['base'],
+    'FactCashFlowForecast': ['base'],
+    'FactProjectedBalances': ['warehouse'],
+    'DataQuality': ['warehouse'],
+    'SqliteExport': ['warehouse'],
+    'dash_aggregations': ['warehouse'],
+}
+
+
+def load_config(run_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(REPO_ROOT, 'config', 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    for key in ['raw_data_path', 'processed_data_path', 'base_data_path', 'warehouse_data_path', 'knowledge_file',
+                'quarantine_data_path', 'compaction_state_file', 'sqlite_export_path',
+                'account_balances_state_file']:
+        config[key] = os.path.join(run_dir, config[key])
+    config['API_TOKEN'] = 'benchmark'
+    config['BUDGET_ID'] = 'benchmark'
+    config['REQUESTS_RETRY_DELAY'] = 0
+    return config
+
+
+def build_budget(size: str):
+    from synthetic.generator import SyntheticBudget
+    return SyntheticBudget(seed=42, **DATASETS[size])
+
+
+def write_raw(budget, raw_path: str, file_name: str, last_knowledge: int):
+    '''Land every entity the way Ingest does, without going over HTTP'''
+    for entity in budget_entities():
+        entity_data = budget.response(entity, last_knowledge)['data']
+        entity_data.pop('server_knowledge', None)
+        directory = os.path.join(raw_path, entity)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, file_name), 'w') as f:
+            json.dump(entity_data, f, default=str)
+
+
+def budget_entities() -> List[str]:
+    with open(os.path.join(REPO_ROOT, 'config', 'config.yaml'), 'r') as f:
+        return yaml.safe_load(f)['entities']
+
+
+def prepare_fixtures(size: str) -> str:
+    '''
+    Build the fixtures for one dataset size once, reusing them while the dataset definition is unchanged.
+    raw_full is a first sync, raw_delta the next incremental one, base and warehouse are the stage outputs.
+    '''
+    from pipeline.raw_to_base import RawToBase
+    from pipeline.table_specs import TableSpecs
+    from pipeline.dimensions import DimDate
+    from pipeline.facts import (
+        FactSubtransactions, FactMonthlyCategoryBudget, FactAccountBalances, FactCashFlowForecast,
+        FactProjectedBalances
+    )
+
+    fixture_dir = os.path.join(WORKSPACE_DIR, size, 'fixtures')
+    marker = os.path.join(fixture_dir, 'dataset.json')
+    definition = {'dataset': DATASETS[size], 'delta': DELTA_SHARE, 'generator': 1, 'warehouse': 8}
+    if os.path.exists(marker):
+        with open(marker, 'r') as f:
+            if json.load(f) == definition:
+                return fixture_dir
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+    logging.info(f"Preparing {size} benchmark fixtures")
+
+    budget = build_budget(size)
+    write_raw(budget, os.path.join(fixture_dir, 'raw_full'), FULL_LOAD_FILE, 0)
+    full_knowledge = budget.server_knowledge
+    transactions = DATASETS[size]['transactions']
+    budget.advance(**{k: max(1, int(v * transactions)) for k, v in DELTA_SHARE.items()})
+    write_raw(budget, os.path.join(fixture_dir, 'raw_delta'), DELTA_LOAD_FILE, full_knowledge)
+
+    build_dir = os.path.join(fixture_dir, 'build')
+    shutil.copytree(os.path.join(fixture_dir, 'raw_full'), os.path.join(build_dir, 'data', 'raw'))
+    config = load_config(build_dir)
+    RawToBase(config)
+    for stage in [TableSpecs, DimDate, FactSubtransactions, FactMonthlyCategoryBudget, FactAccountBalances,
+                  FactCashFlowForecast, FactProjectedBalances]:
+        stage(config)
+    shutil.copytree(config['base_data_path'], os.path.join(fixture_dir, 'base'))
+    shutil.copytree(config['warehouse_data_path'], os.path.join(fixture_dir, 'warehouse'))
+    shutil.rmtree(build_dir)
+
+    with open(marker, 'w') as f:
+        json.dump(definition, f)
+    return fixture_dir
+
+
+def stage_runner(case: str, config: Dict[str, Any], size: str):
+    '''Return a callable running the stage under test, any setup happens before it is timed'''
+    from pipeline.ingest import Ingest
+    from pipeline.raw_to_base import RawToBase
+    from pipeline import dimensions, facts
+    from pipeline.data_quality import DataQuality
+    from pipeline.compaction import CompactBase
+    from pipeline.sqlite_export import SqliteExport
+    from pipeline.table_specs import TableSpecs
+    import dash_data
+
+    if case == 'Ingest':
+        from synthetic.mock_api import MockYnabServer
+        server = MockYnabServer(build_budget(size), rate_limit=10_000).start()
+        config['base_url'] = server.base_url
+
+        def run():
+            try:
+                Ingest(config)
+            finally:
+                server.stop()
+        return run
+    if case.startswith('RawToBase'):
+        return lambda: RawToBase(config)
+    if case == 'dash_aggregations':
+        def run():
+            tables = dash_data.load_warehouse(config['warehouse_data_path'])
+            master = dash_data.build_master_transactions(tables)
+            category_lines = dash_data.build_category_lines(tables)
+            dash_data.spend_per_day(master)
+            dash_data.spend_per_category(category_lines)
+            dash_data.spend_per_payee(master)
+            dash_data.balance_per_day(tables)
+        return run
+    if case == 'CompactBase':
+        return lambda: CompactBase(config)
+    if case == 'SqliteExport':
+        config['sqlite_export'] = True
+        return lambda: SqliteExport(config)
+    if case == 'DataQuality':
+        return lambda: DataQuality(config)
+    if case == 'TableSpecs':
+        return lambda: TableSpecs(config)
+    stage = getattr(dimensions, case, None) or getattr(facts, case)
+    return lambda: stage(config)
+
+
+def run_case(case: str, size: str, fixture_dir: str, run_dir: str) -> Dict[str, Any]:
+    '''Run one case in the current process and return its measurements. Meant to run in a fresh child process'''
+    sys.path.insert(0, REPO_ROOT)
+    logging.basicConfig(level=logging.WARNING)
+    from pipeline import instrumentation
+
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'data'))
+    config = load_config(run_dir)
+    targets = {
+        'raw_full': config['raw_data_path'],
+        'raw_delta': config['raw_data_path'],
+        'base': config['base_data_path'],
+        'warehouse': config['warehouse_data_path'],
+    }
+    for fixture in CASES[case]:
+        shutil.copytree(os.path.join(fixture_dir, fixture), targets[fixture], dirs_exist_ok=True)
+
+    runner = stage_runner(case, config, size)
+    instrumentation.reset()
+    with instrumentation.span(case) as case_span:
+        runner()
+    spans = instrumentation.finished_spans()
+    result = {
+        'wall_s': case_span.duration_s,
+        'cpu_s': case_span.cpu_s,
+        'peak_rss_bytes': case_span.process_peak_rss_bytes,
+        'bytes_written': sum(s.counters.get('bytes_written', 0) for s in spans),
+        'rows_out': sum(s.counters.get('rows_out', 0) for s in spans),
+    }
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return result
+
+
+def run_isolated(function, *args):
+    '''Run a function in a fresh spawned process, so the memory it touches never counts against another one'''
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def run_case_isolated(case: str, size: str, fixture_dir: str) -> Dict[str, Any]:
+    '''Run a case in a fresh spawned process, its peak RSS is that process' own VmHWM'''
+    run_dir = os.path.join(WORKSPACE_DIR, size, 'run')
+    return run_isolated(run_case, case, size, fixture_dir, run_dir)
+
+
+def summarise(measurements: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'repeats': len(measurements),
+        'wall_s': statistics.median(m['wall_s'] for m in measurements),
+        'wall_s_min': min(m['wall_s'] for m in measurements),
+        'cpu_s': statistics.median(m['cpu_s'] for m in measurements),
+        'peak_rss_bytes': max((m['peak_rss_bytes'] or 0) for m in measurements),
+        'bytes_written': measurements[-1]['bytes_written'],
+        'rows_out': measurements[-1]['rows_out'],
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def environment() -> Dict[str, Any]:
+    import polars as pl
+    return {
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'system': platform.system(),
+    }
+
+
+def load_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path: str, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+def compare(cases: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    '''Return a line per case whose wall time or peak memory grew by more than the threshold over the baseline'''
+    regressions = []
+    for key, current in sorted(cases.items()):
+        previous = baseline.get('cases', {}).get(key)
+        if previous is None:
+            continue
+        for metric in ['wall_s', 'peak_rss_bytes']:
+            if not previous.get(metric):
+                continue
+            ratio = current[metric] / previous[metric]
+            if ratio > 1 + threshold:
+                regressions.append(f"{key} {metric}: {previous[metric]:.4g} -> {current[metric]:.4g} ({ratio - 1:+.1%})")
+    return regressions
+
+
+def print_table(cases: Dict[str, Any], baseline: Dict[str, Any]):
+    print(f"{'case':<40} {'wall s':>10} {'cpu s':>10} {'peak MB':>10} {'out MB':>10} {'rows out':>12} {'vs base':>9}")
+    for key, result in sorted(cases.items()):
+        previous = baseline.get('cases', {}).get(key)
+        change = f"{result['wall_s'] / previous['wall_s'] - 1:+.1%}" if previous and previous.get('wall_s') else '-'
+        print(f"{key:<40} {result['wall_s']:>10.3f} {result['cpu_s']:>10.3f} "
+              f"{result['peak_rss_bytes'] / 1e6:>10.1f} {result['bytes_written'] / 1e6:>10.2f} "
+              f"{int(result['rows_out']):>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages against synthetic budgets.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=sorted(DATASETS))
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown over the baseline before failing, 0.2 is 20%%')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--no-record', action='store_true', help='do not append this run to the results file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.path.insert(0, REPO_ROOT)
+
+    cases = {}
+    for size in args.sizes:
+        # the fixtures run every stage, which would leave this process' peak far above any single case
+        fixture_dir = run_isolated(prepare_fixtures, size)
+        for case in args.cases:
+            logging.info(f"Running {case} on {size} x{args.repeat}")
+            measurements = [run_case_isolated(case, size, fixture_dir) for _ in range(args.repeat)]
+            cases[f'{case}@{size}'] = summarise(measurements)
+
+    run = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'date': date.today().isoformat(),
+        'environment': environment(),
+        'datasets': {size: DATASETS[size] for size in args.sizes},
+        'cases': cases,
+    }
+
+    baseline = load_json(BASELINE_FILE, {})
+    print_table(cases, baseline)
+
+    if not args.no_record:
+        results = load_json(RESULTS_FILE, {'schema_version': RESULTS_SCHEMA_VERSION, 'runs': []})
+        results['runs'].append(run)
+        write_json(RESULTS_FILE, results)
+    if args.save_baseline:
+        write_json(BASELINE_FILE, {'schema_version': RESULTS_SCHEMA_VERSION, **run})
+        logging.info(f"Saved baseline to {BASELINE_FILE}")
+        return
+
+    if baseline and baseline.get('environment') != run['environment']:
+        logging.warning("The baseline was recorded on a different environment, comparisons may not be meaningful.")
+    regressions = compare(cases, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,13 @@ import json
 import logging
 from typing import override
 
+LOG_RECORD_BUILTIN_ATTRS = {
+    "args", "asctime", "created", "exc_info", "exc_text", "filename",
+    "funcName", "levelname", "levelno", "lineno", "module", "msecs",
+    "message", "msg", "name", "pathname", "process", "processName",
+    "relativeCreated", "stack_info", "thread", "threadName", "taskName",
+}
+
 class custom_json_logger(logging.Formatter):
     def __init__(
         self,
@@ -37,5 +44,11 @@ class custom_json_logger(logging.Formatter):
             for key, val in self.format_keys.items()
         }
         message.update(always_fields)
+
+        # anything passed in through `extra=` (e.g. span data) is kept as structured fields
+        for key, val in record.__dict__.items():
+            if key not in LOG_RECORD_BUILTIN_ATTRS:
+                message[key] = val
+
         return message
 
@@ -13,4 +13,5 @@ DUPLICATE_RESOLUTION_ERROR = 11
 UNIQUE_ID_NOT_FOUND = 12
 NO_DATA_PRODUCED = 13
 MISSING_DATA_FILES = 14
-BAD_JOIN = 15
\ No newline at end of file
+BAD_JOIN = 15
+UNHANDLED_EXCEPTION = 16
@@ -0,0 +1,94 @@
+'''Module to load the data warehouse and build the datasets the Dash app visualises.'''
+
+import polars as pl
+
+WAREHOUSE_TABLES = [
+    'account_balances',
+    'accounts',
+    'categories',
+    'dates',
+    'payees',
+    'scheduled_transactions',
+    'subtransactions',
+    'transactions',
+]
+
+
+def load_warehouse(warehouse_path='data/warehouse'):
+    '''Read every warehouse table, raises FileNotFoundError if the pipeline has not produced them yet'''
+    return {
+        table: pl.read_parquet(f'{warehouse_path}/{table}.parquet')
+        for table in WAREHOUSE_TABLES
+    }
+
+
+def build_master_transactions(tables):
+    '''Join transactions with accounts, categories, payees and dates to create a master DataFrame'''
+    return tables['transactions'].join(tables['categories'], left_on='category_id', right_on='category_id', suffix='_category')\
+                .join(tables['accounts'], left_on='account_id', right_on='account_id', suffix='_account')\
+                .join(tables['payees'], left_on='payee_id', right_on='payee_id', suffix='_payee')\
+                .join(tables['dates'], left_on='transaction_date', right_on='date_id', suffix='_date')
+
+
+def build_category_lines(tables):
+    '''Transactions with each split transaction replaced by its subtransactions, so every line has a single category'''
+    subtransactions = tables['subtransactions']
+    unsplit_transactions = tables['transactions'].join(
+        subtransactions.select('transaction_id').unique(), on='transaction_id', how='anti'
+    )
+    columns = ['transaction_id', 'transaction_date', 'account_id', 'payee_id', 'category_id', 'transaction_amount']
+    category_lines = pl.concat([
+        unsplit_transactions.select(columns),
+        subtransactions.rename({'subtransaction_amount': 'transaction_amount'}).select(columns),
+    ])
+    return category_lines.join(tables['categories'], left_on='category_id', right_on='category_id', suffix='_category')
+
+
+def spend_per_day(master_transactions):
+    return master_transactions.sql('''
+        SELECT
+            date,
+            year,
+            month,
+            day,
+            ABS(SUM(transaction_amount)) as total
+        FROM self
+        WHERE category_name != 'Inflow: Ready to Assign'
+        GROUP BY date, year, month, day
+        ORDER BY date DESC
+        '''
+    )
+
+
+def spend_per_category(category_lines):
+    return category_lines.sql('''
+        SELECT
+            category_name,
+            ABS(SUM(transaction_amount)) as total
+        FROM self
+        WHERE category_name != 'Inflow: Ready to Assign'
+        GROUP BY category_name
+        ORDER BY total DESC
+        '''
+    )
+
+
+def spend_per_payee(master_transactions):
+    return master_transactions.sql('''
+        SELECT
+            payee_name,
+            ABS(SUM(transaction_amount)) as total
+        FROM self
+        WHERE payee_name != 'Starting Balance'
+            AND transaction_amount < 0
+        GROUP BY payee_name
+        ORDER BY total DESC
+        '''
+    )
+
+
+def balance_per_day(tables):
+    '''Daily balance per account, read straight from the precomputed account balances fact'''
+    return tables['account_balances'].join(tables['accounts'].select('account_id', 'account_name'), on='account_id')\
+                .select('date', 'account_name', 'balance')\
+                .sort(['account_name', 'date'])
@@ -1,4 +1,5 @@
 import os
+import argparse
 import dotenv
 import logging
 import yaml
@@ -9,6 +10,7 @@ import logging.handlers
 
 import config.exit_codes as ec
 from pipeline.pipeline_main import pipeline_main
+from pipeline import profiling
 
 def set_up_logging():
     try:
@@ -34,11 +36,6 @@ dotenv.load_dotenv()
 API_TOKEN = os.getenv('API_TOKEN')
 BUDGET_ID = os.getenv('BUDGET_ID')
 
-
-if not API_TOKEN or not BUDGET_ID:
-    logging.error('API_TOKEN or BUDGET_ID is not set in .env file')
-    sys.exit(ec.MISSING_ENV_VARS)
-
 try:
     with open('config/config.yaml', 'r') as file:
         config = yaml.safe_load(file)
@@ -51,21 +48,58 @@ except yaml.YAMLError as e:
 
 config['API_TOKEN'] = API_TOKEN
 config['BUDGET_ID'] = BUDGET_ID
+# BASE_URL lets the pipeline run against a local stand-in such as synthetic/mock_api.py
+config['base_url'] = os.getenv('BASE_URL', config['base_url'])
 
     #sys.exit(ec.SUCCESS)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Data pipeline for YNAB')
+    subparsers = parser.add_subparsers(dest='command', help='run the pipeline (the default) or serve the warehouse')
+    serve_parser = subparsers.add_parser('serve', help='serve the warehouse over a local HTTP/JSON query API')
+    serve_parser.add_argument('--host', help='address to listen on, defaults to query_service_host in config.yaml')
+    serve_parser.add_argument('--port', type=int, help='port to listen on, defaults to query_service_port in config.yaml')
+    serve_parser.add_argument('--cache-size', type=int, help='number of query results to keep in the LRU cache')
+    parser.add_argument('--profile', choices=profiling.PROFILE_MODES,
+                        help='profile the pipeline stages, reports are written to logs/')
+    parser.add_argument('--profile-stages', nargs='+', metavar='STAGE',
+                        help='only profile these stages, e.g. RawToBase TableSpecs')
+    parser.add_argument('--profile-polars', action='store_true',
+                        help='dump LazyFrame.profile() timings for each polars plan')
+    parser.add_argument('--profile-interval', type=float, default=0.005,
+                        help='seconds between samples for the sampling profiler')
+    return parser.parse_args()
+
+def serve(args):
+    from query_service import QueryService
+    service = QueryService(config, host=args.host, port=args.port, cache_size=args.cache_size)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Query service stopped')
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'serve':
+        serve(args)
+        sys.exit(ec.SUCCESS)
+
+    if not API_TOKEN or not BUDGET_ID:
+        logging.error('API_TOKEN or BUDGET_ID is not set in .env file')
+        sys.exit(ec.MISSING_ENV_VARS)
+
+    profiling.configure(
+        mode=args.profile,
+        stages=args.profile_stages,
+        polars_plans=args.profile_polars,
+        interval=args.profile_interval,
+    )
     try:
+        # exits with NO_DATA_PRODUCED when the pipeline did not produce any data
         pipeline_main(config)
-        
-        # Check if the data was successfully created
-        data_exists = os.path.exists('data/processed') and os.listdir('data/processed')
-        if data_exists:
-            from dash_app import app
-            app.run() # debug=True
-        else:
-            logging.error('Data pipeline did not produce any data. Dash app will not run.')
-            sys.exit(ec.NO_DATA_PRODUCED)
+
+        from dash_app import app
+        app.run() # debug=True
     except SystemExit as e:
         exit_code = e.code
         if exit_code == ec.SUCCESS:
@@ -0,0 +1,98 @@
+'''Module to compact the base tables, dropping tombstones of deleted records once they are past their retention'''
+
+import os
+import json
+import logging
+from datetime import date, timedelta
+from typing import Dict, Any
+
+import polars as pl
+from pipeline import profiling
+from pipeline.instrumentation import span, record, file_size
+
+
+class CompactBase:
+    def __init__(self, config: Dict[str, Any]):
+        """
+        YNAB delta syncs send deleted records as tombstones (`deleted: true`). RawToBase keeps them so the
+        delete wins over the older version, but once a tombstone is older than `tombstone_retention_days`
+        it has done its job. Every `compaction_interval_days` the base tables are rewritten without them,
+        so the tables stop growing with churn. The date each table was last compacted is kept in
+        `compaction_state_file`.
+        """
+        self.config = config
+        self.entities = config['entities']
+        self.base_data_path = config['base_data_path']
+        self.state_file = config['compaction_state_file']
+        self.retention_days = config.get('tombstone_retention_days', 30)
+        self.interval_days = config.get('compaction_interval_days', 7)
+        self.today = date.today()
+        self.state = self.load_state()
+        self.compact_entities()
+
+    def load_state(self) -> Dict[str, str]:
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logging.warning(f"Could not read compaction state file {self.state_file}, compacting every table: {e}")
+        return {}
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f, indent=4)
+
+    def is_due(self, entity: str) -> bool:
+        last_compacted = self.state.get(entity)
+        if last_compacted is None:
+            return True
+        return self.today - date.fromisoformat(last_compacted) >= timedelta(days=self.interval_days)
+
+    def compact_entities(self):
+        for entity in self.entities:
+            if not self.is_due(entity):
+                logging.debug(f"Compaction of {entity} is not due yet, last compacted on {self.state[entity]}")
+                continue
+            with span('compact_entity', entity=entity):
+                if self._compact(entity):
+                    self.state[entity] = self.today.isoformat()
+        try:
+            self.save_state()
+        except Exception as e:
+            logging.error(f"Failed to save the compaction state to {self.state_file}: {e}")
+
+    def _compact(self, entity: str) -> bool:
+        file_path = os.path.join(self.base_data_path, f'{entity}.parquet')
+        if not os.path.exists(file_path):
+            logging.debug(f"No base data to compact for entity: {entity}")
+            return False
+        base_data = pl.scan_parquet(file_path)
+        schema = base_data.collect_schema()
+        if 'deleted' not in schema:
+            logging.debug(f"Entity: {entity} has no deleted flag, nothing to compact")
+            return True
+
+        # ingestion_date is the date the delete arrived, as the tombstone replaced the live record then
+        cut_off = self.today - timedelta(days=self.retention_days)
+        expired = pl.col('deleted').fill_null(False) & (pl.col('ingestion_date') < cut_off)
+        try:
+            expired_count = profiling.collect(base_data.select(expired.sum()), f'CompactBase.{entity}_count').item()
+        except Exception as e:
+            logging.error(f"Failed to count expired tombstones for entity: {entity}, error: {e}")
+            return False
+        record(bytes_read=file_size(file_path))
+        if not expired_count:
+            logging.info(f"No tombstones older than {cut_off} in entity: {entity}")
+            return True
+
+        try:
+            compacted = profiling.collect(base_data.filter(~expired), f'CompactBase.{entity}')
+            compacted.write_parquet(file_path)
+        except Exception as e:
+            logging.error(f"Failed to compact base data for entity: {entity}, error: {e}")
+            return False
+        record(rows_out=compacted.height, tombstones_dropped=expired_count, bytes_written=file_size(file_path))
+        logging.info(f"Dropped {expired_count} tombstones older than {cut_off} from entity: {entity}")
+        return True
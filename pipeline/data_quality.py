@@ -0,0 +1,214 @@
+'''Module to check the warehouse tables against declarative data quality rules and quarantine failing rows'''
+
+import os
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List, Tuple
+
+import polars as pl
+from pipeline import profiling
+from pipeline.instrumentation import span, record, set_attributes, file_size
+
+CHECKS = ['unique', 'not_null', 'foreign_key', 'range', 'valid_date']
+SEVERITIES = ['error', 'warn']
+
+
+def rule_name(rule: Dict[str, Any]) -> str:
+    """
+    The name a rule is reported under, e.g. unique(transaction_id) or foreign_key(account_id->accounts.account_id).
+    """
+    if rule.get('name'):
+        return rule['name']
+    check = rule['check']
+    if check == 'unique':
+        return f"unique({','.join(rule['columns'])})"
+    if check == 'foreign_key':
+        return f"foreign_key({rule['column']}->{rule['references']})"
+    return f"{check}({rule['column']})"
+
+
+def expand_rules(rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Validate the rules of one table and split not_null rules into one rule per column,
+    so every column gets its own count.
+    """
+    expanded = []
+    for rule in rules:
+        if rule.get('check') not in CHECKS:
+            raise ValueError(f"Unknown data quality check {rule.get('check')}, expected one of {CHECKS}")
+        if rule.get('severity', 'error') not in SEVERITIES:
+            raise ValueError(f"Unknown data quality severity {rule.get('severity')}, expected one of {SEVERITIES}")
+        if rule['check'] == 'not_null':
+            expanded.extend({**rule, 'column': column} for column in rule['columns'])
+        else:
+            expanded.append(rule)
+    return expanded
+
+
+def _as_date(value) -> date:
+    # yaml reads unquoted dates as dates, quoted ones as strings
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value))
+
+
+class DataQuality:
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Check every table listed under `data_quality` in the config. Each table is checked in a single
+        lazy plan that adds one boolean column per rule, so the table is read once however many rules it has.
+        Rows failing an error rule are moved out of the table into the quarantine folder, rows failing only
+        warn rules stay in the table and are copied there for inspection. Tables listed in
+        `data_quality_incremental_tables` keep every row, as their stage would not rebuild a removed one.
+        """
+        self.config = config
+        self.warehouse_path = config['warehouse_data_path']
+        self.quarantine_path = config['quarantine_data_path']
+        self.rules = config.get('data_quality') or {}
+        self.incremental_tables = set(config.get('data_quality_incremental_tables') or [])
+        self.checked_at = datetime.now()
+        os.makedirs(self.quarantine_path, exist_ok=True)
+        self.transform()
+
+    def table_path(self, table: str) -> str:
+        return f"{self.warehouse_path}/{table}.parquet"
+
+    def quarantine_file_path(self, table: str) -> str:
+        return f"{self.quarantine_path}/{table}.parquet"
+
+    def rule_flag(self, rule: Dict[str, Any], schema: pl.Schema) -> pl.Expr:
+        """
+        An expression that is true for every row breaking a rule. Nulls only ever break not_null rules.
+        """
+        check = rule['check']
+        if check == 'unique':
+            # the first row of each key is kept, only the repeats are flagged
+            columns = rule['columns']
+            key = pl.col(columns[0]) if len(columns) == 1 else pl.struct(columns)
+            return ~key.is_first_distinct()
+        column = pl.col(rule['column'])
+        if check == 'not_null':
+            return column.is_null()
+        if check == 'range':
+            flag = pl.lit(False)
+            if rule.get('min') is not None:
+                flag = flag | (column < rule['min'])
+            if rule.get('max') is not None:
+                flag = flag | (column > rule['max'])
+            return flag.fill_null(False)
+        if check == 'valid_date':
+            dtype = schema[rule['column']]
+            if dtype.is_integer():
+                parsed = column.cast(pl.Utf8).str.strptime(pl.Date, format='%Y%m%d', strict=False)
+            elif dtype == pl.Utf8:
+                parsed = column.str.strptime(pl.Date, format='%Y-%m-%d', strict=False)
+            else:
+                parsed = column.cast(pl.Date)
+            flag = column.is_not_null() & parsed.is_null()
+            if rule.get('min') is not None:
+                flag = flag | (parsed < _as_date(rule['min']))
+            if rule.get('max_days_ahead') is not None:
+                flag = flag | (parsed > date.today() + timedelta(days=rule['max_days_ahead']))
+            return flag.fill_null(False)
+        raise ValueError(f"Rule {rule_name(rule)} has no row level flag")
+
+    def add_flags(self, table_data: pl.LazyFrame, rules: List[Dict[str, Any]]) -> Tuple[pl.LazyFrame, List[str]]:
+        """
+        Add a `_dq_<n>` boolean column per rule to the plan. Foreign keys are checked with `is_in` against
+        the distinct keys of the referenced table, which are small dimension tables, rather than a lookup per row.
+        """
+        schema = table_data.collect_schema()
+        flags = []
+        for i, rule in enumerate(rules):
+            flag = f'_dq_{i}'
+            if rule['check'] == 'foreign_key':
+                ref_table, ref_column = rule['references'].split('.')
+                ref_path = self.table_path(ref_table)
+                if not os.path.exists(ref_path):
+                    raise FileNotFoundError(f"The referenced table {ref_table} does not exist")
+                record(bytes_read=file_size(ref_path))
+                ref_keys = profiling.collect(
+                    pl.scan_parquet(ref_path).select(pl.col(ref_column).unique()), f'DataQuality.{ref_table}_keys'
+                )[ref_column]
+                column = pl.col(rule['column'])
+                ignored = pl.Series(rule.get('ignore') or [], dtype=schema[rule['column']])
+                found = column.is_in(ref_keys.implode()) | column.is_in(ignored.implode())
+                table_data = table_data.with_columns((column.is_not_null() & ~found).alias(flag))
+            else:
+                table_data = table_data.with_columns(self.rule_flag(rule, schema).alias(flag))
+            flags.append(flag)
+        return table_data, flags
+
+    def check_table(self, table: str, rules: List[Dict[str, Any]]):
+        path = self.table_path(table)
+        try:
+            table_data = pl.scan_parquet(path)
+            table_data.collect_schema()
+        except FileNotFoundError:
+            logging.warning(f"The {table} table does not exist, skipping its data quality checks")
+            return
+        record(bytes_read=file_size(path))
+
+        try:
+            rules = expand_rules(rules)
+            flagged, flags = self.add_flags(table_data, rules)
+            checked = profiling.collect(flagged, f'DataQuality.{table}')
+        except Exception as e:
+            logging.error(f"Failed to run the data quality checks for table: {table}, error: {e}")
+            return
+        record(rows_in=checked.height)
+
+        names = [rule_name(rule) for rule in rules]
+        counts = checked.select([pl.col(flag).sum().alias(name) for flag, name in zip(flags, names)]).row(0, named=True)
+        for name, count in counts.items():
+            if count:
+                logging.warning(f"Data quality rule {name} failed for {count} rows of table: {table}")
+            else:
+                logging.debug(f"Data quality rule {name} passed for table: {table}")
+        set_attributes(rule_counts=counts)
+
+        # an incremental table only rebuilds rows whose source changed, so its failing rows are never removed
+        error_flags = [] if table in self.incremental_tables else [
+            flag for flag, rule in zip(flags, rules) if rule.get('severity', 'error') == 'error'
+        ]
+        is_error = pl.any_horizontal([pl.col(flag) for flag in error_flags]) if error_flags else pl.lit(False)
+        offending = checked.filter(pl.any_horizontal([pl.col(flag) for flag in flags]))
+        quarantine_path = self.quarantine_file_path(table)
+        if offending.is_empty():
+            if os.path.exists(quarantine_path):
+                os.remove(quarantine_path)
+            logging.info(f"All data quality rules passed for table: {table}")
+            return
+
+        quarantine = offending.with_columns([
+            pl.concat_list([pl.when(pl.col(flag)).then(pl.lit(name)) for flag, name in zip(flags, names)])
+            .list.drop_nulls().alias('failed_rules'),
+            is_error.alias('removed'),
+            pl.lit(self.checked_at).alias('checked_at'),
+        ]).drop(flags)
+        try:
+            quarantine.write_parquet(quarantine_path)
+            record(rows_quarantined=quarantine.height, bytes_written=file_size(quarantine_path))
+        except Exception as e:
+            logging.error(f"Failed to write the quarantine file for table: {table}, error: {e}")
+            return
+        logging.info(f"Wrote {quarantine.height} offending rows of table: {table} to {quarantine_path}")
+
+        removed = int(quarantine['removed'].sum())
+        if not removed:
+            return
+        # only rewrite the table when an error rule actually removed rows from it
+        try:
+            checked.filter(~is_error).drop(flags).write_parquet(path)
+            record(rows_out=checked.height - removed, bytes_written=file_size(path))
+        except Exception as e:
+            logging.error(f"Failed to remove the quarantined rows from table: {table}, error: {e}")
+            return
+        logging.warning(f"Removed {removed} rows failing error rules from table: {table}")
+
+    def transform(self):
+        for table, rules in self.rules.items():
+            with span('data_quality_table', table=table):
+                self.check_table(table, rules or [])
@@ -1,7 +1,21 @@
 import polars as pl
 import logging
 import os
-from datetime import date
+from pipeline.instrumentation import record, file_size
+from pipeline import profiling
+from datetime import date, timedelta
+
+
+def date_key(date_column: pl.Expr) -> pl.Expr:
+    """
+    The integer yyyymmdd key of a date, used as date_id in the dates dimension and to reference it from the facts.
+    """
+    # month and day are Int8, cast before multiplying so the key does not overflow
+    return (
+        date_column.dt.year().cast(pl.Int32) * 10000
+        + date_column.dt.month().cast(pl.Int32) * 100
+        + date_column.dt.day().cast(pl.Int32)
+    )
 
 class Dimensions:
     def __init__(self, config):
@@ -13,214 +27,109 @@ class Dimensions:
         return f"{self.base_file_path}/{file_name}"
         
         
-class DimAccounts(Dimensions):
+class DimDate(Dimensions):
     def __init__(self, config):
         super().__init__(config)
-        self.file_path = self.get_full_file_path('accounts.parquet')
+        self.output_path = self.config['warehouse_data_path'] + '/dates.parquet'
         self.transform()
 
-    def transform(self):
-        # Read the parquet file into a polars DataFrame
-        try:
-            source_accounts = pl.read_parquet(self.file_path)
-        except Exception as e:
-            logging.error(f"Failed to read the base accounts parquet file: {e}")
-            return
-
-        logging.info("Transforming the accounts DataFrame")
-        try:
-            base_accounts = (
-                source_accounts.select([
-                    "id",
-                    "name",
-                    "type",
-                    "on_budget",
-                    "closed",
-                    "note",
-                    "balance",
-                    "cleared_balance",
-                    "uncleared_balance",
-                    "deleted"
-                ])
-            )
-        except Exception as e:
-            logging.error(f"Failed to select columns from the categories DataFrame: {e}")
-            return
-
-        try:
-            add_accounts_prefix = base_accounts.with_columns([
-                pl.col("id").alias("account_id"),
-                pl.col("name").alias("account_name"),
-                pl.col("type").alias("account_type")
-            ])
-            fill_accounts_null_values = add_accounts_prefix.with_columns([
-                pl.col('note').fill_null('none')
-            ])
-            fix_accounts_values = fill_accounts_null_values.with_columns([
-                (pl.col("balance") / 1000).alias("balance"),
-                (pl.col("cleared_balance") / 1000).alias("cleared_balance"),
-                (pl.col("uncleared_balance") / 1000).alias("uncleared_balance"),
+    def required_date_range(self):
+        """
+        The span of dates the facts need, from the earliest transaction or schedule to the latest one
+        or the end of the forecast horizon, whichever is later. None when there is no data yet.
+        """
+        date_columns = {
+            'transactions.parquet': ['date'],
+            'scheduled_transactions.parquet': ['date_first', 'date_next'],
+            'months.parquet': ['month'],
+        }
+        bounds = []
+        for file_name, columns in date_columns.items():
+            file_path = self.get_full_file_path(file_name)
+            if not os.path.exists(file_path):
+                continue
+            source_dates = pl.scan_parquet(file_path).select([
+                pl.col(column).str.strptime(pl.Date, format='%Y-%m-%d') for column in columns
             ])
-            drop_accounts_columns = fix_accounts_values.drop([
-                "id", "name", "type"
-            ])
-        except Exception as e:
-            logging.error(f"Failed to transform the accounts DataFrame: {e}")
-            return
-
-        logging.info("Writing the transformed accounts DataFrame to parquet file")
-        try:
-            drop_accounts_columns.write_parquet(self.config['warehouse_data_path'] + '/accounts.parquet')
-        except Exception as e:
-            logging.error(f"Failed to write the transformed accounts DataFrame to parquet file: {e}")
-            return
+            bounds.append(source_dates.select([
+                pl.min_horizontal(pl.all().min()).alias('first_date'),
+                pl.max_horizontal(pl.all().max()).alias('last_date'),
+            ]))
+            record(bytes_read=file_size(file_path))
+        if not bounds:
+            return None
+        first_date, last_date = profiling.collect(pl.concat(bounds).select(
+            pl.col('first_date').min(), pl.col('last_date').max()
+        ), 'DimDate.range').row(0)
+        if first_date is None:
+            return None
+        horizon_end = date.today() + timedelta(days=self.config.get('forecast_horizon_days', 365))
+        return first_date, max(last_date, horizon_end)
 
-class DimCategories(Dimensions):
-    def __init__(self, config):
-        super().__init__(config)
-        self.file_path = self.get_full_file_path('categories.parquet')
-        self.transform()
-    
-    def transform(self):
-        try:
-            source_categories = pl.read_parquet(self.file_path)
-        except Exception as e: 
-            logging.error(f"Failed to read the base categories parquet file: {e}")
-            return
-        logging.info("Transforming the categories DataFrame")
-        try:
-            base_categories = source_categories.select([
-                'id',
-                'name',
-                'category_group_name',
-                'hidden',
-                'note',
-                'budgeted',
-                'activity',
-                'balance',
-                'deleted'
-            ])
-        except Exception as e:
-            logging.error(f"Failed to select columns from the categories DataFrame: {e}")
-            return
-        
-        try:
-            add_categories_prefix = base_categories.with_columns([
-                pl.col('id').alias('category_id'),
-                pl.col('name').alias('category_name')
-            ])
-            fill_null_category_values = add_categories_prefix.with_columns([
-                pl.col('note').fill_null('none')
-            ])
-            fix_categories_values = fill_null_category_values.with_columns([
-                (pl.col('balance') / 1000),
-                (pl.col('budgeted') / 1000),
-                (pl.col('activity') / 1000)
-            ])
-            drop_categories_columns = fix_categories_values.drop([
-                'id', 'name'
-            ])
-        except Exception as e:
-            logging.error(f"Failed to transform the categories DataFrame: {e}")
-            return
-
-        logging.info("Writing the transformed categories DataFrame to parquet file")
-        try:
-            drop_categories_columns.write_parquet(self.config['warehouse_data_path'] + '/categories.parquet')
-        except Exception as e:
-            logging.error(f"Failed to write the transformed categories DataFrame to parquet file: {e}")
-            return
+    def build_dates(self, first_date, last_date):
+        dates_df = pl.DataFrame({'date': pl.date_range(first_date, last_date, "1d", eager=True)})
+        # Extract year, month, day, and weekday from the date column
+        dates_df = dates_df.with_columns([
+            pl.col('date').dt.year().alias('year'),
+            pl.col('date').dt.month().alias('month'),
+            pl.col('date').dt.day().alias('day'),
+            pl.col('date').dt.weekday().alias('weekday')
+        ])
+        # True for weekdays (Monday to Friday), False for weekends (Saturday and Sunday)
+        dates_df = dates_df.with_columns([
+            (pl.col('weekday') < 6).alias('is_weekday'),
+            date_key(pl.col('date')).alias('date_id'),
+        ])
+        return dates_df
 
-class DimPayees(Dimensions):
-    def __init__(self, config):
-        super().__init__(config)
-        self.file_path = self.get_full_file_path('payees.parquet')
-        self.transform()
-    
     def transform(self):
         try:
-            source_payees = pl.read_parquet(self.file_path)
+            date_range = self.required_date_range()
         except Exception as e:
-            logging.error(f"Failed to read the base payees parquet file: {e}")
+            logging.error(f"Failed to find the range of dates used by the facts: {e}")
             return
-        logging.info("Transforming the payees DataFrame")
-        try:
-            base_payees = source_payees.select([
-                'id',
-                'name',
-                'deleted'
-            ])
-        except Exception as e:
-            logging.error(f"Failed to select columns from the payees DataFrame: {e}")
+        if date_range is None:
+            logging.warning("No dated records found, skipping the dates dimension")
             return
+        first_date, last_date = date_range
 
-        try:
-            add_payees_prefix = base_payees.with_columns([
-                pl.col('id').alias('payee_id'),
-                pl.col('name').alias('payee_name')
-            ])
-            drop_payees_columns = add_payees_prefix.drop([
-                'id', 'name'
-            ])
-        except Exception as e:
-            logging.error(f"Failed to rename columns in the payees DataFrame: {e}")
-            return
+        existing_dates = None
+        if os.path.exists(self.output_path):
+            try:
+                existing_dates = pl.read_parquet(self.output_path)
+                record(bytes_read=file_size(self.output_path))
+            except Exception as e:
+                logging.warning(f"Failed to read the existing dates dimension, rebuilding it: {e}")
+            # tables written before date_id became an integer key are rebuilt rather than extended
+            if existing_dates is not None and (existing_dates.is_empty() or existing_dates.schema['date_id'] != pl.Int32):
+                existing_dates = None
 
-        # Write the DataFrame to a new parquet file
-        logging.info("Writing the transformed payees DataFrame to parquet file")
-        try:
-            drop_payees_columns.write_parquet(self.config['warehouse_data_path'] + '/payees.parquet')
-        except Exception as e:
-            logging.error(f"Failed to write the transformed payees DataFrame to parquet file: {e}")
-            return
+        # the dimension only ever grows, new dates are added on either side of the cached range
+        new_ranges = []
+        if existing_dates is None:
+            new_ranges.append((first_date, last_date))
+        else:
+            cached_first, cached_last = existing_dates['date'].min(), existing_dates['date'].max()
+            if first_date < cached_first:
+                new_ranges.append((first_date, cached_first - timedelta(days=1)))
+            if last_date > cached_last:
+                new_ranges.append((cached_last + timedelta(days=1), last_date))
+            if not new_ranges:
+                logging.info(f"The dates dimension already covers {first_date} to {last_date}")
+                return
 
-class DimDate(Dimensions):
-    def __init__(self, config):
-        super().__init__(config)
-        self.transform()
-    
-    def transform(self):
-        # Create a DataFrame with dates from 2020-01-01 to 2030-12-31
         try:
-            dates_df = pl.DataFrame({'date':pl.date_range(date(2020, 1, 1), date(2030, 12, 31), "1d", eager=True)})
+            new_dates = [self.build_dates(start, end) for start, end in new_ranges]
         except Exception as e:
             logging.error(f"Failed to create a DataFrame with dates: {e}")
             return
-        # Extract year, month, day, and weekday from the date column
-        try:
-            dates_df = dates_df.with_columns([
-                pl.col('date').dt.year().alias('year'),
-                pl.col('date').dt.month().alias('month'),
-                pl.col('date').dt.day().alias('day'),
-                pl.col('date').dt.weekday().alias('weekday')
-            ])
-        except Exception as e:
-            logging.error(f"Failed to extract year, month, day, and weekday from the date column: {e}")
-            return 
-        try:
-            # Create a new column to indicate if the date is a weekday or weekend
-            dates_df = dates_df.with_columns([
-                (pl.col('weekday') < 6).alias('is_weekday')  # True for weekdays (Monday to Friday), False for weekends (Saturday and Sunday)
-            ])
-        except Exception as e:
-            logging.error(f"Failed to create a new column to indicate if the date is a weekday or weekend: {e}")
-            return
-        
-        # Create a primary key by concatenating year, month, and day with no separators
-        try:
-            dates_df = dates_df.with_columns([
-                (pl.col('year').cast(pl.Utf8) + 
-                 pl.col('month').cast(pl.Utf8).str.zfill(2) +
-                 pl.col('day').cast(pl.Utf8).str.zfill(2)
-                ).alias('date_id')
-            ])
-        except Exception as e:
-            logging.error(f"Failed to create the primary key column: {e}")
-            return
+        dates_df = pl.concat(new_dates if existing_dates is None else [existing_dates, *new_dates]).sort('date')
+
         # Write the DataFrame to a new parquet file
-        logging.info("Writing the transformed dates DataFrame to parquet file")
+        logging.info(f"Writing the dates DataFrame from {dates_df['date'].min()} to {dates_df['date'].max()} to parquet file")
         try:
-            dates_df.write_parquet(self.config['warehouse_data_path'] + '/dates.parquet')
+            dates_df.write_parquet(self.output_path)
+            record(rows_out=sum(df.height for df in new_dates), bytes_written=file_size(self.output_path))
         except Exception as e:
             logging.error(f"Failed to write the transformed dates DataFrame to parquet file: {e}")
             return
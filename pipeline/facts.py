@@ -1,6 +1,37 @@
 import polars as pl
 import logging
 import os
+import json
+import hashlib
+from datetime import date, timedelta
+from pipeline.instrumentation import record, file_size
+from pipeline import profiling
+from pipeline.dimensions import date_key
+
+# recurrence rules of scheduled transactions, as a step in days or in calendar months
+SCHEDULE_DAY_STEPS = {
+    'daily': 1,
+    'weekly': 7,
+    'everyOtherWeek': 14,
+    'every4Weeks': 28,
+}
+SCHEDULE_MONTH_STEPS = {
+    'monthly': 1,
+    'twiceAMonth': 1,
+    'everyOtherMonth': 2,
+    'every3Months': 3,
+    'every4Months': 4,
+    'twiceAYear': 6,
+    'yearly': 12,
+    'everyOtherYear': 24,
+}
+# twiceAMonth repeats monthly from date_next and again from this many days after it
+TWICE_A_MONTH_OFFSET_DAYS = 15
+
+
+def stable_digest(value) -> str:
+    '''A digest of a nested value that only changes with its content, unlike polars hashes which may change between versions'''
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
 
 class Facts:
     def __init__(self, config):
@@ -10,8 +41,12 @@ class Facts:
         
     def get_full_file_path(self, file_name):
         return f"{self.base_file_path}/{file_name}"
+
+    def scan_live_records(self, file_path):
+        '''Scan a base table without its tombstones, the deleted filter is pushed down into the parquet scan'''
+        return pl.scan_parquet(file_path).filter(~pl.col('deleted'))
     
-class FactTransactions(Facts):
+class FactSubtransactions(Facts):
     def __init__(self, config):
         super().__init__(config)
         self.file_path = self.get_full_file_path('transactions.parquet')
@@ -19,132 +54,548 @@ class FactTransactions(Facts):
 
     def transform(self):
         try:
-            source_transactions = pl.read_parquet(self.file_path)
+            source_transactions = self.scan_live_records(self.file_path)
+            source_schema = source_transactions.collect_schema()
         except FileNotFoundError:
             logging.error("The transactions DataFrame does not exist")
             return
+        record(bytes_read=file_size(self.file_path))
 
+        # subtransactions is a list of structs once any split has been loaded, before that it has no fields to read
+        subtransactions_type = source_schema.get('subtransactions')
+        if not (isinstance(subtransactions_type, pl.List) and isinstance(subtransactions_type.inner, pl.Struct)):
+            logging.info("No split transactions found, writing an empty subtransactions DataFrame")
+            subtransactions = pl.DataFrame(schema={
+                'subtransaction_id': pl.Utf8,
+                'transaction_id': pl.Utf8,
+                'transaction_date': pl.Int32,
+                'account_id': pl.Utf8,
+                'payee_id': pl.Utf8,
+                'category_id': pl.Utf8,
+                'memo': pl.Utf8,
+                'transfer_account_id': pl.Utf8,
+                'deleted': pl.Boolean,
+                'subtransaction_amount': pl.Float64,
+            })
+        else:
+            logging.info("Transforming the subtransactions DataFrame")
+            sub = pl.col('subtransactions').struct.field
+            try:
+                exploded_subtransactions = (
+                    source_transactions
+                    .select(['id', 'date', 'account_id', 'payee_id', 'deleted', 'subtransactions'])
+                    .filter(pl.col('subtransactions').list.len() > 0)
+                    .explode('subtransactions')
+                    .filter(~sub('deleted').fill_null(False))
+                    .with_columns([
+                        pl.col('date').str.strptime(pl.Date, format='%Y-%m-%d').alias('date')
+                    ])
+                )
+                subtransactions = profiling.collect(
+                    exploded_subtransactions.select([
+                        sub('id').alias('subtransaction_id'),
+                        pl.col('id').alias('transaction_id'),
+                        date_key(pl.col('date')).alias('transaction_date'),
+                        pl.col('account_id'),
+                        # a split line only carries its own payee when it differs from the parent
+                        pl.coalesce([sub('payee_id').cast(pl.Utf8), pl.col('payee_id')]).alias('payee_id'),
+                        sub('category_id').cast(pl.Utf8).fill_null('none').alias('category_id'),
+                        sub('memo').cast(pl.Utf8).fill_null('none').alias('memo'),
+                        sub('transfer_account_id').cast(pl.Utf8).fill_null('none').alias('transfer_account_id'),
+                        (sub('deleted') | pl.col('deleted')).alias('deleted'),
+                        (sub('amount') / 1000).alias('subtransaction_amount'),
+                    ]),
+                    'FactSubtransactions'
+                )
+            except Exception as e:
+                logging.error(f"Failed to transform the subtransactions DataFrame: {e}")
+                return
+
+        logging.info("Writing the transformed subtransactions DataFrame to parquet file")
         try:
-            base_transactions = source_transactions.select([
-                "id",
-                "date",
-                "amount",
-                "memo",
-                "cleared",
-                "approved",
-                "flag_color",
-                "account_id",
-                "payee_id",
-                "category_id",
-                "transfer_account_id"
-            ])
+            subtransactions.write_parquet(self.config['warehouse_data_path'] + '/subtransactions.parquet')
+            record(rows_out=subtransactions.height, bytes_written=file_size(self.config['warehouse_data_path'] + '/subtransactions.parquet'))
         except Exception as e:
-            logging.error(f"Failed to select columns from the transactions DataFrame: {e}")
+            logging.error(f"Failed to write the transformed subtransactions DataFrame: {e}")
+
+class FactMonthlyCategoryBudget(Facts):
+    def __init__(self, config):
+        super().__init__(config)
+        self.file_path = self.get_full_file_path('months.parquet')
+        self.output_path = self.config['warehouse_data_path'] + '/monthly_category_budgets.parquet'
+        self.transform()
+
+    def transform(self):
+        try:
+            source_months = pl.scan_parquet(self.file_path)
+            source_schema = source_months.collect_schema()
+        except FileNotFoundError:
+            logging.error("The months DataFrame does not exist")
+            return
+        record(bytes_read=file_size(self.file_path))
+
+        categories_type = source_schema.get('categories')
+        if not (isinstance(categories_type, pl.List) and isinstance(categories_type.inner, pl.Struct)):
+            logging.warning("The months DataFrame has no categories to unnest, skipping the monthly category budgets")
             return
 
-        logging.info("Transforming the transactions DataFrame")
+        base_months = source_months.select([
+            pl.col('month').str.strptime(pl.Date, format='%Y-%m-%d').alias('month'),
+            # one digest per month, so the Python call is cheap
+            pl.col('categories').map_elements(stable_digest, return_dtype=pl.Utf8).alias('source_hash'),
+            'categories',
+        ])
+
+        # a month only needs rebuilding when its categories differ from the ones it was last built from,
+        # ingestion_date alone is not enough as the pipeline can run several times a day
+        existing_budgets = None
+        changed_months = base_months
+        if os.path.exists(self.output_path):
+            try:
+                existing_budgets = pl.read_parquet(self.output_path)
+                record(bytes_read=file_size(self.output_path))
+                if existing_budgets.schema.get('source_hash') != pl.Utf8:
+                    raise ValueError("it was built with the old polars source_hash")
+                changed_months = base_months.join(
+                    existing_budgets.lazy().select(['month', 'source_hash']).unique(),
+                    on=['month', 'source_hash'],
+                    how='anti'
+                )
+            except Exception as e:
+                logging.warning(f"Failed to read the existing monthly category budgets, rebuilding them: {e}")
+                existing_budgets = None
+
+        logging.info("Transforming the monthly category budgets DataFrame")
+        category = pl.col('categories').struct.field
         try:
-            resolve_transaction_dates = base_transactions.with_columns([
-                pl.col("date").str.strptime(pl.Date, format="%Y-%m-%d").alias("date")
-            ])
+            changed_budgets = profiling.collect(
+                changed_months
+                .explode('categories')
+                .filter(pl.col('categories').is_not_null() & ~category('deleted').fill_null(False))
+                .select([
+                    'month',
+                    (pl.col('month').dt.year() * 100 + pl.col('month').dt.month()).cast(pl.Int32).alias('month_id'),
+                    category('id').alias('category_id'),
+                    category('name').alias('category_name'),
+                    category('category_group_name').alias('category_group_name'),
+                    (category('budgeted') / 1000).alias('budgeted'),
+                    (category('activity') / 1000).alias('activity'),
+                    (category('balance') / 1000).alias('balance'),
+                    category('hidden').alias('hidden'),
+                    category('deleted').alias('deleted'),
+                    'source_hash',
+                ]),
+                'FactMonthlyCategoryBudget'
+            )
         except Exception as e:
-            logging.error(f"Failed to covert the date to date format: {e}")
+            logging.error(f"Failed to transform the monthly category budgets DataFrame: {e}")
+            return
+
+        if changed_budgets.is_empty() and existing_budgets is not None:
+            logging.info("No months changed since the last run, keeping the monthly category budgets as they are")
             return
+        logging.info(f"Updating {changed_budgets['month'].n_unique()} changed months of the monthly category budgets")
 
+        if existing_budgets is not None:
+            monthly_budgets = pl.concat([
+                existing_budgets.filter(~pl.col('month').is_in(changed_budgets['month'].unique().implode())),
+                changed_budgets,
+            ], how='vertical_relaxed')
+        else:
+            monthly_budgets = changed_budgets
+        monthly_budgets = monthly_budgets.sort(['month', 'category_id'])
+
+        logging.info("Writing the transformed monthly category budgets DataFrame to parquet file")
         try:
-            add_transaction_prefix = resolve_transaction_dates.with_columns([
-                pl.col("id").alias("transaction_id"),
-                (pl.col("date").dt.year().cast(pl.Utf8) +
-                    pl.col("date").dt.month().cast(pl.Utf8).str.zfill(2) +
-                    pl.col("date").dt.day().cast(pl.Utf8).str.zfill(2)).alias("transaction_date"),
-            ])
-            fix_transaction_nulls = add_transaction_prefix.with_columns([
-                pl.col("memo").fill_null("none"),
-                pl.col("flag_color").fill_null("none"),
-                pl.col("transfer_account_id").fill_null("none"),
-                pl.col("category_id").fill_null("none"),
-            ])
-            fix_transaction_values = fix_transaction_nulls.with_columns([
-                (pl.col("amount") / 1000).alias("transaction_amount")
-            ])
-            drop_transaction_columns = fix_transaction_values.drop([
-                "id", "date", "amount"
-            ])
-            
+            monthly_budgets.write_parquet(self.output_path)
+            record(rows_out=changed_budgets.height, bytes_written=file_size(self.output_path))
         except Exception as e:
-            logging.error(f"Failed to transform the transactions DataFrame: {e}")
+            logging.error(f"Failed to write the transformed monthly category budgets DataFrame: {e}")
+
+class FactAccountBalances(Facts):
+    def __init__(self, config):
+        super().__init__(config)
+        self.file_path = self.get_full_file_path('transactions.parquet')
+        self.output_path = self.config['warehouse_data_path'] + '/account_balances.parquet'
+        self.state_file = self.config['account_balances_state_file']
+        self.transform()
+
+    def load_watermark(self):
+        """
+        The latest ingestion_date of the base transactions the existing balances were built from, None to rebuild.
+        """
+        if not os.path.exists(self.state_file) or not os.path.exists(self.output_path):
+            return None
+        try:
+            with open(self.state_file, 'r') as f:
+                return date.fromisoformat(json.load(f)['ingested_through'])
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read the account balances state file {self.state_file}, rebuilding: {e}")
+            return None
+
+    def save_watermark(self, ingested_through):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        with open(self.state_file, 'w') as f:
+            json.dump({'ingested_through': ingested_through.isoformat() if ingested_through else None}, f, indent=4)
+
+    def changed_accounts(self, base_transactions, watermark, existing_balances, account_totals):
+        """
+        The accounts whose balances may have changed since the last build: those with a record, live or
+        deleted, ingested since the watermark, and those whose total no longer matches their last balance,
+        which catches transactions moved out of an account as only their new version is left in base.
+        ingestion_date is a date, so a run later the same day recomputes every account touched that day.
+        """
+        touched = profiling.collect(
+            base_transactions.filter(pl.col('ingestion_date') >= watermark).select(pl.col('account_id').unique()),
+            'FactAccountBalances.touched'
+        )['account_id']
+        last_balances = (
+            existing_balances.sort('date')
+            .group_by('account_id')
+            .agg((pl.col('balance').last() * 1000).round().cast(pl.Int64).alias('last_balance_milliunits'))
+        )
+        moved = (
+            account_totals.join(last_balances, on='account_id', how='full', coalesce=True)
+            .filter(pl.col('total_milliunits').ne_missing(pl.col('last_balance_milliunits')))
+        )['account_id']
+        return pl.concat([touched, moved]).unique()
+
+    def transform(self):
+        try:
+            base_transactions = pl.scan_parquet(self.file_path)
+            base_transactions.collect_schema()
+        except FileNotFoundError:
+            logging.error("The transactions DataFrame does not exist")
             return
-        # Write the DataFrame to a new parquet file
-        logging.info("Writing the transformed transactions DataFrame to parquet file")
+        source_transactions = base_transactions.filter(~pl.col('deleted'))
+        record(bytes_read=file_size(self.file_path))
+
+        # the one pass over every transaction, a sum and a max per account without parsing a date
         try:
-            drop_transaction_columns.write_parquet(
-                self.config['warehouse_data_path'] + '/transactions.parquet'
+            account_totals = profiling.collect(
+                source_transactions.group_by('account_id').agg(
+                    pl.col('amount').sum().alias('total_milliunits'),
+                    pl.col('date').max().alias('last_date'),
+                ),
+                'FactAccountBalances.totals'
             )
+            ingested_through = profiling.collect(
+                base_transactions.select(pl.col('ingestion_date').max()), 'FactAccountBalances.ingested'
+            ).item()
         except Exception as e:
-            logging.error(f"Failed to write the transformed transactions DataFrame: {e}")
+            logging.error(f"Failed to total the transactions per account: {e}")
+            return
+        if account_totals.is_empty():
+            logging.warning("No transactions to build account balances from")
+            return
+        # one row per account per day runs up to the last transaction in the budget
+        last_date = date.fromisoformat(account_totals['last_date'].max())
 
-class FactScheduledTransactions(Facts):
+        existing_balances = None
+        watermark = self.load_watermark()
+        if watermark is not None:
+            try:
+                existing_balances = pl.read_parquet(self.output_path)
+                record(bytes_read=file_size(self.output_path))
+            except Exception as e:
+                logging.warning(f"Failed to read the existing account balances, rebuilding them: {e}")
+
+        if existing_balances is None:
+            changed_accounts = account_totals['account_id']
+        else:
+            changed_accounts = self.changed_accounts(base_transactions, watermark, existing_balances, account_totals)
+            if changed_accounts.is_empty() and existing_balances['date'].max() == last_date:
+                logging.info("No account balances changed since the last run")
+                self.save_watermark(ingested_through)
+                return
+
+        # amounts stay in integer milliunits until the end, so the cumulative sums and comparisons are exact
+        logging.info(f"Aggregating daily net amounts for {changed_accounts.len()} changed accounts")
+        try:
+            daily_net = profiling.collect(
+                source_transactions
+                .filter(pl.col('account_id').is_in(changed_accounts.implode()))
+                .select([
+                    'account_id',
+                    pl.col('date').str.strptime(pl.Date, format='%Y-%m-%d').alias('date'),
+                    'amount',
+                ])
+                .group_by(['account_id', 'date'])
+                .agg(pl.col('amount').sum().alias('net_milliunits')),
+                'FactAccountBalances'
+            )
+        except Exception as e:
+            logging.error(f"Failed to aggregate the daily net amounts per account: {e}")
+            return
+
+        # from the account's first transaction to the last transaction in the budget
+        daily_series = (
+            daily_net.group_by('account_id').agg(pl.col('date').min().alias('first_date'))
+            .with_columns(pl.date_ranges('first_date', pl.lit(last_date), '1d').alias('date'))
+            .explode('date')
+            .drop('first_date')
+            .join(daily_net, on=['account_id', 'date'], how='left')
+            .with_columns(pl.col('net_milliunits').fill_null(0))
+        )
+
+        if existing_balances is None:
+            first_changes = daily_series.group_by('account_id').agg(pl.col('date').min().alias('first_changed_date'))
+            kept_balances = None
+            opening_balances = first_changes.select('account_id', pl.lit(0, dtype=pl.Int64).alias('opening_milliunits'))
+        else:
+            changed = pl.col('account_id').is_in(changed_accounts.implode())
+            existing = existing_balances.filter(changed).select([
+                'account_id',
+                'date',
+                (pl.col('net_amount') * 1000).round().cast(pl.Int64).alias('existing_net_milliunits'),
+                (pl.col('balance') * 1000).round().cast(pl.Int64).alias('existing_balance_milliunits'),
+            ])
+            # the earliest day per changed account whose net amount differs, or that only exists on one side
+            first_changes = (
+                daily_series.join(existing, on=['account_id', 'date'], how='full', coalesce=True)
+                .filter(pl.col('net_milliunits').ne_missing(pl.col('existing_net_milliunits')))
+                .group_by('account_id')
+                .agg(pl.col('date').min().alias('first_changed_date'))
+            )
+            opening_balances = (
+                existing.join(first_changes, on='account_id')
+                .filter(pl.col('date') < pl.col('first_changed_date'))
+                .group_by('account_id')
+                .agg(pl.col('existing_balance_milliunits').sort_by('date').last().alias('opening_milliunits'))
+            )
+            kept_balances = (
+                existing_balances.join(first_changes, on='account_id', how='left')
+                .filter(pl.col('first_changed_date').is_null() | (pl.col('date') < pl.col('first_changed_date')))
+                .drop('first_changed_date')
+                .filter(pl.col('date') <= last_date)
+            )
+            # the accounts that did not change carry their last balance forward to a later last date
+            carried_forward = (
+                kept_balances.filter(~pl.col('account_id').is_in(first_changes['account_id'].implode()))
+                .sort('date')
+                .group_by('account_id')
+                .agg(pl.col('date').last().alias('last_kept_date'), pl.col('balance').last())
+                .filter(pl.col('last_kept_date') < last_date)
+                .with_columns(
+                    pl.date_ranges(pl.col('last_kept_date') + timedelta(days=1), pl.lit(last_date), '1d').alias('date')
+                )
+                .explode('date')
+                .select(['account_id', 'date', pl.lit(0.0).alias('net_amount'), 'balance'])
+            )
+            kept_balances = pl.concat([kept_balances, carried_forward])
+
+        logging.info(f"Recomputing balances for {first_changes.height} accounts from their earliest changed date")
+        try:
+            recomputed_balances = (
+                daily_series.join(first_changes, on='account_id')
+                .filter(pl.col('date') >= pl.col('first_changed_date'))
+                .join(opening_balances, on='account_id', how='left')
+                .sort(['account_id', 'date'])
+                .with_columns(
+                    (pl.col('opening_milliunits').fill_null(0) + pl.col('net_milliunits').cum_sum().over('account_id'))
+                    .alias('balance_milliunits')
+                )
+                .select([
+                    'account_id',
+                    'date',
+                    (pl.col('net_milliunits') / 1000).alias('net_amount'),
+                    (pl.col('balance_milliunits') / 1000).alias('balance'),
+                ])
+            )
+        except Exception as e:
+            logging.error(f"Failed to compute the running account balances: {e}")
+            return
+
+        account_balances = recomputed_balances if kept_balances is None else pl.concat([kept_balances, recomputed_balances])
+        account_balances = account_balances.sort(['account_id', 'date'])
+
+        logging.info("Writing the account balances DataFrame to parquet file")
+        try:
+            account_balances.write_parquet(self.output_path)
+            record(rows_out=recomputed_balances.height, bytes_written=file_size(self.output_path))
+            self.save_watermark(ingested_through)
+        except Exception as e:
+            logging.error(f"Failed to write the account balances DataFrame: {e}")
+
+
+class FactCashFlowForecast(Facts):
     def __init__(self, config):
         super().__init__(config)
         self.file_path = self.get_full_file_path('scheduled_transactions.parquet')
+        self.output_path = self.config['warehouse_data_path'] + '/cash_flow_forecast.parquet'
+        self.horizon_end = date.today() + timedelta(days=self.config.get('forecast_horizon_days', 365))
         self.transform()
 
     def transform(self):
         try:
-            source_scheduled = pl.read_parquet(self.file_path)
+            source_scheduled = self.scan_live_records(self.file_path)
+            source_scheduled.collect_schema()
         except FileNotFoundError:
             logging.error("The scheduled transactions DataFrame does not exist")
             return
+        record(bytes_read=file_size(self.file_path))
 
+        logging.info(f"Expanding scheduled transactions up to {self.horizon_end}")
         try:
-            base_scheduled = source_scheduled.select([
-                "id",
-                "date_first",
-                "date_next",
-                "frequency",
-                "amount",
-                "memo",
-                "flag_color",
-                "account_id",
-                "payee_id",
-                "category_id",
-                "transfer_account_id"
+            schedules = (
+                source_scheduled
+                .select([
+                    pl.col('id').alias('scheduled_transaction_id'),
+                    pl.col('date_next').str.strptime(pl.Date, format='%Y-%m-%d').alias('date_next'),
+                    'frequency',
+                    'amount',
+                    'account_id',
+                    'payee_id',
+                    'category_id',
+                    'transfer_account_id',
+                ])
+            )
+            # twiceAMonth is two monthly series, the second one starting half a month after date_next
+            schedules = pl.concat([
+                schedules,
+                schedules.filter(pl.col('frequency') == 'twiceAMonth')
+                .with_columns(pl.col('date_next') + pl.duration(days=TWICE_A_MONTH_OFFSET_DAYS)),
             ])
+
+            day_step = pl.col('frequency').replace_strict(SCHEDULE_DAY_STEPS, default=None, return_dtype=pl.Int64)
+            month_step = pl.col('frequency').replace_strict(SCHEDULE_MONTH_STEPS, default=None, return_dtype=pl.Int64)
+            horizon_end = pl.lit(self.horizon_end)
+            days_to_end = (horizon_end - pl.col('date_next')).dt.total_days()
+            months_to_end = (
+                (horizon_end.dt.year() - pl.col('date_next').dt.year()) * 12
+                + horizon_end.dt.month() - pl.col('date_next').dt.month()
+            )
+            # the number of steps that can fit before the horizon, 'never' and unknown rules occur once
+            steps = (
+                pl.when(day_step.is_not_null()).then(days_to_end // day_step)
+                .when(month_step.is_not_null()).then(months_to_end // month_step)
+                .otherwise(0)
+                .clip(lower_bound=0)
+            )
+            # months are added to the first occurrence rather than the previous one, so a 31st stays on month ends
+            occurrence_date = (
+                pl.when(day_step.is_not_null())
+                .then(pl.col('date_next') + pl.duration(days=pl.col('occurrence') * day_step))
+                .when(month_step.is_not_null())
+                .then(pl.col('date_next').dt.offset_by(pl.format('{}mo', pl.col('occurrence') * month_step)))
+                .otherwise(pl.col('date_next'))
+            )
+            forecast = profiling.collect(
+                schedules
+                .with_columns(pl.int_ranges(0, steps + 1).alias('occurrence'))
+                .explode('occurrence')
+                .with_columns(occurrence_date.alias('occurrence_date'))
+                .filter(pl.col('occurrence_date') <= horizon_end)
+                .select([
+                    'scheduled_transaction_id',
+                    'occurrence_date',
+                    'frequency',
+                    'account_id',
+                    'payee_id',
+                    pl.col('category_id').fill_null('none'),
+                    pl.col('transfer_account_id').fill_null('none'),
+                    (pl.col('amount') / 1000).alias('scheduled_transaction_amount'),
+                ])
+                .sort(['occurrence_date', 'scheduled_transaction_id']),
+                'FactCashFlowForecast'
+            )
         except Exception as e:
-            logging.error(f"Failed to select columns from the scheduled transactions DataFrame: {e}")
+            logging.error(f"Failed to expand the scheduled transactions: {e}")
             return
 
+        logging.info("Writing the cash flow forecast DataFrame to parquet file")
         try:
-            resolve_scheduled_dates = base_scheduled.with_columns([
-                pl.col("date_first").str.strptime(pl.Date, format="%Y-%m-%d").alias("date_first"),
-                pl.col("date_next").str.strptime(pl.Date, format="%Y-%m-%d").alias("date_next")
-            ])
+            forecast.write_parquet(self.output_path)
+            record(rows_out=forecast.height, bytes_written=file_size(self.output_path))
         except Exception as e:
-            logging.error(f"Failed to covert the date to date format: {e}")
+            logging.error(f"Failed to write the cash flow forecast DataFrame: {e}")
+
+
+class FactProjectedBalances(Facts):
+    def __init__(self, config):
+        super().__init__(config)
+        self.balances_path = self.config['warehouse_data_path'] + '/account_balances.parquet'
+        self.forecast_path = self.config['warehouse_data_path'] + '/cash_flow_forecast.parquet'
+        self.output_path = self.config['warehouse_data_path'] + '/projected_balances.parquet'
+        self.transform()
+
+    def transform(self):
+        try:
+            account_balances = pl.scan_parquet(self.balances_path)
+            forecast = pl.scan_parquet(self.forecast_path)
+            account_balances.collect_schema()
+            forecast.collect_schema()
+        except FileNotFoundError:
+            logging.error("The account balances or cash flow forecast DataFrame does not exist")
             return
-        
-        logging.info("Transforming the scheduled transactions DataFrame")
+        record(bytes_read=file_size(self.balances_path) + file_size(self.forecast_path))
+
         try:
-            add_scheduled_prefix = resolve_scheduled_dates.with_columns([
-                pl.col("id").alias("scheduled_transaction_id")
-            ])
-            fix_sheduled_nulls = add_scheduled_prefix.with_columns([
-                pl.col("memo").fill_null("none"),
-                pl.col("flag_color").fill_null("none"),
-                pl.col("transfer_account_id").fill_null("none"),
-                pl.col("category_id").fill_null("none"),
-            ])
-            fix_scheduled_values = fix_sheduled_nulls.with_columns([
-                (pl.col("amount") / 1000).alias("scheduled_transaction_amount"),
-            ])
-            drop_scheduled_columns = fix_scheduled_values.drop([
-                "id", "amount"
+            # the latest known balance of every account is where its projection starts
+            latest_balances = profiling.collect(
+                account_balances.group_by('account_id').agg([
+                    pl.col('date').max().alias('last_date'),
+                    pl.col('balance').sort_by('date').last().alias('opening_balance'),
+                ]),
+                'FactProjectedBalances.latest'
+            )
+        except Exception as e:
+            logging.error(f"Failed to read the latest account balances: {e}")
+            return
+        if latest_balances.is_empty():
+            logging.warning("No account balances to project")
+            return
+
+        projection_start = max(date.today(), latest_balances['last_date'].max() + timedelta(days=1))
+        projection_end = profiling.collect(
+            forecast.select(pl.col('occurrence_date').max()), 'FactProjectedBalances.end'
+        ).item()
+        if projection_end is None or projection_end < projection_start:
+            projection_end = projection_start
+
+        logging.info(f"Projecting account balances from {projection_start} to {projection_end}")
+        try:
+            # a scheduled transfer moves money out of one account and into the other
+            scheduled_flows = pl.concat([
+                forecast.select(['account_id', 'occurrence_date', 'scheduled_transaction_amount']),
+                forecast.filter(pl.col('transfer_account_id') != 'none').select([
+                    pl.col('transfer_account_id').alias('account_id'),
+                    'occurrence_date',
+                    -pl.col('scheduled_transaction_amount'),
+                ]),
             ])
+            # overdue scheduled transactions are still to be entered, so they land on the first projected day
+            daily_net = (
+                scheduled_flows
+                .with_columns(pl.max_horizontal('occurrence_date', pl.lit(projection_start)).alias('date'))
+                .group_by(['account_id', 'date'])
+                .agg(pl.col('scheduled_transaction_amount').sum().alias('net_amount'))
+            )
+            projected_balances = profiling.collect(
+                latest_balances.lazy()
+                .select([
+                    'account_id',
+                    'opening_balance',
+                    pl.date_ranges(pl.lit(projection_start), pl.lit(projection_end), '1d').alias('date'),
+                ])
+                .explode('date')
+                .join(daily_net, on=['account_id', 'date'], how='left')
+                .with_columns(pl.col('net_amount').fill_null(0.0))
+                .sort(['account_id', 'date'])
+                .with_columns(
+                    (pl.col('opening_balance') + pl.col('net_amount').cum_sum().over('account_id'))
+                    .alias('projected_balance')
+                )
+                .select(['account_id', 'date', 'net_amount', 'projected_balance']),
+                'FactProjectedBalances'
+            )
         except Exception as e:
-            logging.error(f"Failed to transform the scheduled transactions DataFrame: {e}")
+            logging.error(f"Failed to project the account balances: {e}")
             return
-        logging.info("Writing the transformed scheduled transactions DataFrame to parquet file")
+
+        logging.info("Writing the projected balances DataFrame to parquet file")
         try:
-            drop_scheduled_columns.write_parquet(self.config['warehouse_data_path'] + '/scheduled_transactions.parquet')
+            projected_balances.write_parquet(self.output_path)
+            record(rows_out=projected_balances.height, bytes_written=file_size(self.output_path))
         except Exception as e:
-            logging.error(f"Failed to write the transformed scheduled transactions DataFrame: {e}")
+            logging.error(f"Failed to write the projected balances DataFrame: {e}")
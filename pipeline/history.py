@@ -0,0 +1,119 @@
+'''Module to keep slowly changing dimension (SCD2) history of base tables and answer as-of queries'''
+
+import os
+import logging
+from datetime import date, datetime, time
+from typing import Dict, Any, Union
+
+import polars as pl
+from pipeline import profiling
+from pipeline.instrumentation import record, file_size
+
+VALID_FROM = 'valid_from'
+VALID_TO = 'valid_to'
+# small row groups keep the min/max statistics of the sorted valid_from column selective
+HISTORY_ROW_GROUP_SIZE = 64_000
+
+
+def history_file_path(config: Dict[str, Any], entity: str) -> str:
+    return os.path.join(config['history_data_path'], f'{entity}.parquet')
+
+
+def history_enabled(config: Dict[str, Any], entity: str) -> bool:
+    return entity in (config.get('history_entities') or [])
+
+
+def update_history(config: Dict[str, Any], entity: str, unique_id: str, new_data: pl.DataFrame,
+                   previous_base: pl.DataFrame, loaded_at: datetime) -> bool:
+    """
+    Close the open version of every record in `new_data` at `loaded_at` and append the new versions.
+    The history is stored sorted by valid_from, so as-of queries can binary search instead of scanning.
+    Re-applying the same load replaces it, so a run that failed half way can simply be repeated.
+    """
+    path = history_file_path(config, entity)
+    if os.path.exists(path):
+        record(bytes_read=file_size(path))
+        history = pl.read_parquet(path)
+        # undo an earlier attempt at this same load before applying it again
+        history = history.filter(pl.col(VALID_FROM) != loaded_at).with_columns(
+            pl.when(pl.col(VALID_TO) == loaded_at).then(None).otherwise(pl.col(VALID_TO)).alias(VALID_TO)
+        )
+    elif not previous_base.is_empty():
+        # history switched on for an existing table, seed it with the current rows from their ingestion date
+        logging.info(f"Seeding {entity} history from the existing base table")
+        history = previous_base.with_columns(
+            pl.col('ingestion_date').cast(pl.Datetime('us')).alias(VALID_FROM),
+            pl.lit(None, dtype=pl.Datetime('us')).alias(VALID_TO),
+        )
+    else:
+        history = pl.DataFrame()
+
+    new_versions = new_data.with_columns(
+        pl.lit(loaded_at, dtype=pl.Datetime('us')).alias(VALID_FROM),
+        pl.lit(None, dtype=pl.Datetime('us')).alias(VALID_TO),
+    )
+
+    if not history.is_empty():
+        changed = pl.col(unique_id).is_in(new_data[unique_id].implode()) & pl.col(VALID_TO).is_null()
+        history = history.with_columns(
+            pl.when(changed).then(pl.lit(loaded_at, dtype=pl.Datetime('us'))).otherwise(pl.col(VALID_TO)).alias(VALID_TO)
+        )
+        history = pl.concat([history, new_versions], how='diagonal_relaxed')
+    else:
+        history = new_versions
+
+    history = history.sort([VALID_FROM, unique_id])
+    os.makedirs(config['history_data_path'], exist_ok=True)
+    try:
+        history.write_parquet(path, row_group_size=HISTORY_ROW_GROUP_SIZE, statistics=True)
+    except Exception as e:
+        logging.error(f"Failed to save history for entity: {entity}, error: {e}")
+        return False
+    record(history_rows=history.height, bytes_written=file_size(path))
+    logging.debug(f"Saved {history.height} history rows for entity: {entity} to path: {path}")
+    return True
+
+
+def _as_datetime(at: Union[date, datetime]) -> datetime:
+    # a plain date means "as things stood at the end of that day"
+    if isinstance(at, datetime):
+        return at
+    return datetime.combine(at, time.max)
+
+
+def as_of(config: Dict[str, Any], entity: str, at: Union[date, datetime]) -> pl.DataFrame:
+    """
+    Return every record of an entity as it was at `at`.
+    The valid_from filter is pushed down into the parquet scan, and as the history is sorted by valid_from
+    the row group statistics skip every row group loaded after `at` without reading it.
+    """
+    at = _as_datetime(at)
+    history = pl.scan_parquet(history_file_path(config, entity))
+    return profiling.collect(
+        history.filter((pl.col(VALID_FROM) <= at) & (pl.col(VALID_TO).is_null() | (pl.col(VALID_TO) > at))),
+        f'as_of.{entity}'
+    )
+
+
+def as_of_join(config: Dict[str, Any], entity: str, df: pl.DataFrame, left_on: str, by: str,
+               unique_id: str = 'id', suffix: str = '_as_of') -> pl.DataFrame:
+    """
+    Attach to each row of `df` the version of the `entity` record it references (`by`) that was valid at the
+    row's `left_on` time, using a sorted as-of join rather than a filter per row.
+    Only the versions of the referenced records loaded before the latest row's time are read from the history.
+    """
+    history = pl.scan_parquet(history_file_path(config, entity))
+    as_of_time = pl.col(left_on).cast(pl.Datetime('us'))
+    if df.schema[left_on] == pl.Date:
+        as_of_time = as_of_time + pl.duration(days=1) - pl.duration(microseconds=1)
+    left = df.with_columns(as_of_time.alias('_as_of_time')).sort('_as_of_time')
+    latest = left['_as_of_time'].max()
+    referenced = left[by].drop_nulls().unique()
+    right = history.filter(pl.col(unique_id).is_in(referenced.implode()))
+    if latest is not None:
+        right = right.filter(pl.col(VALID_FROM) <= latest)
+    right = profiling.collect(right.rename({unique_id: by}).sort(VALID_FROM), f'as_of_join.{entity}')
+    return left.join_asof(
+        right, left_on='_as_of_time', right_on=VALID_FROM, by=by, strategy='backward', suffix=suffix,
+        check_sortedness=False  # both sides were just sorted, polars cannot verify that per `by` group
+    ).drop('_as_of_time')
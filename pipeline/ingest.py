@@ -5,8 +5,16 @@ import logging
 import requests
 import sys
 import yaml
-from typing import Dict, Any
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
 import config.exit_codes as ec
+from pipeline.instrumentation import span, record, set_attributes, file_size
+
+class BackfillAborted(Exception):
+    '''A transactions backfill shard that cannot be fetched, the backfill falls back to a single request'''
+
 
 class Ingest:
 
@@ -25,6 +33,11 @@ class Ingest:
         self.knowledge_cache = self.load_knowledge_cache()
         self.MAX_RETRIES = config['REQUESTS_MAX_RETRIES']
         self.RETRY_DELAY = config['REQUESTS_RETRY_DELAY']
+        self.backfill = config.get('transactions_backfill', False)
+        self.backfill_workers = config.get('transactions_backfill_workers', 4)
+        # requests the backfill shards may still make in the rate limit window, None outside a backfill
+        self.shard_requests_left: Optional[int] = None
+        self.rate_limit_lock = threading.Lock()
         self.fetch_and_cache_entity_data()
 
     def load_knowledge_cache(self) -> Dict[str, Any]:
@@ -36,19 +49,24 @@ class Ingest:
                 return json.load(f)
         return {}
 
-    def save_entity_data_to_raw(self, entity: str, data: Dict[str, Any]):
+    def save_entity_data_to_raw(self, entity: str, data: Dict[str, Any], file_stem: Optional[str] = None):
         """
-        Save the data for a specific entity to a new cache file.
+        Save the data for a specific entity to a new cache file, named after the current time unless
+        a file_stem is given.
         """
-        current_time = time.strftime('%Y%m%d%H%M%S')
+        file_stem = file_stem or time.strftime('%Y%m%d%H%M%S')
         directory = os.path.join(self.raw_data_path, entity)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        entity_file = f'{directory}/{current_time}.json'
+        os.makedirs(directory, exist_ok=True)
+        entity_file = f'{directory}/{file_stem}.json'
         logging.info(f"Saving {entity} data to {entity_file}")
         try:
             with open(entity_file, 'w') as f:
                 json.dump(data, f, indent=4)
+            if entity == 'categories':
+                rows = sum(len(group.get('categories', [])) for group in data.get('category_groups', []))
+            else:
+                rows = len(data.get(entity, []))
+            record(rows_out=rows, bytes_written=file_size(entity_file))
         except Exception as e:
             logging.error(f"Error saving {entity} data: {e}")
 
@@ -70,6 +88,16 @@ class Ingest:
         with open(self.knowledge_file, 'w') as f:
             json.dump(knowledge_cache, f, indent=4)
 
+    def remaining_requests(self, response: requests.Response) -> Optional[int]:
+        """
+        The number of requests left in the rate limit window, or None if the response does not say.
+        """
+        rate_limit_header = response.headers.get('X-Rate-Limit')
+        if not rate_limit_header:
+            return None
+        requests_made, limit = map(int, rate_limit_header.split('/'))
+        return limit - requests_made
+
     def check_rate_limit(self, response: requests.Response):
         """
         Check and handle the rate limit based on the response headers.
@@ -79,6 +107,7 @@ class Ingest:
             requests_made, limit = map(int, rate_limit_header.split('/'))
             remaining_requests = limit - requests_made
             logging.info(f"Rate Limit: {remaining_requests}/{limit} requests remaining.")
+            set_attributes(rate_limit_remaining=remaining_requests, rate_limit=limit)
             if remaining_requests < 20:
                 logging.warning("Approaching rate limit. Consider pausing further requests.")
                 # Implement pause or delay logic here if necessary
@@ -118,46 +147,181 @@ class Ingest:
             response.raise_for_status()
             return False
 
+    def retry_delay(self, response: Optional[requests.Response], attempt: int) -> float:
+        """
+        How long to wait before retrying: the Retry-After header when the API sends one, otherwise
+        REQUESTS_RETRY_DELAY doubled on every attempt.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.RETRY_DELAY * 2 ** attempt
+
+    def take_shard_request(self):
+        """
+        Count a backfill shard request against the rate limit left for the shards. The backfill is aborted
+        before it eats into the requests kept for the entities after transactions.
+        """
+        with self.rate_limit_lock:
+            if self.shard_requests_left is None:
+                return
+            if self.shard_requests_left <= 0:
+                raise BackfillAborted("The rate limit left for the backfill shards is spent")
+            self.shard_requests_left -= 1
+
+    def update_shard_requests(self, response: requests.Response):
+        """
+        Lower the requests left for the shards to what the API says is left, the shards running at the
+        same time all count against the same window.
+        """
+        remaining = self.remaining_requests(response)
+        with self.rate_limit_lock:
+            if self.shard_requests_left is not None and remaining is not None:
+                self.shard_requests_left = min(self.shard_requests_left, remaining - len(self.entities))
+
+    def get_with_retries(self, url: str, entity: str, shard: bool = False) -> requests.Response:
+        """
+        GET a url, retrying failed requests up to REQUESTS_MAX_RETRIES times with a growing delay.
+        Exits when every attempt failed. A backfill shard raises BackfillAborted on a 404 instead of exiting,
+        and counts its requests against the rate limit left for the shards.
+        """
+        response = None
+        for attempt in range(self.MAX_RETRIES):
+            if shard:
+                self.take_shard_request()
+            try:
+                with span('http_get', entity=entity, attempt=attempt + 1) as request_span:
+                    response = requests.get(url, headers=self.headers)
+                    request_span.set(status_code=response.status_code)
+                    request_span.record(bytes_read=len(response.content))
+                if shard:
+                    self.update_shard_requests(response)
+                    if response.status_code == 404:
+                        raise BackfillAborted(f"{url} was not found")
+                if not self.handle_response(response):
+                    return response
+                logging.warning(f"Fetching {entity} data failed with status {response.status_code} (attempt {attempt + 1}/{self.MAX_RETRIES})")
+            except requests.exceptions.RequestException as e:
+                response = None
+                logging.error(f"Error fetching {entity} data (attempt {attempt + 1}/{self.MAX_RETRIES}): {e}")
+            if attempt < self.MAX_RETRIES - 1:
+                time.sleep(self.retry_delay(response, attempt))  # Wait before retrying
+        logging.error("Max retries reached. Exiting.")
+        sys.exit(ec.REQUESTS_ERROR)
+
+    def fetch_transactions_shard(self, account_id: str, file_stem: str) -> Optional[int]:
+        """
+        Fetch every transaction of one account and land them as one raw chunk. Returns the server_knowledge
+        the shard was read at.
+        """
+        with span('backfill_shard', entity='transactions', account_id=account_id):
+            url = f'{self.base_url}/{self.budget_id}/accounts/{account_id}/transactions?last_knowledge_of_server=0'
+            response = self.get_with_retries(url, 'transactions', shard=True)
+            shard_data = response.json()['data']
+            server_knowledge = shard_data.pop('server_knowledge', None)
+            if shard_data.get('transactions'):
+                self.save_entity_data_to_raw('transactions', shard_data, file_stem)
+            self.check_rate_limit(response)
+            return server_knowledge
+
+    def remove_backfill_shards(self, load_time: str):
+        """
+        Remove the shards of a backfill that did not finish, a partial backfill must never be merged.
+        """
+        directory = os.path.join(self.raw_data_path, 'transactions')
+        for file_name in os.listdir(directory) if os.path.exists(directory) else []:
+            if file_name.startswith(f'{load_time}.'):
+                os.remove(os.path.join(directory, file_name))
+
+    def backfill_transactions(self) -> bool:
+        """
+        Fetch the first transactions sync per account rather than as one response, `transactions_backfill_workers`
+        accounts at a time. Each shard is retried on its own and landed as a `<load time>.<shard>.json` chunk,
+        which RawToBase merges as one load. The knowledge cache gets the lowest server_knowledge of the shards,
+        so anything changed while the shards were fetched is picked up again by the next delta sync.
+        Returns False, having fetched nothing, when there are no accounts, when the shards would run into the
+        rate limit or when an account is not found, so the caller falls back to a single request.
+        """
+        accounts_response = self.get_with_retries(f'{self.base_url}/{self.budget_id}/accounts', 'accounts')
+        accounts = accounts_response.json()['data'].get('accounts', [])
+        # YNAB only deletes accounts without transactions, closed accounts keep theirs and are still fetched
+        account_ids = [account['id'] for account in accounts if not account.get('deleted')]
+        remaining_requests = self.remaining_requests(accounts_response)
+        if not account_ids:
+            logging.info("No accounts to shard the transactions backfill by, fetching it in one request")
+            return False
+        # leave room for the entities still to come after transactions
+        if remaining_requests is not None and remaining_requests < len(account_ids) + len(self.entities):
+            logging.warning(f"Only {remaining_requests} requests left in the rate limit, fetching the transactions backfill in one request")
+            return False
+
+        load_time = time.strftime('%Y%m%d%H%M%S')
+        logging.info(f"Backfilling transactions in {len(account_ids)} shards by account, {self.backfill_workers} at a time")
+        if remaining_requests is not None:
+            self.shard_requests_left = remaining_requests - len(self.entities)
+        pool = ThreadPoolExecutor(max_workers=self.backfill_workers)
+        try:
+            # every shard runs in its own copy of the context, so its spans nest under this entity
+            futures = [
+                pool.submit(contextvars.copy_context().run, self.fetch_transactions_shard, account_id, f'{load_time}.{shard:04d}')
+                for shard, account_id in enumerate(account_ids)
+            ]
+            shard_knowledge = [future.result() for future in futures]
+        except BackfillAborted as e:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.remove_backfill_shards(load_time)
+            logging.warning(f"The transactions backfill stopped, fetching it in one request instead: {e}")
+            return False
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.remove_backfill_shards(load_time)
+            logging.error("The transactions backfill failed, removed the shards fetched so far")
+            raise
+        finally:
+            self.shard_requests_left = None
+        pool.shutdown()
+
+        known = [knowledge for knowledge in shard_knowledge if knowledge is not None]
+        server_knowledge = min(known) if known else None
+        set_attributes(last_knowledge=0, server_knowledge=server_knowledge, shards=len(account_ids))
+        if server_knowledge is not None:
+            self.update_server_knowledge_cache('transactions', server_knowledge)
+        logging.info(f"Backfilled transactions in {len(account_ids)} shards at server knowledge {server_knowledge}")
+        return True
+
     def fetch_and_cache_entity_data(self):
         """
         Fetch and cache data for all entities.
         """
         for entity in self.entities:
-            file_path = f'data/raw/{entity}'
+            file_path = os.path.join(self.raw_data_path, entity)
             if os.path.exists(file_path) and os.listdir(file_path):
                 logging.warning(f"Raw data exists for {entity} processing any raw data we already have.")
                 break # break here instead of continue as we dont want to update our server knowledge cache and potentially miss data.
 
-            last_knowledge = self.knowledge_cache.get(entity, 0)
-            #logging.debug(f'Last Knowledge of {entity}: {last_knowledge}')
-            logging.info(f'Fetching {entity} data since last knowledge: {last_knowledge}')
-            url = f'{self.base_url}/{self.budget_id}/{entity}?last_knowledge_of_server={last_knowledge}'
+            with span('ingest_entity', entity=entity):
+                last_knowledge = self.knowledge_cache.get(entity, 0)
+                #logging.debug(f'Last Knowledge of {entity}: {last_knowledge}')
+                logging.info(f'Fetching {entity} data since last knowledge: {last_knowledge}')
+                if entity == 'transactions' and last_knowledge == 0 and self.backfill:
+                    if self.backfill_transactions():
+                        continue
 
-            for attempt in range(self.MAX_RETRIES):
-                try:
-                    response = requests.get(url, headers=self.headers)
-                    should_retry = self.handle_response(response)
-                    if not should_retry:
-                        break  # Exit the loop if the request is successful
-                except requests.exceptions.RequestException as e:
-                    logging.error(f"Error fetching {entity} data (attempt {attempt + 1}/{self.MAX_RETRIES}): {e}")
-                    if attempt < self.MAX_RETRIES - 1:
-                        time.sleep(self.RETRY_DELAY)  # Wait before retrying
-                    else:
-                        logging.error("Max retries reached. Exiting.")
-                        sys.exit(ec.REQUESTS_ERROR)
+                url = f'{self.base_url}/{self.budget_id}/{entity}?last_knowledge_of_server={last_knowledge}'
+                response = self.get_with_retries(url, entity)
             
-            data = response.json()
-            server_knowledge = data['data'].get('server_knowledge')
-            logging.debug(f'{entity} new server knowledge: {server_knowledge}')
+                data = response.json()
+                server_knowledge = data['data'].get('server_knowledge')
+                logging.debug(f'{entity} new server knowledge: {server_knowledge}')
+                set_attributes(last_knowledge=last_knowledge, server_knowledge=server_knowledge)
             
-            if server_knowledge is not None and server_knowledge != last_knowledge:
-                self.update_server_knowledge_cache(entity, server_knowledge)
-                entity_data = data['data']
-                entity_data.pop('server_knowledge', None)
-                self.save_entity_data_to_raw(entity, entity_data)
-            else:
-                logging.info(f"No new data for {entity}. Skipping cache update.")
+                if server_knowledge is not None and server_knowledge != last_knowledge:
+                    self.update_server_knowledge_cache(entity, server_knowledge)
+                    entity_data = data['data']
+                    entity_data.pop('server_knowledge', None)
+                    self.save_entity_data_to_raw(entity, entity_data)
+                else:
+                    logging.info(f"No new data for {entity}. Skipping cache update.")
             
-            if self.check_rate_limit(response):
-                break # break out here and continue processing the data we have.
+                if self.check_rate_limit(response):
+                    break # break out here and continue processing the data we have.
@@ -0,0 +1,203 @@
+'''Module to trace pipeline stages and HTTP calls as structured spans in the JSON logs'''
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+
+_active_span = contextvars.ContextVar('active_span', default=None)
+_finished_spans = []
+_spans_lock = threading.Lock()
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None if it cannot be measured.
+    """
+    # VmHWM belongs to this process alone, ru_maxrss is inherited from the parent by a forked or spawned child
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def file_size(path: str) -> int:
+    """
+    Return the size of a file in bytes, or 0 if it does not exist.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional['Span'] = None, **attributes):
+        """
+        A single timed unit of work, such as a pipeline stage or an HTTP request.
+        Attributes are descriptive labels, counters are numbers summed over the span.
+        """
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.counters: Dict[str, float] = {}
+        self.status = 'ok'
+        self.duration_s = None
+        self.cpu_s = None
+        self.process_peak_rss_bytes = None
+        self.peak_rss_growth_bytes = None
+        self._start_peak_rss = peak_rss_bytes()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self.started_at = time.time()
+
+    def record(self, **counters):
+        """
+        Add to the numeric counters of this span, e.g. rows_in, rows_out, bytes_read, bytes_written.
+        """
+        for key, value in counters.items():
+            if value is None:
+                continue
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, **attributes):
+        """
+        Set descriptive attributes on this span, overwriting any previous value.
+        """
+        self.attributes.update(attributes)
+
+    def finish(self, status: str = 'ok'):
+        self.duration_s = time.perf_counter() - self._start_wall
+        self.cpu_s = time.process_time() - self._start_cpu
+        # ru_maxrss is the high-water mark of the whole process, the growth is how far this span raised it
+        self.process_peak_rss_bytes = peak_rss_bytes()
+        if self.process_peak_rss_bytes is not None and self._start_peak_rss is not None:
+            self.peak_rss_growth_bytes = self.process_peak_rss_bytes - self._start_peak_rss
+        self.status = status
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'parent': self.parent.name if self.parent is not None else None,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration_s': self.duration_s,
+            'cpu_s': self.cpu_s,
+            'process_peak_rss_bytes': self.process_peak_rss_bytes,
+            'peak_rss_growth_bytes': self.peak_rss_growth_bytes,
+            **self.attributes,
+            **self.counters,
+        }
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time the wrapped block and log it as a structured span when it finishes.
+    Nested spans record their parent, so HTTP calls can be attributed to the stage that made them.
+    """
+    current = Span(name, parent=_active_span.get(), **attributes)
+    token = _active_span.set(current)
+    status = 'ok'
+    try:
+        yield current
+    except BaseException as e:
+        # SystemExit(0) is how the pipeline signals a clean early stop
+        if not (isinstance(e, SystemExit) and e.code in (0, None)):
+            status = 'error'
+        raise
+    finally:
+        _active_span.reset(token)
+        current.finish(status)
+        with _spans_lock:
+            _finished_spans.append(current)
+        logging.info(
+            f"Span {name} finished in {current.duration_s:.3f}s with status {status}",
+            extra={'span': current.to_dict()}
+        )
+
+
+def record(**counters):
+    """
+    Add counters to the innermost active span. Does nothing when called outside a span.
+    """
+    current = _active_span.get()
+    if current is not None:
+        current.record(**counters)
+
+
+def set_attributes(**attributes):
+    """
+    Set attributes on the innermost active span. Does nothing when called outside a span.
+    """
+    current = _active_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def finished_spans() -> list:
+    with _spans_lock:
+        return list(_finished_spans)
+
+
+def reset():
+    """
+    Forget all finished spans, so a new run starts with an empty summary.
+    """
+    with _spans_lock:
+        _finished_spans.clear()
+
+
+def run_summary() -> Dict[str, Any]:
+    """
+    Summarise every finished span of this run, with per-stage totals for the top level spans.
+    """
+    spans = finished_spans()
+    stages = [s for s in spans if s.parent is None]
+    return {
+        'started_at': min((s.started_at for s in spans), default=None),
+        'total_duration_s': sum(s.duration_s for s in stages),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'status': 'error' if any(s.status == 'error' for s in stages) else 'ok',
+        'stages': [s.to_dict() for s in stages],
+        'spans': [s.to_dict() for s in spans],
+    }
+
+
+def write_run_summary(path: str) -> Dict[str, Any]:
+    """
+    Log the run summary and write it as JSON to the given path.
+    """
+    summary = run_summary()
+    logging.info(
+        f"Run summary: {len(summary['stages'])} stages in {summary['total_duration_s']:.3f}s",
+        extra={'run_summary': summary}
+    )
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=4, default=str)
+    except Exception as e:
+        logging.error(f"Failed to write run summary to {path}: {e}")
+    return summary
@@ -0,0 +1,217 @@
+'''Module to export pipeline metrics as a Prometheus textfile after each run'''
+
+import os
+import json
+import time
+import logging
+from typing import Dict, Any, Optional
+
+
+class PipelineMetrics:
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Build metrics from the run summary written by the instrumentation spans.
+        Histograms and counters are kept in a small JSON state file so they accumulate across runs,
+        which is what a node-exporter textfile collector expects to scrape.
+        """
+        self.config = config
+        self.textfile = config['metrics_textfile']
+        self.state_file = config['metrics_state_file']
+        self.duration_buckets = sorted(float(b) for b in config['metrics_duration_buckets'])
+        self.state = self.load_state()
+        self.families = {}
+
+    def load_state(self) -> Dict[str, Any]:
+        """
+        Load the histogram and counter state from previous runs if it exists.
+        """
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logging.warning(f"Could not read metrics state file {self.state_file}, starting fresh: {e}")
+        return {'histograms': {}, 'counters': {}, 'help': {}}
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f, indent=4)
+
+    def add_gauge(self, name: str, help_text: str, value: Optional[float], **labels):
+        if value is None:
+            return
+        family = self.families.setdefault(name, {'type': 'gauge', 'help': help_text, 'samples': []})
+        family['samples'].append((name, labels, value))
+
+    def inc_counter(self, name: str, help_text: str, value: float, **labels):
+        """
+        Increase a counter that is persisted across runs. The name must end in _total.
+        """
+        series = self.state['counters'].setdefault(name, {})
+        key = _labels_key(labels)
+        series[key] = series.get(key, 0) + value
+        self.state['help'][name] = help_text
+
+    def observe(self, name: str, help_text: str, value: float, **labels):
+        """
+        Add an observation to a histogram that is persisted across runs.
+        A series is reset if the configured buckets have changed since it was written.
+        """
+        series = self.state['histograms'].setdefault(name, {})
+        key = _labels_key(labels)
+        histogram = series.get(key)
+        if histogram is None or histogram['le'] != self.duration_buckets:
+            histogram = {'le': self.duration_buckets, 'buckets': [0] * len(self.duration_buckets), 'sum': 0.0, 'count': 0}
+            series[key] = histogram
+        for i, upper_bound in enumerate(histogram['le']):
+            if value <= upper_bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+        self.state['help'][name] = help_text
+
+    def collect(self, summary: Dict[str, Any], exit_code: int):
+        """
+        Turn the run summary into metric families.
+        """
+        for stage in summary['stages']:
+            self.observe('dpfy_stage_duration_seconds', 'Duration of each pipeline stage.',
+                         stage['duration_s'], stage=stage['name'])
+            self.add_gauge('dpfy_last_run_stage_duration_seconds', 'Duration of each pipeline stage in the last run.',
+                           stage['duration_s'], stage=stage['name'])
+
+        rate_limit_remaining = None
+        rate_limit = None
+        for span in summary['spans']:
+            if span['name'] == 'ingest_entity':
+                entity = span['entity']
+                server_knowledge = span.get('server_knowledge')
+                last_knowledge = span.get('last_knowledge')
+                self.add_gauge('dpfy_server_knowledge', 'Latest server_knowledge returned by YNAB.',
+                               server_knowledge, entity=entity)
+                if server_knowledge is not None and last_knowledge is not None:
+                    self.add_gauge('dpfy_server_knowledge_lag', 'Change in server_knowledge since the previous sync.',
+                                   server_knowledge - last_knowledge, entity=entity)
+                if span.get('rate_limit_remaining') is not None:
+                    rate_limit_remaining = span['rate_limit_remaining']
+                    rate_limit = span['rate_limit']
+            elif span['name'] == 'raw_to_base_entity':
+                rows = span.get('rows_in', 0)
+                self.add_gauge('dpfy_rows_merged_last_run', 'Rows merged into the base table in the last run.',
+                               rows, entity=span['entity'])
+                self.inc_counter('dpfy_rows_merged_total', 'Rows merged into the base table across all runs.',
+                                 rows, entity=span['entity'])
+
+            elif span['name'] == 'compact_entity':
+                self.inc_counter('dpfy_tombstones_dropped_total', 'Expired tombstones dropped from the base tables.',
+                                 span.get('tombstones_dropped', 0), entity=span['entity'])
+            elif span['name'] == 'data_quality_table':
+                for rule, count in (span.get('rule_counts') or {}).items():
+                    self.add_gauge('dpfy_data_quality_violations', 'Rows failing each data quality rule in the last run.',
+                                   count, table=span['table'], rule=rule)
+                self.add_gauge('dpfy_data_quality_quarantined_rows', 'Rows written to quarantine in the last run.',
+                               span.get('rows_quarantined', 0), table=span['table'])
+
+        self.add_gauge('dpfy_rate_limit_remaining', 'Requests remaining in the YNAB rate limit window.', rate_limit_remaining)
+        self.add_gauge('dpfy_rate_limit', 'Size of the YNAB rate limit window.', rate_limit)
+
+        for layer, path_key in [('raw', 'raw_data_path'), ('processed', 'processed_data_path'),
+                                ('base', 'base_data_path'), ('warehouse', 'warehouse_data_path')]:
+            self.add_gauge('dpfy_data_size_bytes', 'Size on disk of each data layer.',
+                           _directory_size(self.config[path_key]), layer=layer)
+
+        self.add_gauge('dpfy_last_run_exit_code', 'Exit code of the last run, 0 is success.', exit_code)
+        self.add_gauge('dpfy_last_run_duration_seconds', 'Total duration of the last run.', summary['total_duration_s'])
+        self.add_gauge('dpfy_last_run_peak_rss_bytes', 'Peak resident memory of the last run.', summary['peak_rss_bytes'])
+        self.add_gauge('dpfy_last_run_timestamp_seconds', 'Unix time the last run finished.', time.time())
+        self.inc_counter('dpfy_runs_total', 'Pipeline runs by outcome.', 1,
+                         status='success' if exit_code == 0 else 'failure')
+
+    def render(self) -> str:
+        # counters and histograms from earlier runs are rendered even if this run did not touch them
+        families = dict(self.families)
+        for name in self.state['counters']:
+            # Prometheus text format 0.0.4 names the counter by its samples, _total suffix included
+            families[name] = {'type': 'counter', 'help': self.state['help'].get(name, ''), 'samples': []}
+        for name in self.state['histograms']:
+            families[name] = {'type': 'histogram', 'help': self.state['help'].get(name, ''), 'samples': []}
+
+        lines = []
+        for name in sorted(families):
+            family = families[name]
+            family_type = family['type']
+            lines.append(f'# HELP {name} {family["help"]}')
+            lines.append(f'# TYPE {name} {family_type}')
+            if family_type == 'gauge':
+                for sample_name, labels, value in family['samples']:
+                    lines.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+            elif family_type == 'counter':
+                for key, value in sorted(self.state['counters'][name].items()):
+                    lines.append(f'{name}{_format_labels(_parse_labels_key(key))} {_format_value(value)}')
+            elif family_type == 'histogram':
+                for key, histogram in sorted(self.state['histograms'][name].items()):
+                    labels = _parse_labels_key(key)
+                    for upper_bound, count in zip(histogram['le'], histogram['buckets']):
+                        lines.append(f'{name}_bucket{_format_labels({**labels, "le": _format_value(upper_bound)})} {count}')
+                    lines.append(f'{name}_bucket{_format_labels({**labels, "le": "+Inf"})} {histogram["count"]}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram["sum"])}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Write the textfile atomically, so a collector never scrapes a half written file.
+        """
+        os.makedirs(os.path.dirname(self.textfile) or '.', exist_ok=True)
+        tmp_file = f'{self.textfile}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_file, self.textfile)
+        self.save_state()
+        logging.info(f"Wrote pipeline metrics to {self.textfile}")
+
+
+def write_metrics(config: Dict[str, Any], summary: Dict[str, Any], exit_code: int):
+    '''Write the metrics textfile for a finished run, never failing the run because of it'''
+    try:
+        metrics = PipelineMetrics(config)
+        metrics.collect(summary, exit_code)
+        metrics.write()
+    except Exception as e:
+        logging.error(f"Failed to write pipeline metrics: {e}")
+
+
+def _directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                continue
+    return total
+
+
+def _labels_key(labels: Dict[str, Any]) -> str:
+    return json.dumps({k: str(v) for k, v in labels.items()}, sort_keys=True)
+
+
+def _parse_labels_key(key: str) -> Dict[str, str]:
+    return json.loads(key)
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
@@ -1,24 +1,79 @@
 '''Module to run the data pipeline'''
 
+import os
+import sys
 import logging
+from contextlib import contextmanager
 
+import config.exit_codes as ec
+from pipeline import instrumentation, profiling
+from pipeline.instrumentation import span
+from pipeline.metrics import write_metrics
 from pipeline.ingest import Ingest
 from pipeline.raw_to_base import RawToBase
-from pipeline.dimensions import DimAccounts, DimCategories, DimPayees, DimDate
-from pipeline.facts import FactTransactions, FactScheduledTransactions
+from pipeline.compaction import CompactBase
+from pipeline.table_specs import TableSpecs
+from pipeline.dimensions import DimDate
+from pipeline.facts import (
+    FactSubtransactions, FactMonthlyCategoryBudget, FactAccountBalances, FactCashFlowForecast,
+    FactProjectedBalances
+)
+from pipeline.data_quality import DataQuality
+from pipeline.sqlite_export import SqliteExport
+
+
+@contextmanager
+def stage(name):
+    '''Trace a stage, and profile it when profiling is switched on'''
+    with span(name), profiling.stage(name):
+        yield
 
 
 def pipeline_main(config):
     '''Run the data pipeline'''
     logging.info('Starting data pipeline')
+    instrumentation.reset()
+    exit_code = ec.SUCCESS
+
+    try:
+        with stage('Ingest'):
+            Ingest(config)
+        with stage('RawToBase'):
+            RawToBase(config)
+        with stage('CompactBase'):
+            CompactBase(config)
+        with stage('TableSpecs'):
+            TableSpecs(config)
+        with stage('DimDate'):
+            DimDate(config)
+        with stage('FactSubtransactions'):
+            FactSubtransactions(config)
+        with stage('FactMonthlyCategoryBudget'):
+            FactMonthlyCategoryBudget(config)
+        with stage('FactAccountBalances'):
+            FactAccountBalances(config)
+        with stage('FactCashFlowForecast'):
+            FactCashFlowForecast(config)
+        with stage('FactProjectedBalances'):
+            FactProjectedBalances(config)
+        with stage('DataQuality'):
+            DataQuality(config)
+        with stage('SqliteExport'):
+            SqliteExport(config)
 
-    Ingest(config)
-    RawToBase(config)
-    DimAccounts(config)
-    DimCategories(config)
-    DimPayees(config)
-    DimDate(config)
-    FactTransactions(config)
-    FactScheduledTransactions(config)
+        # the exit code is settled before the metrics are written, a run that processed nothing is a failure
+        processed_data_path = config['processed_data_path']
+        if not (os.path.exists(processed_data_path) and os.listdir(processed_data_path)):
+            logging.error('Data pipeline did not produce any data. Dash app will not run.')
+            sys.exit(ec.NO_DATA_PRODUCED)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else ec.SUCCESS if e.code is None else ec.UNHANDLED_EXCEPTION
+        raise
+    except Exception:
+        exit_code = ec.UNHANDLED_EXCEPTION
+        raise
+    finally:
+        summary = instrumentation.write_run_summary(config['run_summary_file'])
+        write_metrics(config, summary, exit_code)
 
     logging.info('Data pipeline completed successfully')
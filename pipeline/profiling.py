@@ -0,0 +1,191 @@
+'''Module to profile pipeline stages on demand, writing flamegraph friendly reports to the logs folder'''
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Optional, List
+
+import polars as pl
+
+PROFILE_MODES = ['cprofile', 'sampling']
+
+_settings = {
+    'mode': None,
+    'stages': None,
+    'polars_plans': False,
+    'output_dir': 'logs',
+    'interval': 0.005,
+    'run_id': None,
+    'warned_no_profile': False,
+}
+
+
+def configure(
+    mode: Optional[str] = None,
+    stages: Optional[List[str]] = None,
+    polars_plans: bool = False,
+    output_dir: str = 'logs',
+    interval: float = 0.005,
+):
+    """
+    Turn profiling on for this process. With no mode and polars_plans off, profiling stays disabled
+    and `stage`/`collect` cost nothing beyond a dictionary lookup.
+    """
+    if mode is not None and mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+    _settings.update(
+        mode=mode,
+        stages=set(stages) if stages else None,
+        polars_plans=polars_plans,
+        output_dir=output_dir,
+        interval=interval,
+        run_id=time.strftime('%Y%m%d%H%M%S'),
+    )
+    if mode is not None or polars_plans:
+        os.makedirs(output_dir, exist_ok=True)
+
+
+def _report_path(name: str, suffix: str) -> str:
+    return os.path.join(_settings['output_dir'], f"profile_{_settings['run_id']}_{name}.{suffix}")
+
+
+def stage(name: str):
+    """
+    Profile the wrapped stage if profiling is on and the stage was selected, otherwise do nothing.
+    """
+    mode = _settings['mode']
+    if mode is None or (_settings['stages'] is not None and name not in _settings['stages']):
+        return nullcontext()
+    if mode == 'cprofile':
+        return _cprofile_stage(name)
+    return _sampling_stage(name)
+
+
+@contextmanager
+def _cprofile_stage(name: str):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stats_path = _report_path(name, 'prof')
+        profiler.dump_stats(stats_path)
+        summary_path = _report_path(name, 'txt')
+        with open(summary_path, 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(40)
+        logging.info(f"Wrote cProfile report for {name} to {stats_path} (open with snakeviz or flameprof)")
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float):
+        """
+        A pure Python sampling profiler. A background thread snapshots the stack of every other thread
+        at a fixed interval and counts identical stacks, which is the collapsed format flamegraph.pl,
+        speedscope and inferno read. Time spent inside polars shows up on the Python line that called it.
+        """
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling_profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def write_folded(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def _sampling_stage(name: str):
+    profiler = SamplingProfiler(_settings['interval'])
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        folded_path = _report_path(name, 'folded')
+        profiler.write_folded(folded_path)
+        logging.info(f"Wrote {sum(profiler.samples.values())} stack samples for {name} to {folded_path} (collapsed stack format)")
+
+
+def _warn_no_node_timings():
+    if _settings['warned_no_profile']:
+        return
+    _settings['warned_no_profile'] = True
+    logging.warning(f"polars {pl.__version__} has no LazyFrame.profile(), the polars plan reports only hold "
+                    "the optimised plan and total time, not per node timings")
+
+
+def collect(lazy_frame: pl.LazyFrame, name: str) -> pl.DataFrame:
+    """
+    Collect a lazy plan, dumping its optimised plan and per node timings from `LazyFrame.profile()`
+    when polars plan profiling is on. Polars versions without `profile()` get the plan and total time only.
+    """
+    if not _settings['polars_plans']:
+        return lazy_frame.collect()
+    path = _report_path(f'{name}_polars', 'txt')
+    profile = getattr(lazy_frame, 'profile', None)
+    if profile is None:
+        _warn_no_node_timings()
+    start = time.perf_counter()
+    if profile is not None:
+        result, timings = profile()
+    else:
+        result, timings = lazy_frame.collect(), None
+    elapsed = time.perf_counter() - start
+    with open(path, 'w') as f:
+        f.write(lazy_frame.explain())
+        f.write(f'\n\ncollected {result.height} rows in {elapsed:.3f}s\n')
+        if timings is not None:
+            with pl.Config(tbl_rows=-1, tbl_width_chars=200, fmt_str_lengths=200):
+                f.write(str(timings))
+    logging.info(f"Wrote polars plan profile for {name} to {path}")
+    return result
+
+
+def collect_all(lazy_frames: List[pl.LazyFrame], name: str) -> List[pl.DataFrame]:
+    """
+    Collect several lazy plans together with `pl.collect_all`, dumping every optimised plan and the
+    total time when polars plan profiling is on. Per node timings are not available for a combined run.
+    """
+    if not _settings['polars_plans']:
+        return pl.collect_all(lazy_frames)
+    path = _report_path(f'{name}_polars', 'txt')
+    start = time.perf_counter()
+    results = pl.collect_all(lazy_frames)
+    elapsed = time.perf_counter() - start
+    with open(path, 'w') as f:
+        for i, (lazy_frame, result) in enumerate(zip(lazy_frames, results)):
+            f.write(f'plan {i}, {result.height} rows\n{lazy_frame.explain()}\n\n')
+        f.write(f'collected {len(results)} plans in {elapsed:.3f}s\n')
+    logging.info(f"Wrote polars plan profile for {name} to {path}")
+    return results
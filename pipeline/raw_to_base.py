@@ -2,10 +2,21 @@ import os
 import json
 import logging
 import sys
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
 import config.exit_codes as ec
 import polars as pl
+from pipeline.instrumentation import span, record, file_size
+from pipeline.history import history_enabled, update_history
+
+# peak memory of merging an entity per byte on disk, parsed JSON records and decoded parquet columns.
+# Measured as the VmHWM growth of merging transactions alone on the small and medium benchmark fixtures:
+# a first sync grows by 4.9 bytes per raw JSON byte, an incremental one by about 57 bytes per base parquet
+# byte on top of its raw JSON, as the zstd compressed parquet is decoded, cast and updated
+RAW_JSON_MEMORY_FACTOR = 5
+BASE_PARQUET_MEMORY_FACTOR = 60
 
 class RawToBase:
     def __init__(self, config: Dict[str, Any]):
@@ -14,49 +25,116 @@ class RawToBase:
         self.raw_data_path = config['raw_data_path']
         self.processed_data_path = config['processed_data_path']
         self.base_data_path = config['base_data_path']
+        self.config = config
+        self.workers = max(1, config.get('raw_to_base_workers', 1))
+        self.memory_budget = config.get('raw_to_base_memory_budget_mb', 1024) * 1024 * 1024
         self.data = {}
         self.base_data = {}
+        self.new_data = {}
+        self.previous_base_data = {}
+        self.load_times = {}
         self.process_entities()
 
+    def estimate_memory(self, entity: str) -> int:
+        """
+        Estimate the peak memory merging an entity takes, from the size of its raw files and base table.
+        """
+        raw_path = os.path.join(self.raw_data_path, entity)
+        raw_bytes = sum(file_size(os.path.join(raw_path, f)) for f in os.listdir(raw_path)) if os.path.isdir(raw_path) else 0
+        base_bytes = file_size(os.path.join(self.base_data_path, f'{entity}.parquet'))
+        return raw_bytes * RAW_JSON_MEMORY_FACTOR + base_bytes * BASE_PARQUET_MEMORY_FACTOR
+
     def process_entities(self):
-        for entity in self.entities:
-            logging.info(f"Processing entity: {entity}")
-            # check the file is in the raw data path, if not skip the entity
-            folder_path = os.path.join(self.raw_data_path, entity)
-            folder_contents = os.listdir(folder_path)
-            if not folder_contents:
-                logging.warning(f"The folder {folder_path} is empty skipping {entity}.")
-                continue
-            if not self._load_raw_data(entity):
-                logging.warning(f"Skipping processing for entity: {entity} due to empty data.")
-                continue
-            self._load_existing_base_data(entity)
-            self._combine_data(entity)
-            if not self._save_base_data(entity):
-                logging.error(f"Skipping processing for entity: {entity} due to failed saving base data.")
-                continue
-            if not self._move_raw_to_processed(entity):
-                logging.error(f"entity: {entity} has been processed, but we could not move the file out of the raw folder, please clear the raw folder for {entity}.")
-                sys.exit(ec.MOVE_FILE_ERROR)
-            logging.info(f"Successfully processed entity: {entity}")
+        """
+        Merge the entities on a pool of `raw_to_base_workers` threads. The biggest entities start first and
+        an entity only starts while the estimated memory of the running ones leaves room for it in
+        `raw_to_base_memory_budget_mb`, so the small entities are merged alongside transactions rather than
+        all the big ones at once. One entity always runs, even if it alone is over the budget.
+        """
+        estimates = {entity: self.estimate_memory(entity) for entity in self.entities}
+        pending: List[str] = sorted(self.entities, key=lambda entity: estimates[entity], reverse=True)
+        running = {}
+        in_flight = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while pending or running:
+                    while pending and len(running) < self.workers:
+                        entity = next((e for e in pending if in_flight + estimates[e] <= self.memory_budget), None)
+                        if entity is None and not running:
+                            entity = pending[0]
+                        if entity is None:
+                            break
+                        pending.remove(entity)
+                        in_flight += estimates[entity]
+                        # every entity runs in its own copy of the context, so its span nests under the stage
+                        future = pool.submit(contextvars.copy_context().run, self.process_entity, entity, estimates[entity])
+                        running[future] = entity
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        in_flight -= estimates[running.pop(future)]
+                        future.result()
+            except BaseException:
+                # let the entities already running finish, but start no more
+                pending.clear()
+                wait(running)
+                raise
+
+    def process_entity(self, entity: str, memory_estimate: int):
+        with span('raw_to_base_entity', entity=entity, memory_estimate_bytes=memory_estimate):
+            try:
+                self._process_entity(entity)
+            finally:
+                self._release_entity(entity)
+
+    def _process_entity(self, entity: str):
+        logging.info(f"Processing entity: {entity}")
+        # check the file is in the raw data path, if not skip the entity
+        folder_path = os.path.join(self.raw_data_path, entity)
+        folder_contents = os.listdir(folder_path)
+        if not folder_contents:
+            logging.warning(f"The folder {folder_path} is empty skipping {entity}.")
+            return
+        if not self._load_raw_data(entity):
+            logging.warning(f"Skipping processing for entity: {entity} due to empty data.")
+            return
+        self._load_existing_base_data(entity)
+        self._combine_data(entity)
+        if not self._save_base_data(entity):
+            logging.error(f"Skipping processing for entity: {entity} due to failed saving base data.")
+            return
+        if history_enabled(self.config, entity) and not self._update_history(entity):
+            logging.error(f"Skipping processing for entity: {entity} due to failed saving history.")
+            return
+        if not self._move_raw_to_processed(entity):
+            logging.error(f"entity: {entity} has been processed, but we could not move the file out of the raw folder, please clear the raw folder for {entity}.")
+            sys.exit(ec.MOVE_FILE_ERROR)
+        logging.info(f"Successfully processed entity: {entity}")
+
+    def _release_entity(self, entity: str):
+        """
+        Drop every frame held for an entity once it is done, so memory does not grow across the entities.
+        """
+        for frames in (self.data, self.base_data, self.new_data, self.previous_base_data):
+            frames.pop(entity, None)
     
     def _load_raw_data(self, entity):
         entity_path = os.path.join(self.raw_data_path, entity)
         self.data[entity] = []
         logging.debug(f"Loading data for entity: {entity} from path: {entity_path}")
         
-        files = [f for f in os.listdir(entity_path) if f.endswith('.json')]
+        # a load is one <load time>.json file, or <load time>.<shard>.json chunks from a sharded backfill
+        files = sorted(f for f in os.listdir(entity_path) if f.endswith('.json'))
         
-        if len(files) > 1:
-            logging.error(f"""More than one file found in path: {entity_path}. Skipping processing for entity: {entity}.
+        if len({f.split('.')[0] for f in files}) > 1:
+            logging.error(f"""More than one load found in path: {entity_path}. Skipping processing for entity: {entity}.
 recommended actions is to move the newest file(s) out, re-run main.py.
 Then move the files back in one at a time oldest to newest and run again for each file""")
             return False
         
-        if len(files) == 1:
-            file_name = files[0]
+        for file_name in files:
             file_path = os.path.join(entity_path, file_name)
             logging.debug(f"Reading file: {file_path}")
+            record(bytes_read=file_size(file_path))
             try:
                 with open(file_path, 'r') as f:
                     data = json.load(f)
@@ -65,13 +143,14 @@ Then move the files back in one at a time oldest to newest and run again for eac
                 return False
             
             if self._is_data_empty(entity, data, file_path):
-                return False
+                continue
             
             modified_data = self._add_ingestion_date(entity, data, file_name)
+            self.load_times[entity] = datetime.strptime(file_name.split('.')[0], '%Y%m%d%H%M%S')
 
             self.data[entity].append(modified_data)
             logging.debug(f"Successfully loaded data from file: {file_path}")
-        return True
+        return bool(self.data[entity]) or not files
 
     def _is_data_empty(self, entity, data, file_path):
         logging.debug(f"Checking if data is empty for entity: {entity}")
@@ -113,6 +192,7 @@ Then move the files back in one at a time oldest to newest and run again for eac
         base_path = os.path.join(self.base_data_path, f'{entity}.parquet')
         if os.path.exists(base_path):
             logging.debug(f"Loading existing base data for entity: {entity} from path: {base_path}")
+            record(bytes_read=file_size(base_path))
             try:
                 self.base_data[entity] = pl.read_parquet(base_path)
             except Exception as e:
@@ -124,9 +204,11 @@ Then move the files back in one at a time oldest to newest and run again for eac
             logging.debug(f"No existing base data found for entity: {entity}, starting with an empty DataFrame")
     
     #Function to cast null Struct({'': Null}) columns to String
+    #newer polars versions infer empty objects ({}) as a Struct with no fields, which parquet cannot write either
     def _cast_struct_to_string(self,df):
         for col in df.columns:
-            if df.schema[col] == pl.Struct({'': pl.Null}):
+            dtype = df.schema[col]
+            if dtype == pl.Struct({'': pl.Null}) or (isinstance(dtype, pl.Struct) and not dtype.fields):
                 df = df.with_columns(
                     pl.when(pl.col(col).is_null())
                     .then(pl.lit("null"))
@@ -149,6 +231,7 @@ Then move the files back in one at a time oldest to newest and run again for eac
                 combined_data.extend(data)
         
         new_data_df = pl.DataFrame(combined_data)
+        record(rows_in=new_data_df.height)
         
         # Ensure the unique id column is preserved
         unique_id = self.primary_keys[entity]['unique_id']
@@ -158,6 +241,8 @@ Then move the files back in one at a time oldest to newest and run again for eac
         
         # Cast columns in new_data_df
         new_data_df = self._cast_struct_to_string(new_data_df)
+        self.new_data[entity] = new_data_df
+        self.previous_base_data[entity] = self.base_data.get(entity, pl.DataFrame())
         
         # Merge new data with existing base data
         if entity in self.base_data and not self.base_data[entity].is_empty():
@@ -167,15 +252,17 @@ Then move the files back in one at a time oldest to newest and run again for eac
             existing_data_df = self._cast_struct_to_string(existing_data_df)
             
             # Identify new rows and rows to update
-            new_rows = new_data_df.filter(~pl.col(unique_id).is_in(existing_data_df[unique_id]))
-            updated_rows = new_data_df.filter(pl.col(unique_id).is_in(existing_data_df[unique_id]))
+            existing_ids = existing_data_df[unique_id].implode()
+            new_rows = new_data_df.filter(~pl.col(unique_id).is_in(existing_ids))
+            updated_rows = new_data_df.filter(pl.col(unique_id).is_in(existing_ids))
             
-            # Update existing rows
-            for row in updated_rows.iter_rows(named=True):
-                existing_data_df = existing_data_df.with_columns([
-                    pl.when(pl.col(unique_id) == row[unique_id]).then(pl.lit(row[col], allow_object=True)).otherwise(pl.col(col)).alias(col)
-                    for col in updated_rows.columns if col != unique_id
-                ])
+            # Update existing rows in place in one join, the latest version of a record wins and nulls overwrite
+            if not updated_rows.is_empty():
+                existing_data_df = existing_data_df.update(
+                    updated_rows.unique(subset=unique_id, keep='last', maintain_order=True),
+                    on=unique_id,
+                    include_nulls=True,
+                )
             
             # Add new rows
             self.base_data[entity] = pl.concat([existing_data_df, new_rows])
@@ -189,12 +276,20 @@ Then move the files back in one at a time oldest to newest and run again for eac
         file_path = os.path.join(self.base_data_path, f'{entity}.parquet')
         try:
             self.base_data[entity].write_parquet(file_path)
+            record(rows_out=self.base_data[entity].height, bytes_written=file_size(file_path))
         except Exception as e:
             logging.error(f"Failed to save base data for entity: {entity}, error: {e}")
             return False
         logging.debug(f"Saved base data for entity: {entity} to path: {file_path}")
         return True
     
+    def _update_history(self, entity):
+        unique_id = self.primary_keys[entity]['unique_id']
+        return update_history(
+            self.config, entity, unique_id, self.new_data[entity],
+            self.previous_base_data[entity], self.load_times[entity]
+        )
+
     def _move_raw_to_processed(self, entity):
         raw_entity_path = os.path.join(self.raw_data_path, entity)
         processed_path = os.path.join(self.processed_data_path, entity)
@@ -203,18 +298,18 @@ Then move the files back in one at a time oldest to newest and run again for eac
         
         try:
             files = [f for f in os.listdir(raw_entity_path) if f.endswith('.json')]
-            if len(files) != 1:
-                logging.error(f"Expected exactly one file in path: {raw_entity_path}, but found {len(files)}")
+            if not files:
+                logging.error(f"Expected the files of one load in path: {raw_entity_path}, but found none")
                 return False
             
-            file_name = files[0]
-            raw_file_path = os.path.join(raw_entity_path, file_name)
-            processed_file_path = os.path.join(processed_path, file_name)
-            
-            logging.debug(f"Moving file: {raw_file_path} to {processed_file_path}")
-            
-            os.rename(raw_file_path, processed_file_path)
-            logging.debug(f"Moved file: {file_name} to processed")
+            for file_name in files:
+                raw_file_path = os.path.join(raw_entity_path, file_name)
+                processed_file_path = os.path.join(processed_path, file_name)
+                
+                logging.debug(f"Moving file: {raw_file_path} to {processed_file_path}")
+                
+                os.rename(raw_file_path, processed_file_path)
+                logging.debug(f"Moved file: {file_name} to processed")
         
         except FileNotFoundError as e:
             logging.error(f"File not found: {e}")
@@ -0,0 +1,196 @@
+'''Module to mirror the warehouse into a SQLite database for BI and ad-hoc query tools'''
+
+import os
+import sqlite3
+import logging
+from typing import Dict, Any, List, Tuple
+
+import polars as pl
+from pipeline.facts import stable_digest
+from pipeline.instrumentation import span, record, file_size
+
+# digest of every exported row, compared with the warehouse to find the rows that changed since the last export.
+# The digests live in a side table per exported table, so the tables BI tools read only hold warehouse columns
+ROW_HASH = '_row_hash'
+ROW_HASH_TABLE_PREFIX = '_row_hashes_'
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def row_hash_table(table: str) -> str:
+    return f'{ROW_HASH_TABLE_PREFIX}{table}'
+
+
+def row_hashes(frame: pl.DataFrame) -> pl.Series:
+    """
+    A digest of each row's SQLite values. Unlike a polars hash it stays the same across polars versions,
+    so an upgrade does not rewrite every row.
+    """
+    return pl.Series(ROW_HASH, [stable_digest(row) for row in frame.iter_rows()], dtype=pl.Utf8)
+
+
+def sqlite_type(dtype: pl.DataType) -> str:
+    if dtype.is_integer():
+        return 'INTEGER'
+    if dtype.is_float():
+        return 'REAL'
+    return 'TEXT'
+
+
+def to_sqlite_frame(df: pl.DataFrame, table: str) -> pl.DataFrame:
+    """
+    Convert a warehouse table to the values SQLite stores: booleans as 0/1, dates and times as ISO text,
+    unsigned 64 bit integers as signed ones.
+    Nested columns have no SQLite equivalent and are left out.
+    """
+    columns = []
+    for name, dtype in df.schema.items():
+        if dtype == pl.Boolean:
+            columns.append(pl.col(name).cast(pl.Int8))
+        elif dtype == pl.UInt64:
+            # SQLite integers are signed 64 bit, hashes keep their bits but may turn negative
+            columns.append(pl.col(name).reinterpret(signed=True))
+        elif dtype.is_temporal() or dtype == pl.Null:
+            columns.append(pl.col(name).cast(pl.Utf8))
+        elif dtype.is_decimal():
+            columns.append(pl.col(name).cast(pl.Float64))
+        elif dtype.is_nested():
+            logging.warning(f"Column {name} of table: {table} is nested, it is not exported to SQLite")
+        else:
+            columns.append(pl.col(name))
+    return df.select(columns)
+
+
+class SqliteExport:
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Mirror the warehouse tables listed in `sqlite_export_tables` into the SQLite database at
+        `sqlite_export_path`, keyed by the columns listed for each table. Only rows whose content changed
+        since the last export are upserted and rows gone from the warehouse are deleted, all in one
+        transaction so readers never see a half exported warehouse. Does nothing unless `sqlite_export` is on.
+        """
+        self.config = config
+        self.warehouse_path = config['warehouse_data_path']
+        self.database_path = config['sqlite_export_path']
+        self.tables = config.get('sqlite_export_tables') or {}
+        self.index_columns = config.get('sqlite_index_columns') or []
+        if not config.get('sqlite_export', False):
+            logging.debug("SQLite export is switched off")
+            return
+        self.transform()
+
+    def transform(self):
+        os.makedirs(os.path.dirname(self.database_path) or '.', exist_ok=True)
+        # autocommit mode, so the explicit BEGIN also covers the CREATE TABLE and CREATE INDEX statements
+        connection = sqlite3.connect(self.database_path, isolation_level=None)
+        try:
+            connection.execute('BEGIN')
+            for table, keys in self.tables.items():
+                with span('sqlite_export_table', table=table):
+                    self.export_table(connection, table, keys)
+            connection.execute('COMMIT')
+        except Exception as e:
+            connection.execute('ROLLBACK')
+            logging.error(f"Failed to export the warehouse to SQLite database {self.database_path}, error: {e}")
+            return
+        finally:
+            connection.close()
+        record(bytes_written=file_size(self.database_path))
+        logging.info(f"Exported the warehouse to SQLite database {self.database_path}")
+
+    def existing_schema(self, connection: sqlite3.Connection, table: str) -> Tuple[List[str], List[str]]:
+        """
+        The columns and the primary key columns, in key order, of the exported table. Both are empty if
+        the table or its row hashes do not exist yet.
+        """
+        hash_table = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (row_hash_table(table),)
+        ).fetchone()
+        if hash_table is None:
+            return [], []
+        table_info = connection.execute(f"PRAGMA table_info({_quote(table)})").fetchall()
+        columns = [row[1] for row in table_info]
+        # the pk field is the 1-based position of the column in the primary key, 0 for the other columns
+        keys = [row[1] for row in sorted((row for row in table_info if row[5]), key=lambda row: row[5])]
+        return columns, keys
+
+    def create_table(self, connection: sqlite3.Connection, table: str, frame: pl.DataFrame, keys: List[str]):
+        column_definitions = [f"{_quote(name)} {sqlite_type(dtype)}" for name, dtype in frame.schema.items()]
+        key_definitions = [f"{_quote(key)} {sqlite_type(frame.schema[key])}" for key in keys]
+        primary_key = ', '.join(_quote(key) for key in keys)
+        connection.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+        connection.execute(f"DROP TABLE IF EXISTS {_quote(row_hash_table(table))}")
+        connection.execute(
+            f"CREATE TABLE {_quote(table)} ({', '.join(column_definitions)}, PRIMARY KEY ({primary_key}))"
+        )
+        connection.execute(
+            f"CREATE TABLE {_quote(row_hash_table(table))} "
+            f"({', '.join(key_definitions)}, {_quote(ROW_HASH)} TEXT, PRIMARY KEY ({primary_key}))"
+        )
+
+    def upsert(self, connection: sqlite3.Connection, table: str, rows: pl.DataFrame, keys: List[str]):
+        columns = ', '.join(_quote(column) for column in rows.columns)
+        placeholders = ', '.join('?' for _ in rows.columns)
+        updates = ', '.join(
+            f"{_quote(column)} = excluded.{_quote(column)}" for column in rows.columns if column not in keys
+        )
+        on_conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        connection.executemany(
+            f"INSERT INTO {_quote(table)} ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT ({', '.join(_quote(key) for key in keys)}) {on_conflict}",
+            rows.iter_rows(),
+        )
+
+    def create_indexes(self, connection: sqlite3.Connection, table: str, frame: pl.DataFrame, keys: List[str]):
+        for column in self.index_columns:
+            # the leading primary key column is already indexed by the primary key
+            if column not in frame.columns or column == keys[0]:
+                continue
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {_quote(f'idx_{table}_{column}')} ON {_quote(table)} ({_quote(column)})"
+            )
+
+    def export_table(self, connection: sqlite3.Connection, table: str, keys: List[str]):
+        path = f"{self.warehouse_path}/{table}.parquet"
+        if not os.path.exists(path):
+            logging.warning(f"The {table} table does not exist, skipping its SQLite export")
+            return
+        frame = to_sqlite_frame(pl.read_parquet(path), table)
+        record(rows_in=frame.height, bytes_read=file_size(path))
+        missing_keys = [key for key in keys if key not in frame.columns]
+        if missing_keys:
+            raise KeyError(f"Key columns {missing_keys} not found in table: {table}")
+        hashed = frame.select(keys).with_columns(row_hashes(frame))
+
+        key_schema = {key: frame.schema[key] for key in keys}
+        existing_columns, existing_keys = self.existing_schema(connection, table)
+        if existing_columns != frame.columns or existing_keys != keys:
+            if existing_columns:
+                logging.info(f"The columns or keys of table: {table} changed, recreating it in SQLite")
+            self.create_table(connection, table, frame, keys)
+            exported = pl.DataFrame(schema={**key_schema, ROW_HASH: pl.Utf8})
+        else:
+            selected = ', '.join(_quote(column) for column in [*keys, ROW_HASH])
+            exported = pl.DataFrame(
+                connection.execute(f"SELECT {selected} FROM {_quote(row_hash_table(table))}").fetchall(),
+                schema={**key_schema, ROW_HASH: pl.Utf8},
+                orient='row',
+            )
+
+        changed_hashes = hashed.join(exported, on=[*keys, ROW_HASH], how='anti')
+        changed_rows = frame.join(changed_hashes.select(keys), on=keys, how='semi')
+        removed_keys = exported.join(frame.select(keys), on=keys, how='anti').select(keys)
+
+        if not changed_rows.is_empty():
+            self.upsert(connection, table, changed_rows, keys)
+            self.upsert(connection, row_hash_table(table), changed_hashes, keys)
+        if not removed_keys.is_empty():
+            conditions = ' AND '.join(f"{_quote(key)} = ?" for key in keys)
+            for target in (table, row_hash_table(table)):
+                connection.executemany(f"DELETE FROM {_quote(target)} WHERE {conditions}", removed_keys.iter_rows())
+        self.create_indexes(connection, table, frame, keys)
+
+        record(rows_out=changed_rows.height, rows_deleted=removed_keys.height)
+        logging.info(f"Upserted {changed_rows.height} and deleted {removed_keys.height} rows of table: {table} in SQLite")
@@ -0,0 +1,118 @@
+'''Module to build the warehouse tables declared under `table_specs` in the config, all in one polars run'''
+
+import os
+import logging
+from typing import Dict, Any, List, Union
+
+import polars as pl
+from pipeline import profiling
+from pipeline.dimensions import date_key
+from pipeline.instrumentation import span, record, file_size
+
+COLUMN_OPTIONS = ['name', 'from', 'parse_date', 'date_key', 'milliunits', 'fill_null']
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def column_expr(column: Union[str, Dict[str, Any]]) -> pl.Expr:
+    """
+    Compile one column of a table spec into an expression. A plain string keeps the base column as is.
+    """
+    if isinstance(column, str):
+        return pl.col(column)
+    unknown = set(column) - set(COLUMN_OPTIONS)
+    if unknown or 'name' not in column:
+        raise ValueError(f"Invalid table spec column {column}, expected a name and any of {COLUMN_OPTIONS[1:]}")
+    expr = pl.col(column.get('from', column['name']))
+    if column.get('parse_date') or column.get('date_key'):
+        expr = expr.str.strptime(pl.Date, format=DATE_FORMAT)
+    if column.get('date_key'):
+        expr = date_key(expr)
+    if column.get('milliunits'):
+        expr = expr / 1000
+    if 'fill_null' in column:
+        expr = expr.fill_null(column['fill_null'])
+    return expr.alias(column['name'])
+
+
+def compile_spec(spec: Dict[str, Any], source_path: str) -> pl.LazyFrame:
+    """
+    Compile a table spec into a lazy plan over its base table. Only the columns the spec reads are
+    projected from the parquet file, and live_only pushes the deleted filter down into the scan.
+    """
+    plan = pl.scan_parquet(source_path)
+    if spec.get('live_only', False):
+        plan = plan.filter(~pl.col('deleted'))
+    return plan.select([column_expr(column) for column in spec['columns']])
+
+
+class TableSpecs:
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Build every warehouse table declared under `table_specs`. The plans are executed together with
+        `pl.collect_all`, so polars runs them in parallel and shares the scans of base tables read by more
+        than one spec. Adding a table that is a selection of one base table is a config change.
+        """
+        self.config = config
+        self.base_data_path = config['base_data_path']
+        self.warehouse_path = config['warehouse_data_path']
+        self.specs = config.get('table_specs') or {}
+        os.makedirs(self.warehouse_path, exist_ok=True)
+        self.transform()
+
+    def source_path(self, spec: Dict[str, Any]) -> str:
+        return f"{self.base_data_path}/{spec['source']}.parquet"
+
+    def output_path(self, table: str) -> str:
+        return f"{self.warehouse_path}/{table}.parquet"
+
+    def compile_plans(self) -> Dict[str, pl.LazyFrame]:
+        plans = {}
+        for table, spec in self.specs.items():
+            source_path = self.source_path(spec)
+            if not os.path.exists(source_path):
+                logging.error(f"The base {spec['source']} table does not exist, skipping table: {table}")
+                continue
+            try:
+                plans[table] = compile_spec(spec, source_path)
+            except Exception as e:
+                logging.error(f"Failed to compile the table spec of table: {table}, error: {e}")
+                continue
+            record(bytes_read=file_size(source_path))
+        return plans
+
+    def collect_plans(self, plans: Dict[str, pl.LazyFrame]) -> Dict[str, pl.DataFrame]:
+        """
+        Collect every plan in one go. If that fails, collect them one by one so a single bad table
+        only costs that table.
+        """
+        tables = list(plans)
+        try:
+            return dict(zip(tables, profiling.collect_all([plans[table] for table in tables], 'TableSpecs')))
+        except Exception as e:
+            logging.warning(f"Failed to build the spec tables together, building them one by one: {e}")
+        frames = {}
+        for table in tables:
+            try:
+                frames[table] = profiling.collect(plans[table], f'TableSpecs.{table}')
+            except Exception as e:
+                logging.error(f"Failed to build table: {table}, error: {e}")
+        return frames
+
+    def write_tables(self, frames: Dict[str, pl.DataFrame]):
+        for table, frame in frames.items():
+            with span('table_spec', table=table):
+                path = self.output_path(table)
+                logging.info(f"Writing the transformed {table} DataFrame to parquet file")
+                try:
+                    frame.write_parquet(path)
+                except Exception as e:
+                    logging.error(f"Failed to write the transformed {table} DataFrame to parquet file: {e}")
+                    continue
+                record(rows_out=frame.height, bytes_written=file_size(path))
+
+    def transform(self):
+        logging.info(f"Building {len(self.specs)} spec tables")
+        plans = self.compile_plans()
+        if not plans:
+            return
+        self.write_tables(self.collect_plans(plans))
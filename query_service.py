@@ -0,0 +1,374 @@
+'''Module to serve the data warehouse over a local HTTP/JSON query API with a result cache'''
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Iterable, List, Optional, Set, Tuple
+
+import polars as pl
+import dash_data
+
+# :name placeholders outside string literals, `::` casts are left alone
+PARAMETER = re.compile(r"'(?:[^']|'')*'|(?<!:):([A-Za-z_][A-Za-z0-9_]*)")
+# comments, string literals, quoted identifiers, words and single characters, in that order
+SQL_TOKEN = re.compile(r"""\s+|--[^\n]*|/\*.*?\*/|('(?:[^']|'')*')|("(?:[^"]|"")*")|([A-Za-z_][A-Za-z0-9_$]*)|(.)""", re.S)
+# polars SQL functions that read files rather than the registered tables
+TABLE_FUNCTIONS = {'read_csv', 'read_parquet', 'read_ipc', 'read_json', 'read_ndjson', 'read_delta', 'read_excel'}
+# words after which an opening parenthesis groups a subquery or a list rather than calling a function
+NON_CALL_KEYWORDS = {
+    'as', 'from', 'join', 'in', 'exists', 'on', 'and', 'or', 'not', 'select', 'where', 'with', 'union',
+    'intersect', 'except', 'all', 'any', 'some', 'lateral', 'using', 'having', 'by', 'then', 'else', 'when',
+}
+# words that end a table reference in a FROM clause, so they are never taken as its alias
+CLAUSE_KEYWORDS = {
+    'where', 'group', 'order', 'having', 'limit', 'offset', 'join', 'inner', 'left', 'right', 'full', 'cross',
+    'natural', 'semi', 'anti', 'on', 'using', 'union', 'intersect', 'except', 'window', 'qualify', 'fetch',
+}
+
+
+class QueryError(Exception):
+    '''A query the client got wrong, reported back as a 400'''
+
+
+def sql_literal(value: Any) -> str:
+    """
+    Render a parameter value as a SQL literal. Strings are quoted with embedded quotes doubled,
+    so a parameter can never change the shape of the query it is bound into.
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        if not value:
+            raise QueryError("List parameters cannot be empty")
+        return '(' + ', '.join(sql_literal(v) for v in value) + ')'
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise QueryError(f"Unsupported parameter type {type(value).__name__}")
+
+
+def bind_parameters(sql: str, params: Dict[str, Any]) -> str:
+    """
+    Replace every :name placeholder with the literal of params[name]. Lists become (a, b, c) for IN clauses.
+    """
+    def replace(match):
+        name = match.group(1)
+        if name is None:
+            return match.group(0)
+        if name not in params:
+            raise QueryError(f"Missing value for parameter :{name}")
+        return sql_literal(params[name])
+    return PARAMETER.sub(replace, sql)
+
+
+def sql_tokens(sql: str) -> List[Tuple[str, str]]:
+    """
+    Split a query into (kind, value) tokens, kind being 'string', 'name', 'word' or 'symbol'. Comments are
+    dropped and quoted identifiers become names, so a table cannot hide from `check_tables` behind either.
+    """
+    tokens = []
+    for match in SQL_TOKEN.finditer(sql):
+        string, quoted, word, symbol = match.groups()
+        if string is not None:
+            tokens.append(('string', string))
+        elif quoted is not None:
+            tokens.append(('name', quoted[1:-1].replace('""', '"')))
+        elif word is not None:
+            tokens.append(('word', word))
+        elif symbol is not None:
+            tokens.append(('symbol', symbol))
+    return tokens
+
+
+def check_tables(sql: str, tables: Iterable[str]):
+    """
+    Reject anything but a single SELECT over the registered tables and the query's own CTEs. polars SQL
+    would otherwise read any file the service can reach through `read_parquet(...)` and the other
+    table functions, or through a quoted path in the FROM clause.
+    """
+    tokens = sql_tokens(sql)
+    words = [value.lower() if kind == 'word' else None for kind, value in tokens]
+    if not tokens or words[0] not in ('select', 'with'):
+        raise QueryError("Only SELECT queries are allowed")
+    if any(value == ';' for _, value in tokens[:-1]):
+        raise QueryError("Only one statement can be run per query")
+    # the query's own CTEs, `name AS (`
+    allowed = {table.lower() for table in tables}
+    for index in range(len(tokens) - 2):
+        if tokens[index][0] in ('word', 'name') and words[index + 1] == 'as' and tokens[index + 2][1] == '(':
+            allowed.add(tokens[index][1].lower())
+
+    # whether each open parenthesis is a function call, where FROM is an argument, e.g. EXTRACT(year FROM d)
+    calls = []
+    index = 0
+    while index < len(tokens):
+        kind, value = tokens[index]
+        if kind == 'word' and words[index] in TABLE_FUNCTIONS:
+            raise QueryError(f"Table function {value} is not allowed, query the warehouse tables instead")
+        if value == '(':
+            previous = tokens[index - 1] if index else ('symbol', '')
+            calls.append(previous[0] in ('word', 'name') and words[index - 1] not in NON_CALL_KEYWORDS)
+        elif value == ')' and calls:
+            calls.pop()
+        elif words[index] in ('from', 'join') and not (calls and calls[-1]):
+            index = check_table_references(tokens, words, index + 1, allowed)
+            continue
+        index += 1
+
+
+def check_table_references(tokens: List[Tuple[str, str]], words: List[Optional[str]], index: int, allowed: Set[str]) -> int:
+    """
+    Check the comma separated table references of a FROM clause starting at tokens[index] and return
+    the index of the first token after them. A subquery is left to the caller to walk into.
+    """
+    while index < len(tokens):
+        kind, value = tokens[index]
+        if value == '(':
+            return index
+        if kind == 'string':
+            raise QueryError(f"Reading {value} is not allowed, query the warehouse tables instead")
+        if kind not in ('word', 'name'):
+            raise QueryError(f"Unexpected {value} in a FROM clause")
+        if index + 1 < len(tokens) and tokens[index + 1][1] == '(':
+            raise QueryError(f"Table function {value} is not allowed, query the warehouse tables instead")
+        if value.lower() not in allowed:
+            raise QueryError(f"Unknown table {value}")
+        index += 1
+        # an optional alias, with or without AS
+        if index < len(tokens) and words[index] == 'as':
+            index += 2
+        elif index < len(tokens) and tokens[index][0] in ('word', 'name') and words[index] not in CLAUSE_KEYWORDS:
+            index += 1
+        if index < len(tokens) and tokens[index][1] == ',':
+            index += 1
+            continue
+        return index
+    return index
+
+
+class ResultCache:
+    def __init__(self, max_entries: int):
+        """
+        A thread safe LRU cache of serialised query results. Keys include the warehouse version,
+        so results of an older warehouse are never served and simply age out.
+        """
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Any]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses}
+
+
+class Warehouse:
+    def __init__(self, warehouse_path: str):
+        """
+        Every warehouse table read into memory once, plus the joined views the dashboard builds, so queries
+        never decode parquet and a pipeline run rewriting the files cannot fail a query mid-read.
+        The version is a digest of the file names, sizes and modification times, and the tables are
+        reloaded when it changes, e.g. after a pipeline run.
+        """
+        self.warehouse_path = warehouse_path
+        self.lock = threading.Lock()
+        # version and tables are swapped together, so a reader never pairs a version with the wrong tables
+        self.state: Tuple[Optional[str], Dict[str, pl.DataFrame]] = (None, {})
+
+    def current_version(self) -> str:
+        digest = hashlib.sha1()
+        for file_name in sorted(os.listdir(self.warehouse_path)):
+            if not file_name.endswith('.parquet'):
+                continue
+            stat = os.stat(os.path.join(self.warehouse_path, file_name))
+            digest.update(f'{file_name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        return digest.hexdigest()[:16]
+
+    def load(self, version: str):
+        tables = {}
+        for file_name in sorted(os.listdir(self.warehouse_path)):
+            if file_name.endswith('.parquet'):
+                path = os.path.join(self.warehouse_path, file_name)
+                tables[file_name[:-len('.parquet')]] = pl.read_parquet(path)
+        # the joins every consumer repeats are done once per warehouse version
+        try:
+            tables['master_transactions'] = dash_data.build_master_transactions(tables)
+            tables['category_lines'] = dash_data.build_category_lines(tables)
+        except Exception as e:
+            logging.warning(f"Could not build the joined transaction views: {e}")
+        self.state = (version, tables)
+        logging.info(f"Loaded {len(tables)} warehouse tables at version {version}")
+
+    def snapshot(self) -> Tuple[str, Dict[str, pl.DataFrame]]:
+        """
+        Return the current version and tables, reloading them first if the files changed.
+        Only one thread reloads, the others wait and then share the same copy.
+        """
+        version = self.current_version()
+        if version != self.state[0]:
+            with self.lock:
+                if version != self.state[0]:
+                    self.load(version)
+        return self.state
+
+
+class _QueryHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 resets connections when many readers query at once
+    request_queue_size = 128
+
+
+class QueryService:
+    def __init__(self, config: Dict[str, Any], host: Optional[str] = None, port: Optional[int] = None,
+                 cache_size: Optional[int] = None):
+        """
+        A local HTTP/JSON API over the warehouse:
+        GET /health, GET /tables and POST /query with {"sql": ..., "params": {...}}.
+        """
+        self.warehouse = Warehouse(config['warehouse_data_path'])
+        self.cache = ResultCache(cache_size if cache_size is not None else config.get('query_cache_size', 128))
+        self.max_rows = config.get('query_max_rows', 100_000)
+        host = host or config.get('query_service_host', '127.0.0.1')
+        port = port if port is not None else config.get('query_service_port', 8060)
+        self.httpd = _QueryHTTPServer((host, port), self._handler_class())
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug(f"query service: {format % args}")
+
+            def do_GET(self):
+                service.handle(self, 'GET')
+
+            def do_POST(self):
+                service.handle(self, 'POST')
+
+        return Handler
+
+    def query(self, sql: str, params: Dict[str, Any]) -> Tuple[bytes, bool]:
+        """
+        Run a query against the current warehouse, returning the JSON body and whether it came from the cache.
+        """
+        if not isinstance(sql, str) or not sql.strip():
+            raise QueryError("The request needs a sql string")
+        if not isinstance(params, dict):
+            raise QueryError("params must be an object")
+        bound_sql = bind_parameters(sql, params)
+        version, tables = self.warehouse.snapshot()
+        check_tables(bound_sql, tables)
+        key = (version, bound_sql)
+        body = self.cache.get(key)
+        if body is not None:
+            return body, True
+
+        start = time.perf_counter()
+        try:
+            # a context per query, the frames it registers are shared rather than copied
+            result = pl.SQLContext(frames=tables, eager=True).execute(bound_sql)
+        except Exception as e:
+            raise QueryError(f"Query failed: {e}")
+        truncated = result.height > self.max_rows
+        result = result.head(self.max_rows)
+        header = json.dumps({
+            'version': version,
+            'columns': [{'name': name, 'type': str(dtype)} for name, dtype in result.schema.items()],
+            'row_count': result.height,
+            'truncated': truncated,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 3),
+        })
+        # the rows are serialised by polars and spliced in, rather than converted to Python objects
+        body = f'{header[:-1]}, "rows": {result.write_json()}}}'.encode()
+        self.cache.put(key, body)
+        return body, False
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        path = handler.path.split('?')[0]
+        try:
+            if method == 'GET' and path == '/health':
+                version, tables = self.warehouse.snapshot()
+                return self._send(handler, 200, {'status': 'ok', 'version': version, 'cache': self.cache.stats()})
+            if method == 'GET' and path == '/tables':
+                version, tables = self.warehouse.snapshot()
+                return self._send(handler, 200, {'version': version, 'tables': {
+                    name: {'rows': df.height, 'columns': {c: str(t) for c, t in df.schema.items()}}
+                    for name, df in tables.items()
+                }})
+            if method == 'POST' and path == '/query':
+                length = int(handler.headers.get('Content-Length') or 0)
+                try:
+                    request = json.loads(handler.rfile.read(length) or b'{}')
+                except json.JSONDecodeError as e:
+                    raise QueryError(f"The request body is not valid JSON: {e}")
+                body, cached = self.query(request.get('sql'), request.get('params') or {})
+                return self._send_raw(handler, 200, body, {'X-Cache': 'hit' if cached else 'miss'})
+            return self._send(handler, 404, {'error': 'not_found'})
+        except QueryError as e:
+            return self._send(handler, 400, {'error': 'bad_query', 'detail': str(e)})
+        except FileNotFoundError as e:
+            return self._send(handler, 503, {'error': 'warehouse_missing', 'detail': str(e)})
+        except Exception as e:
+            logging.error(f"Query service failed to handle {method} {path}: {e}")
+            return self._send(handler, 500, {'error': 'internal_error'})
+
+    def _send(self, handler: BaseHTTPRequestHandler, status: int, payload: Dict[str, Any]):
+        self._send_raw(handler, status, json.dumps(payload, default=str).encode())
+
+    def _send_raw(self, handler: BaseHTTPRequestHandler, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def serve_forever(self):
+        # load up front so the first request does not pay for it
+        self.warehouse.snapshot()
+        logging.info(f"Query service listening on {self.url}")
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+
+    def shutdown(self):
+        self.httpd.shutdown()
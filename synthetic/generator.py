@@ -0,0 +1,435 @@
+'''Module to generate deterministic synthetic YNAB budgets for benchmarking and offline runs'''
+
+import copy
+import uuid
+import random
+from datetime import date, timedelta
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+ACCOUNT_TYPES = ['checking', 'savings', 'creditCard', 'cash', 'otherAsset']
+CLEARED_STATES = ['cleared', 'uncleared', 'reconciled']
+FLAG_COLORS = [None, None, None, None, 'red', 'orange', 'yellow', 'green', 'blue', 'purple']
+FREQUENCIES = [
+    'never', 'daily', 'weekly', 'everyOtherWeek', 'twiceAMonth', 'every4Weeks', 'monthly',
+    'everyOtherMonth', 'every3Months', 'every4Months', 'twiceAYear', 'yearly', 'everyOtherYear'
+]
+CATEGORY_GROUP_NAMES = ['Bills', 'Everyday', 'Savings Goals', 'Fun', 'Giving', 'Debt', 'Travel', 'Health']
+
+# each entity gets its own uuid namespace so ids never collide across entities
+_ENTITY_CODES = {
+    'accounts': 1, 'category_groups': 2, 'categories': 3, 'payees': 4,
+    'transactions': 5, 'subtransactions': 6, 'scheduled_transactions': 7,
+}
+
+
+def synthetic_id(entity: str, index: int) -> str:
+    return str(uuid.UUID(int=(_ENTITY_CODES[entity] << 96) | index))
+
+
+class SyntheticBudget:
+    def __init__(
+        self,
+        seed: int = 42,
+        accounts: int = 8,
+        category_groups: int = 6,
+        categories_per_group: int = 6,
+        payees: int = 200,
+        transactions: int = 10_000,
+        scheduled_transactions: int = 25,
+        years: int = 3,
+        split_ratio: float = 0.05,
+        delete_ratio: float = 0.01,
+        end_date: date = date(2024, 12, 31),
+    ):
+        """
+        A synthetic budget that behaves like the YNAB delta API.
+        Every record remembers the server_knowledge at which it last changed, and `advance` moves the
+        budget forward with edits, deletes and new records so incremental syncs can be exercised.
+        Transactions are generated on demand from their index, so very large budgets stay cheap to hold.
+        """
+        self.seed = seed
+        self.split_ratio = split_ratio
+        self.delete_ratio = delete_ratio
+        self.end_date = end_date
+        self.start_date = end_date - timedelta(days=365 * years)
+        self.server_knowledge = 1
+        self.rng = random.Random(seed)
+
+        self.accounts = self._build_accounts(accounts)
+        self.category_groups = self._build_categories(category_groups, categories_per_group)
+        self.categories = [c for group in self.category_groups for c in group['categories']]
+        self.budget_categories = [c for c in self.categories if c['category_group_name'] != 'Internal Master Category']
+        self.payees = self._build_payees(payees)
+        # transactions draw from a fixed pool, so payees added by `advance` do not reshuffle history
+        self.payee_pool = self.payees[len(self.accounts) + 1:]
+        self.months = self._build_months()
+        self.scheduled_transactions = self._build_scheduled_transactions(scheduled_transactions)
+
+        self.transaction_count = transactions
+        # index -> (server_knowledge, overridden fields) for transactions changed or added after generation
+        self.transaction_changes: Dict[int, Tuple[int, Dict[str, Any]]] = {}
+
+    def _record_rng(self, entity: str, index: int) -> random.Random:
+        return random.Random((self.seed << 40) ^ (_ENTITY_CODES[entity] << 36) ^ index)
+
+    def _build_accounts(self, count: int) -> List[Dict[str, Any]]:
+        accounts = []
+        for i in range(count):
+            account_type = ACCOUNT_TYPES[i % len(ACCOUNT_TYPES)]
+            balance = self.rng.randint(-2_000_000, 20_000_000)
+            uncleared = self.rng.randint(-200_000, 0)
+            accounts.append({
+                'id': synthetic_id('accounts', i),
+                'name': f'{account_type.title()} Account {i + 1}',
+                'type': account_type,
+                'on_budget': account_type != 'otherAsset',
+                'closed': False,
+                'note': None,
+                'balance': balance,
+                'cleared_balance': balance - uncleared,
+                'uncleared_balance': uncleared,
+                'transfer_payee_id': synthetic_id('payees', i),
+                'direct_import_linked': False,
+                'direct_import_in_error': False,
+                'last_reconciled_at': None,
+                'debt_original_balance': None,
+                'debt_interest_rates': {},
+                'debt_minimum_payments': {},
+                'debt_escrow_amounts': {},
+                'deleted': False,
+                'server_knowledge': self.server_knowledge,
+            })
+        return accounts
+
+    def _build_categories(self, group_count: int, per_group: int) -> List[Dict[str, Any]]:
+        groups = []
+        category_index = 0
+        group_names = ['Internal Master Category'] + [
+            CATEGORY_GROUP_NAMES[i % len(CATEGORY_GROUP_NAMES)] + ('' if i < len(CATEGORY_GROUP_NAMES) else f' {i}')
+            for i in range(group_count)
+        ]
+        for group_index, group_name in enumerate(group_names):
+            group_id = synthetic_id('category_groups', group_index)
+            if group_name == 'Internal Master Category':
+                names = ['Inflow: Ready to Assign', 'Uncategorized']
+            else:
+                names = [f'{group_name} Category {j + 1}' for j in range(per_group)]
+            categories = []
+            for name in names:
+                budgeted = self.rng.randint(0, 500_000)
+                activity = -self.rng.randint(0, budgeted + 1)
+                categories.append({
+                    'id': synthetic_id('categories', category_index),
+                    'category_group_id': group_id,
+                    'category_group_name': group_name,
+                    'name': name,
+                    'hidden': False,
+                    'original_category_group_id': None,
+                    'note': None,
+                    'budgeted': budgeted,
+                    'activity': activity,
+                    'balance': budgeted + activity,
+                    'goal_type': None,
+                    'goal_target': None,
+                    'goal_percentage_complete': None,
+                    'deleted': False,
+                    'server_knowledge': self.server_knowledge,
+                })
+                category_index += 1
+            groups.append({
+                'id': group_id,
+                'name': group_name,
+                'hidden': False,
+                'deleted': False,
+                'categories': categories,
+            })
+        return groups
+
+    def _build_payees(self, count: int) -> List[Dict[str, Any]]:
+        payees = []
+        # the first payees are the transfer payees of each account, as in YNAB
+        for i, account in enumerate(self.accounts):
+            payees.append({
+                'id': synthetic_id('payees', i),
+                'name': f"Transfer : {account['name']}",
+                'transfer_account_id': account['id'],
+                'deleted': False,
+                'server_knowledge': self.server_knowledge,
+            })
+        payees.append({
+            'id': synthetic_id('payees', len(payees)),
+            'name': 'Starting Balance',
+            'transfer_account_id': None,
+            'deleted': False,
+            'server_knowledge': self.server_knowledge,
+        })
+        for i in range(len(payees), len(payees) + count):
+            payees.append({
+                'id': synthetic_id('payees', i),
+                'name': f'Payee {i}',
+                'transfer_account_id': None,
+                'deleted': False,
+                'server_knowledge': self.server_knowledge,
+            })
+        return payees
+
+    def _build_months(self) -> List[Dict[str, Any]]:
+        months = []
+        month = self.start_date.replace(day=1)
+        while month <= self.end_date:
+            months.append(self._month_record(month))
+            month = (month + timedelta(days=32)).replace(day=1)
+        return months
+
+    def _month_record(self, month: date) -> Dict[str, Any]:
+        categories = []
+        for category in self.budget_categories:
+            budgeted = self.rng.randint(0, 500_000)
+            activity = -self.rng.randint(0, budgeted + 1)
+            categories.append({
+                'id': category['id'],
+                'category_group_id': category['category_group_id'],
+                'category_group_name': category['category_group_name'],
+                'name': category['name'],
+                'hidden': False,
+                'budgeted': budgeted,
+                'activity': activity,
+                'balance': budgeted + activity,
+                'deleted': False,
+            })
+        income = self.rng.randint(2_000_000, 6_000_000)
+        budgeted = sum(c['budgeted'] for c in categories)
+        activity = sum(c['activity'] for c in categories)
+        return {
+            'month': month.isoformat(),
+            'note': None,
+            'income': income,
+            'budgeted': budgeted,
+            'activity': activity,
+            'to_be_budgeted': income - budgeted,
+            'age_of_money': self.rng.randint(5, 90),
+            'deleted': False,
+            'categories': categories,
+            'server_knowledge': self.server_knowledge,
+        }
+
+    def _build_scheduled_transactions(self, count: int) -> List[Dict[str, Any]]:
+        scheduled = []
+        for i in range(count):
+            account = self.rng.choice(self.accounts)
+            payee = self.rng.choice(self.payee_pool)
+            category = self.rng.choice(self.budget_categories)
+            date_first = self.start_date + timedelta(days=self.rng.randint(0, 365))
+            scheduled.append({
+                'id': synthetic_id('scheduled_transactions', i),
+                'date_first': date_first.isoformat(),
+                'date_next': (self.end_date + timedelta(days=self.rng.randint(1, 60))).isoformat(),
+                'frequency': FREQUENCIES[i % len(FREQUENCIES)],
+                'amount': -self.rng.randint(1_000, 500_000),
+                'memo': None,
+                'flag_color': self.rng.choice(FLAG_COLORS),
+                'flag_name': None,
+                'account_id': account['id'],
+                'payee_id': payee['id'],
+                'category_id': category['id'],
+                'transfer_account_id': None,
+                'deleted': False,
+                'account_name': account['name'],
+                'payee_name': payee['name'],
+                'category_name': category['name'],
+                'subtransactions': [],
+                'server_knowledge': self.server_knowledge,
+            })
+        return scheduled
+
+    def transaction(self, index: int) -> Dict[str, Any]:
+        """
+        Build transaction `index` as it currently stands, including any changes made by `advance`.
+        """
+        rng = self._record_rng('transactions', index)
+        account = self.accounts[rng.randrange(len(self.accounts))]
+        payee = self.payee_pool[rng.randrange(len(self.payee_pool))]
+        is_inflow = rng.random() < 0.08
+        amount = rng.randint(100_000, 5_000_000) if is_inflow else -rng.randint(500, 300_000)
+        day = self.start_date + timedelta(days=rng.randrange((self.end_date - self.start_date).days + 1))
+        transaction_id = synthetic_id('transactions', index)
+
+        subtransactions = []
+        if not is_inflow and rng.random() < self.split_ratio:
+            category = None
+            parts = rng.randint(2, 4)
+            remaining = amount
+            for part in range(parts):
+                part_amount = remaining if part == parts - 1 else round(amount / parts)
+                remaining -= part_amount
+                sub_category = self.budget_categories[rng.randrange(len(self.budget_categories))]
+                subtransactions.append({
+                    'id': synthetic_id('subtransactions', index * 4 + part),
+                    'transaction_id': transaction_id,
+                    'amount': part_amount,
+                    'memo': None,
+                    'payee_id': None,
+                    'payee_name': None,
+                    'category_id': sub_category['id'],
+                    'category_name': sub_category['name'],
+                    'transfer_account_id': None,
+                    'transfer_transaction_id': None,
+                    'deleted': False,
+                })
+        elif is_inflow:
+            category = self.categories[0]
+        else:
+            category = self.budget_categories[rng.randrange(len(self.budget_categories))]
+
+        record = {
+            'id': transaction_id,
+            'date': day.isoformat(),
+            'amount': amount,
+            'memo': f'memo {index}' if rng.random() < 0.3 else None,
+            'cleared': CLEARED_STATES[rng.randrange(len(CLEARED_STATES))],
+            'approved': True,
+            'flag_color': FLAG_COLORS[rng.randrange(len(FLAG_COLORS))],
+            'flag_name': None,
+            'account_id': account['id'],
+            'account_name': account['name'],
+            'payee_id': payee['id'],
+            'payee_name': payee['name'],
+            'category_id': category['id'] if category else None,
+            'category_name': category['name'] if category else 'Split (Multiple Categories)...',
+            'transfer_account_id': None,
+            'transfer_transaction_id': None,
+            'matched_transaction_id': None,
+            'import_id': None,
+            'import_payee_name': None,
+            'import_payee_name_original': None,
+            'debt_transaction_type': None,
+            'deleted': rng.random() < self.delete_ratio,
+            'subtransactions': subtransactions,
+        }
+        change = self.transaction_changes.get(index)
+        if change is not None:
+            record.update(change[1])
+        return record
+
+    def advance(self, edits: int = 100, deletes: int = 10, new_transactions: int = 200, seed: Optional[int] = None) -> int:
+        """
+        Move the budget on by one server_knowledge, editing, deleting and adding transactions and
+        touching the small entities the way a day of budgeting would. Returns the new server_knowledge.
+        """
+        self.server_knowledge += 1
+        knowledge = self.server_knowledge
+        rng = random.Random(seed if seed is not None else (self.seed << 16) + knowledge)
+
+        existing = self.transaction_count
+        for _ in range(min(edits, existing)):
+            index = rng.randrange(existing)
+            fields = dict(self.transaction_changes.get(index, (0, {}))[1])
+            category = rng.choice(self.budget_categories)
+            fields['amount'] = -rng.randint(500, 300_000)
+            fields['memo'] = f'edited at knowledge {knowledge}'
+            fields['category_id'] = category['id']
+            fields['category_name'] = category['name']
+            fields['subtransactions'] = []
+            self.transaction_changes[index] = (knowledge, fields)
+        for _ in range(min(deletes, existing)):
+            index = rng.randrange(existing)
+            fields = dict(self.transaction_changes.get(index, (0, {}))[1])
+            fields['deleted'] = True
+            self.transaction_changes[index] = (knowledge, fields)
+        for index in range(existing, existing + new_transactions):
+            # new transactions land on the last day of the budget, end_date itself stays fixed
+            self.transaction_changes[index] = (knowledge, {'date': self.end_date.isoformat(), 'deleted': False})
+        self.transaction_count += new_transactions
+
+        for account in rng.sample(self.accounts, k=min(2, len(self.accounts))):
+            account['balance'] += rng.randint(-100_000, 100_000)
+            account['server_knowledge'] = knowledge
+        for category in rng.sample(self.budget_categories, k=min(3, len(self.budget_categories))):
+            category['activity'] -= rng.randint(0, 50_000)
+            category['balance'] = category['budgeted'] + category['activity']
+            category['server_knowledge'] = knowledge
+        payee_index = len(self.payees)
+        self.payees.append({
+            'id': synthetic_id('payees', payee_index),
+            'name': f'Payee {payee_index}',
+            'transfer_account_id': None,
+            'deleted': False,
+            'server_knowledge': knowledge,
+        })
+        current_month = self.months[-1]
+        for category in current_month['categories']:
+            category['activity'] -= rng.randint(0, 10_000)
+            category['balance'] = category['budgeted'] + category['activity']
+        current_month['server_knowledge'] = knowledge
+        return knowledge
+
+    def snapshot(self) -> 'SyntheticBudget':
+        """
+        A copy of the budget whose transactions are frozen at its current server_knowledge, for streaming a
+        transactions response while `advance` moves the original on. Only the transaction changes are copied,
+        the accounts, categories, payees and months are still the live objects `advance` changes.
+        """
+        frozen = copy.copy(self)
+        frozen.transaction_changes = dict(self.transaction_changes)
+        return frozen
+
+    def transaction_account_id(self, index: int) -> str:
+        """
+        The account of transaction `index`, without building the rest of it. It is the first draw of its rng.
+        """
+        rng = self._record_rng('transactions', index)
+        return self.accounts[rng.randrange(len(self.accounts))]['id']
+
+    def iter_transactions(self, last_knowledge: int = 0, account_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the transactions that changed after `last_knowledge`, or every transaction for a full sync.
+        With an account_id only that account's transactions are yielded, as `/accounts/{id}/transactions` does.
+        """
+        if last_knowledge == 0:
+            indexes = range(self.transaction_count)
+        else:
+            indexes = [index for index, (knowledge, _) in sorted(self.transaction_changes.items())
+                       if knowledge > last_knowledge]
+        for index in indexes:
+            if account_id is not None and self.transaction_account_id(index) != account_id:
+                continue
+            yield self.transaction(index)
+
+    def iter_records(self, entity: str, last_knowledge: int = 0) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the records of an entity that changed after `last_knowledge`, without the internal knowledge field.
+        """
+        if entity == 'transactions':
+            yield from self.iter_transactions(last_knowledge)
+            return
+        source = {
+            'accounts': self.accounts,
+            'payees': self.payees,
+            'months': self.months,
+            'scheduled_transactions': self.scheduled_transactions,
+        }[entity]
+        for record in source:
+            if record['server_knowledge'] > last_knowledge:
+                yield {k: v for k, v in record.items() if k != 'server_knowledge'}
+
+    def category_groups_since(self, last_knowledge: int = 0) -> List[Dict[str, Any]]:
+        groups = []
+        for group in self.category_groups:
+            categories = [
+                {k: v for k, v in c.items() if k != 'server_knowledge'}
+                for c in group['categories'] if c['server_knowledge'] > last_knowledge
+            ]
+            if categories:
+                groups.append({**group, 'categories': categories})
+        return groups
+
+    def response(self, entity: str, last_knowledge: int = 0) -> Dict[str, Any]:
+        """
+        Build the full JSON response body the YNAB API would return for an entity delta request.
+        """
+        if entity == 'categories':
+            data = {'category_groups': self.category_groups_since(last_knowledge)}
+        else:
+            data = {entity: list(self.iter_records(entity, last_knowledge))}
+        data['server_knowledge'] = self.server_knowledge
+        return {'data': data}
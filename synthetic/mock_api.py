@@ -0,0 +1,213 @@
+'''Module to serve a synthetic budget over HTTP the way the YNAB delta endpoints do'''
+
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Optional
+
+from synthetic.generator import SyntheticBudget
+
+ENTITY_ROUTE = re.compile(r'^/v1/budgets/(?P<budget_id>[^/]+)/(?P<entity>[a-z_]+)$')
+ACCOUNT_TRANSACTIONS_ROUTE = re.compile(r'^/v1/budgets/(?P<budget_id>[^/]+)/accounts/(?P<account_id>[^/]+)/(?P<entity>transactions)$')
+STREAM_CHUNK_RECORDS = 1000
+
+
+class MockYnabServer:
+    def __init__(
+        self,
+        budget: SyntheticBudget,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        rate_limit: int = 200,
+        rate_limit_window_seconds: int = 3600,
+    ):
+        """
+        A local stand-in for api.ynab.com serving `/v1/budgets/{id}/{entity}?last_knowledge_of_server=N`
+        and the per account `/v1/budgets/{id}/accounts/{account_id}/transactions`, a 404 for an unknown or
+        deleted account.
+        Responses carry an `X-Rate-Limit: used/limit` header and return 429 once the limit is spent.
+        Port 0 picks a free port, `base_url` gives the value to put in the pipeline config.
+        """
+        self.budget = budget
+        self.rate_limit = rate_limit
+        self.rate_limit_window_seconds = rate_limit_window_seconds
+        self.request_times = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1/budgets'
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug(f"mock api: {format % args}")
+
+            def do_GET(self):
+                server.handle_get(self)
+
+        return Handler
+
+    def take_rate_limit(self) -> int:
+        """
+        Count a request against the rolling rate limit window and return how many have been used.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.request_times = [t for t in self.request_times if now - t < self.rate_limit_window_seconds]
+            self.request_times.append(now)
+            return len(self.request_times)
+
+    def handle_get(self, handler: BaseHTTPRequestHandler):
+        used = self.take_rate_limit()
+        rate_limit_header = f'{min(used, self.rate_limit)}/{self.rate_limit}'
+
+        if not handler.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send_error(handler, 401, 'unauthorized', rate_limit_header)
+        if used > self.rate_limit:
+            return self._send_error(handler, 429, 'too_many_requests', rate_limit_header)
+
+        url = urlparse(handler.path)
+        route = ENTITY_ROUTE.match(url.path) or ACCOUNT_TRANSACTIONS_ROUTE.match(url.path)
+        if route is None or route['entity'] not in ('accounts', 'categories', 'months', 'payees',
+                                                    'transactions', 'scheduled_transactions'):
+            return self._send_error(handler, 404, 'not_found', rate_limit_header)
+
+        account_id = route.groupdict().get('account_id')
+        if account_id is not None and not any(a['id'] == account_id and not a['deleted'] for a in self.budget.accounts):
+            return self._send_error(handler, 404, 'not_found', rate_limit_header)
+
+        query = parse_qs(url.query)
+        try:
+            last_knowledge = int(query.get('last_knowledge_of_server', ['0'])[0])
+        except ValueError:
+            return self._send_error(handler, 400, 'bad_request', rate_limit_header)
+
+        with self.lock:
+            server_knowledge = self.budget.server_knowledge
+            if route['entity'] == 'transactions':
+                # a full transactions sync can be huge, so it is generated while streaming rather than up front,
+                # from a snapshot so an advance during the stream cannot change what server_knowledge describes
+                records = self.budget.snapshot().iter_transactions(last_knowledge, account_id)
+                if last_knowledge:
+                    records = list(records)
+                body = None
+            else:
+                body = self.budget.response(route['entity'], last_knowledge)
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('X-Rate-Limit', rate_limit_header)
+        if body is not None:
+            payload = json.dumps(body).encode()
+            handler.send_header('Content-Length', str(len(payload)))
+            handler.end_headers()
+            handler.wfile.write(payload)
+            return
+
+        # no Content-Length, the response is delimited by closing the connection
+        handler.close_connection = True
+        handler.end_headers()
+        handler.wfile.write(b'{"data": {"transactions": [')
+        chunk = []
+        first = True
+        for record in records:
+            chunk.append(json.dumps(record))
+            if len(chunk) >= STREAM_CHUNK_RECORDS:
+                handler.wfile.write((('' if first else ',') + ','.join(chunk)).encode())
+                first = False
+                chunk = []
+        if chunk:
+            handler.wfile.write((('' if first else ',') + ','.join(chunk)).encode())
+        handler.wfile.write(f'], "server_knowledge": {server_knowledge}}}}}'.encode())
+
+    def _send_error(self, handler: BaseHTTPRequestHandler, status: int, name: str, rate_limit_header: str):
+        payload = json.dumps({'error': {'id': str(status), 'name': name, 'detail': name}}).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.send_header('X-Rate-Limit', rate_limit_header)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def advance(self, **kwargs) -> int:
+        """
+        Move the served budget forward, see `SyntheticBudget.advance`.
+        """
+        with self.lock:
+            return self.budget.advance(**kwargs)
+
+    def start(self) -> 'MockYnabServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='mock_ynab_api', daemon=True)
+        self.thread.start()
+        logging.info(f"Mock YNAB API serving on {self.base_url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self) -> 'MockYnabServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic YNAB budget on a local port.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--accounts', type=int, default=8)
+    parser.add_argument('--payees', type=int, default=200)
+    parser.add_argument('--transactions', type=int, default=10_000)
+    parser.add_argument('--scheduled-transactions', type=int, default=25)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--split-ratio', type=float, default=0.05)
+    parser.add_argument('--delete-ratio', type=float, default=0.01)
+    parser.add_argument('--rate-limit', type=int, default=200)
+    parser.add_argument('--advance-every', type=float, default=0,
+                        help='seconds between automatic budget updates, 0 to never update')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    budget = SyntheticBudget(
+        seed=args.seed,
+        accounts=args.accounts,
+        payees=args.payees,
+        transactions=args.transactions,
+        scheduled_transactions=args.scheduled_transactions,
+        years=args.years,
+        split_ratio=args.split_ratio,
+        delete_ratio=args.delete_ratio,
+    )
+    server = MockYnabServer(budget, host=args.host, port=args.port, rate_limit=args.rate_limit)
+    server.start()
+    try:
+        while True:
+            if args.advance_every > 0:
+                time.sleep(args.advance_every)
+                knowledge = server.advance()
+                logging.info(f"Advanced synthetic budget to server_knowledge {knowledge}")
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
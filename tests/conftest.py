@@ -0,0 +1,50 @@
+'''Shared fixtures for the test suite, run from the repository root with `python -m pytest`'''
+
+import os
+import sys
+
+import pytest
+import yaml
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture
+def config(tmp_path):
+    '''The repository config with every data and log path moved into a temporary directory'''
+    with open(os.path.join(REPO_ROOT, 'config', 'config.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    for key, value in list(config.items()):
+        if isinstance(value, str) and (value.startswith('data/') or value.startswith('logs/')):
+            config[key] = str(tmp_path / value)
+    config['API_TOKEN'] = 'test'
+    config['BUDGET_ID'] = 'test'
+    config['REQUESTS_RETRY_DELAY'] = 0
+    return config
+
+
+@pytest.fixture
+def mock_api(config):
+    '''A synthetic budget served by the mock YNAB API, with the config pointed at it'''
+    from synthetic.generator import SyntheticBudget
+    from synthetic.mock_api import MockYnabServer
+
+    server = MockYnabServer(SyntheticBudget(transactions=600)).start()
+    config['base_url'] = server.base_url
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def synced(config, mock_api):
+    '''Run the first sync into the base tables, returns a function that syncs again after the budget moved on'''
+    from pipeline.ingest import Ingest
+    from pipeline.raw_to_base import RawToBase
+
+    def sync():
+        Ingest(config)
+        RawToBase(config)
+
+    sync()
+    return sync
@@ -0,0 +1,45 @@
+import os
+
+import polars as pl
+
+from pipeline.data_quality import DataQuality
+from pipeline.facts import FactAccountBalances
+from pipeline.table_specs import TableSpecs
+
+
+def test_removed_rows_of_a_rebuilt_table_come_back_on_the_next_run(config, synced):
+    TableSpecs(config)
+    path = config['warehouse_data_path'] + '/transactions.parquet'
+    built = pl.read_parquet(path)
+    config['data_quality'] = {'transactions': [{'check': 'range', 'column': 'transaction_amount', 'min': 0}]}
+    DataQuality(config)
+
+    outflows = built.filter(pl.col('transaction_amount') < 0).height
+    assert pl.read_parquet(path).height == built.height - outflows
+    quarantine = pl.read_parquet(config['quarantine_data_path'] + '/transactions.parquet')
+    assert quarantine.height == outflows and quarantine['removed'].all()
+
+    TableSpecs(config)
+    assert pl.read_parquet(path).equals(built)
+
+
+def test_incremental_tables_keep_their_failing_rows(config, synced, mock_api):
+    FactAccountBalances(config)
+    path = config['warehouse_data_path'] + '/account_balances.parquet'
+    built = pl.read_parquet(path)
+    config['data_quality'] = {'account_balances': [{'check': 'range', 'column': 'balance', 'min': 0}]}
+    DataQuality(config)
+
+    assert pl.read_parquet(path).equals(built)
+    quarantine = pl.read_parquet(config['quarantine_data_path'] + '/account_balances.parquet')
+    assert quarantine.height == built.filter(pl.col('balance') < 0).height > 0
+    assert not quarantine['removed'].any()
+
+    # the next incremental run still agrees with a rebuild
+    mock_api.advance(edits=20, deletes=5, new_transactions=10)
+    synced()
+    FactAccountBalances(config)
+    incremental = pl.read_parquet(path)
+    os.remove(config['account_balances_state_file'])
+    FactAccountBalances(config)
+    assert incremental.equals(pl.read_parquet(path))
@@ -0,0 +1,55 @@
+from datetime import date, datetime
+
+import polars as pl
+
+from pipeline.history import update_history, as_of, as_of_join
+
+
+def load(config, rows, loaded_at, previous=pl.DataFrame()):
+    new_data = pl.DataFrame(rows).with_columns(pl.lit(loaded_at.date()).alias('ingestion_date'))
+    assert update_history(config, 'payees', 'id', new_data, previous, loaded_at)
+    return new_data
+
+
+def build_history(config):
+    load(config, [{'id': 'a', 'name': 'Shop'}, {'id': 'b', 'name': 'Cafe'}], datetime(2024, 1, 1, 8))
+    load(config, [{'id': 'a', 'name': 'Shop Ltd'}], datetime(2024, 2, 1, 8))
+    load(config, [{'id': 'a', 'name': 'Shop Group'}, {'id': 'c', 'name': 'Bar'}], datetime(2024, 3, 1, 8))
+
+
+def names(frame: pl.DataFrame) -> dict:
+    return dict(zip(frame['id'], frame['name']))
+
+
+def test_as_of_returns_the_versions_valid_at_a_time(config):
+    build_history(config)
+    assert names(as_of(config, 'payees', date(2024, 1, 15))) == {'a': 'Shop', 'b': 'Cafe'}
+    assert names(as_of(config, 'payees', datetime(2024, 2, 1, 8))) == {'a': 'Shop Ltd', 'b': 'Cafe'}
+    assert names(as_of(config, 'payees', date(2024, 3, 1))) == {'a': 'Shop Group', 'b': 'Cafe', 'c': 'Bar'}
+    assert as_of(config, 'payees', date(2023, 12, 31)).is_empty()
+
+
+def test_reapplying_a_load_replaces_it(config):
+    build_history(config)
+    load(config, [{'id': 'a', 'name': 'Shop Group'}, {'id': 'c', 'name': 'Bar'}], datetime(2024, 3, 1, 8))
+    history = pl.read_parquet(config['history_data_path'] + '/payees.parquet')
+    assert history.height == 5
+    assert history.filter(pl.col('valid_to').is_null()).height == 3
+
+
+def test_as_of_join_matches_each_row_to_the_version_valid_on_its_date(config):
+    build_history(config)
+    transactions = pl.DataFrame({
+        'transaction_id': ['t1', 't2', 't3', 't4', 't5'],
+        'date': [date(2024, 1, 10), date(2024, 2, 1), date(2024, 3, 5), date(2024, 3, 5), date(2023, 6, 1)],
+        'payee_id': ['a', 'a', 'a', 'b', 'a'],
+    })
+    joined = as_of_join(config, 'payees', transactions, left_on='date', by='payee_id').sort('transaction_id')
+    assert joined['name'].to_list() == ['Shop', 'Shop Ltd', 'Shop Group', 'Cafe', None]
+    assert joined.columns[:3] == ['transaction_id', 'date', 'payee_id']
+
+
+def test_as_of_join_of_an_empty_frame(config):
+    build_history(config)
+    empty = pl.DataFrame(schema={'date': pl.Date, 'payee_id': pl.Utf8})
+    assert as_of_join(config, 'payees', empty, left_on='date', by='payee_id').is_empty()
@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+import config.exit_codes as ec
+from pipeline.ingest import Ingest
+
+
+def transaction_files(config):
+    return sorted(os.listdir(os.path.join(config['raw_data_path'], 'transactions')))
+
+
+def fetched_transaction_ids(config):
+    ids = set()
+    for file_name in transaction_files(config):
+        with open(os.path.join(config['raw_data_path'], 'transactions', file_name)) as f:
+            ids.update(transaction['id'] for transaction in json.load(f)['transactions'])
+    return ids
+
+
+@pytest.fixture
+def backfill(config, mock_api):
+    config['entities'] = ['transactions']
+    config['transactions_backfill'] = True
+    config['transactions_backfill_workers'] = 2
+    return config
+
+
+def test_backfill_lands_a_chunk_per_account_and_skips_deleted_ones(backfill, mock_api):
+    budget = mock_api.budget
+    deleted = budget.accounts[0]
+    deleted['deleted'] = True
+    Ingest(backfill)
+
+    accounts = [a['id'] for a in budget.accounts if not a['deleted']]
+    assert len(transaction_files(backfill)) == len(accounts)
+    expected = {t['id'] for t in budget.iter_transactions() if t['account_id'] != deleted['id']}
+    assert fetched_transaction_ids(backfill) == expected
+    with open(backfill['knowledge_file']) as f:
+        assert json.load(f)['transactions'] == budget.server_knowledge
+
+
+def test_backfill_falls_back_to_one_request_when_an_account_is_not_found(backfill, mock_api, monkeypatch):
+    response = mock_api.budget.response
+
+    def response_with_a_missing_account(entity, last_knowledge):
+        body = response(entity, last_knowledge)
+        if entity == 'accounts':
+            body['data']['accounts'].append({**body['data']['accounts'][0], 'id': 'missing'})
+        return body
+
+    monkeypatch.setattr(mock_api.budget, 'response', response_with_a_missing_account)
+    Ingest(backfill)
+
+    files = transaction_files(backfill)
+    assert len(files) == 1 and files[0].count('.') == 1
+    assert fetched_transaction_ids(backfill) == {t['id'] for t in mock_api.budget.iter_transactions()}
+
+
+def test_backfill_falls_back_to_one_request_before_the_rate_limit_runs_out(backfill, mock_api, monkeypatch):
+    # enough requests for every shard when the backfill starts, then another client spends 6 of them
+    mock_api.rate_limit = len(mock_api.budget.accounts) + 4
+    take_rate_limit = mock_api.take_rate_limit
+
+    def take_rate_limit_with_another_client():
+        used = take_rate_limit()
+        return used + 6 if used > 1 else used
+
+    monkeypatch.setattr(mock_api, 'take_rate_limit', take_rate_limit_with_another_client)
+    backfill['transactions_backfill_workers'] = 1
+    Ingest(backfill)
+
+    files = transaction_files(backfill)
+    assert len(files) == 1 and files[0].count('.') == 1
+
+
+def test_retries_back_off_and_exit_once_they_run_out(config, mock_api, monkeypatch):
+    mock_api.rate_limit = 0
+    config['REQUESTS_RETRY_DELAY'] = 1
+    delays = []
+    monkeypatch.setattr('pipeline.ingest.time.sleep', delays.append)
+    with pytest.raises(SystemExit) as exit_info:
+        Ingest(config)
+    assert exit_info.value.code == ec.REQUESTS_ERROR
+    assert delays == [1, 2]
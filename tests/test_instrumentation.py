@@ -0,0 +1,21 @@
+from pipeline import instrumentation
+
+
+def test_span_records_its_own_peak_rss_growth():
+    with instrumentation.span('allocating') as allocating:
+        block = bytearray(64 * 1024 * 1024)
+        block[::4096] = b'1' * len(block[::4096])
+    del block
+    with instrumentation.span('idle') as idle:
+        pass
+
+    assert allocating.peak_rss_growth_bytes >= 32 * 1024 * 1024
+    # the process peak stays high, but the later span did not raise it. The kernel batches RSS counters
+    # per thread, so the high-water mark read back can be a few pages off
+    assert idle.process_peak_rss_bytes >= allocating.process_peak_rss_bytes - 1024 * 1024
+    assert idle.peak_rss_growth_bytes < 8 * 1024 * 1024
+
+
+def test_record_outside_a_span_does_nothing():
+    instrumentation.record(rows_in=1)
+    instrumentation.set_attributes(entity='none')
@@ -0,0 +1,53 @@
+import pytest
+
+import config.exit_codes as ec
+import pipeline.pipeline_main as pipeline_main_module
+from pipeline.metrics import PipelineMetrics
+
+
+def run_summary():
+    return {
+        'total_duration_s': 1.5,
+        'peak_rss_bytes': 1000,
+        'stages': [{'name': 'RawToBase', 'duration_s': 1.5}],
+        'spans': [
+            {'name': 'raw_to_base_entity', 'entity': 'transactions', 'rows_in': 10},
+            {'name': 'RawToBase'},
+        ],
+    }
+
+
+def test_counters_are_typed_under_the_name_of_their_samples(config):
+    metrics = PipelineMetrics(config)
+    metrics.collect(run_summary(), 0)
+    text = metrics.render()
+    lines = text.splitlines()
+
+    assert '# TYPE dpfy_rows_merged_total counter' in lines
+    assert '# HELP dpfy_rows_merged_total Rows merged into the base table across all runs.' in lines
+    assert 'dpfy_rows_merged_total{entity="transactions"} 10' in lines
+    assert '# TYPE dpfy_runs_total counter' in lines
+    # the last run gauge does not share a name with the counter
+    assert '# TYPE dpfy_rows_merged_last_run gauge' in lines
+    # text format 0.0.4 has no # EOF terminator, that is OpenMetrics only
+    assert '# EOF' not in lines
+
+
+def test_counters_accumulate_across_runs(config):
+    for _ in range(2):
+        metrics = PipelineMetrics(config)
+        metrics.collect(run_summary(), 0)
+        metrics.write()
+    text = PipelineMetrics(config).render()
+    assert 'dpfy_rows_merged_total{entity="transactions"} 20' in text.splitlines()
+
+
+def test_a_run_without_data_exports_its_exit_code(config, mock_api, monkeypatch):
+    monkeypatch.setattr(pipeline_main_module, 'RawToBase', lambda config: None)
+    with pytest.raises(SystemExit) as exit_info:
+        pipeline_main_module.pipeline_main(config)
+    assert exit_info.value.code == ec.NO_DATA_PRODUCED
+    with open(config['metrics_textfile']) as f:
+        lines = f.read().splitlines()
+    assert f'dpfy_last_run_exit_code {ec.NO_DATA_PRODUCED}' in lines
+    assert 'dpfy_runs_total{status="failure"} 1' in lines
@@ -0,0 +1,63 @@
+import logging
+import time
+
+import polars as pl
+import pytest
+
+from pipeline import profiling
+
+
+@pytest.fixture
+def profile_dir(tmp_path):
+    yield tmp_path
+    # profiling is process wide, switch it off again for the other tests
+    profiling.configure()
+    profiling._settings['warned_no_profile'] = False
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_normal_runs_are_not_profiled(tmp_path):
+    profiling.configure()
+    with profiling.stage('Anything'):
+        pass
+    assert profiling.collect(pl.LazyFrame({'a': [1, 2]}), 'plan').height == 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sampling_stage_writes_collapsed_stacks(profile_dir):
+    profiling.configure(mode='sampling', output_dir=str(profile_dir), interval=0.001)
+    with profiling.stage('Busy'):
+        busy(0.2)
+    folded = list(profile_dir.glob('*_Busy.folded'))
+    assert len(folded) == 1
+    lines = folded[0].read_text().splitlines()
+    assert lines and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    assert any('busy (test_profiling.py' in line for line in lines)
+
+
+def test_only_selected_stages_are_profiled(profile_dir):
+    profiling.configure(mode='cprofile', stages=['Selected'], output_dir=str(profile_dir))
+    with profiling.stage('Selected'):
+        busy(0.01)
+    with profiling.stage('Other'):
+        busy(0.01)
+    assert list(profile_dir.glob('*_Selected.prof'))
+    assert not list(profile_dir.glob('*_Other.*'))
+
+
+def test_polars_plans_are_dumped(profile_dir, caplog):
+    profiling.configure(polars_plans=True, output_dir=str(profile_dir))
+    plan = pl.LazyFrame({'a': [1, 2, 3]}).filter(pl.col('a') > 1)
+    with caplog.at_level(logging.WARNING):
+        assert profiling.collect(plan, 'Filter').height == 2
+        assert len(profiling.collect_all([plan, plan], 'Both')) == 2
+    report = next(profile_dir.glob('*_Filter_polars.txt')).read_text()
+    assert 'FILTER' in report and 'collected 2 rows' in report
+    assert list(profile_dir.glob('*_Both_polars.txt'))
+    if not hasattr(pl.LazyFrame, 'profile'):
+        assert sum('has no LazyFrame.profile()' in r.message for r in caplog.records) == 1
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import polars as pl
+import pytest
+
+from query_service import QueryError, QueryService, check_tables
+
+TABLES = ['transactions', 'accounts']
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM transactions t JOIN accounts a ON t.account_id = a.account_id",
+    "SELECT * FROM transactions, accounts AS a WHERE transactions.account_id = a.account_id",
+    "WITH recent AS (SELECT * FROM transactions) SELECT * FROM recent",
+    "SELECT * FROM (SELECT * FROM \"Transactions\") AS t",
+    "SELECT EXTRACT(year FROM transaction_date) AS year FROM transactions -- FROM secrets",
+    "SELECT 'read_parquet(x)' AS text FROM accounts;",
+])
+def test_check_tables_allows_queries_over_warehouse_tables(sql):
+    check_tables(sql, TABLES)
+
+
+@pytest.mark.parametrize('sql', [
+    "SELECT * FROM read_parquet('/etc/passwd')",
+    "SELECT * FROM transactions, READ_CSV('/etc/passwd') AS f",
+    "SELECT * FROM transactions WHERE id IN (SELECT id FROM read_json('x.json'))",
+    "SELECT * FROM '/tmp/other.parquet'",
+    "SELECT * FROM secrets",
+    "SELECT * FROM transactions JOIN /* accounts */ secrets ON true",
+    "CREATE TABLE copy AS SELECT * FROM transactions",
+    "SELECT * FROM transactions; SELECT * FROM accounts",
+])
+def test_check_tables_rejects_files_and_unknown_tables(sql):
+    with pytest.raises(QueryError):
+        check_tables(sql, TABLES)
+
+
+def post(url, payload):
+    request = urllib.request.Request(url + '/query', data=json.dumps(payload).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers.get('X-Cache'), json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None, json.loads(e.read())
+
+
+@pytest.fixture
+def service(config, tmp_path):
+    os.makedirs(config['warehouse_data_path'], exist_ok=True)
+    pl.DataFrame({'account_id': ['a', 'b'], 'account_name': ['Checking', 'Savings']}).write_parquet(
+        config['warehouse_data_path'] + '/accounts.parquet'
+    )
+    pl.DataFrame({'x': [1]}).write_parquet(tmp_path / 'outside.parquet')
+    service = QueryService(config, port=0)
+    thread = threading.Thread(target=service.serve_forever, daemon=True)
+    thread.start()
+    yield service
+    service.shutdown()
+    thread.join()
+
+
+def test_query_service_runs_and_caches_queries_and_rejects_files(service, tmp_path):
+    payload = {'sql': "SELECT account_name FROM accounts WHERE account_id = :id", 'params': {'id': 'b'}}
+    status, cache, body = post(service.url, payload)
+    assert (status, cache, body['rows']) == (200, 'miss', [{'account_name': 'Savings'}])
+    assert post(service.url, payload)[1] == 'hit'
+
+    status, _, body = post(service.url, {'sql': f"SELECT * FROM read_parquet('{tmp_path / 'outside.parquet'}')"})
+    assert status == 400 and body['error'] == 'bad_query'
+    status, _, body = post(service.url, {'sql': "SELECT * FROM secrets"})
+    assert status == 400 and 'Unknown table' in body['detail']
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import polars as pl
+import pytest
+
+from pipeline.ingest import Ingest
+from pipeline.raw_to_base import RawToBase
+
+ESTIMATES = {'transactions': 600, 'payees': 300, 'categories': 200, 'accounts': 100}
+
+
+@pytest.fixture
+def scheduled(config, monkeypatch):
+    '''Run RawToBase with fixed memory estimates, recording when each entity starts and how many overlap'''
+    config['entities'] = list(ESTIMATES)
+    runs = {'started': [], 'running': 0, 'max_running': 0}
+    lock = threading.Lock()
+
+    def process_entity(self, entity, memory_estimate):
+        with lock:
+            runs['started'].append(entity)
+            runs['running'] += 1
+            runs['max_running'] = max(runs['max_running'], runs['running'])
+        time.sleep(0.05)
+        with lock:
+            runs['running'] -= 1
+
+    monkeypatch.setattr(RawToBase, 'estimate_memory', lambda self, entity: ESTIMATES[entity])
+    monkeypatch.setattr(RawToBase, 'process_entity', process_entity)
+
+    def run(workers, budget_bytes):
+        config['raw_to_base_workers'] = workers
+        config['raw_to_base_memory_budget_mb'] = budget_bytes / (1024 * 1024)
+        RawToBase(config)
+        return runs
+    return run
+
+
+def test_entities_over_the_budget_run_one_at_a_time_biggest_first(scheduled):
+    runs = scheduled(workers=4, budget_bytes=0)
+    assert runs['started'] == ['transactions', 'payees', 'categories', 'accounts']
+    assert runs['max_running'] == 1
+
+
+def test_small_entities_run_alongside_the_biggest_within_the_budget(scheduled):
+    runs = scheduled(workers=4, budget_bytes=1000)
+    # transactions and payees fill 900 of the budget, categories waits while accounts fits
+    assert runs['started'][:3] == ['transactions', 'payees', 'accounts']
+    assert runs['max_running'] == 3
+
+
+def test_entity_frames_are_released_once_merged(config, synced, mock_api):
+    path = config['base_data_path'] + '/transactions.parquet'
+    rows = pl.read_parquet(path).height
+    mock_api.advance(edits=10, deletes=2, new_transactions=10)
+    Ingest(config)
+    raw_to_base = RawToBase(config)
+    assert pl.read_parquet(path).height == rows + 10
+    for frames in (raw_to_base.data, raw_to_base.base_data, raw_to_base.new_data, raw_to_base.previous_base_data):
+        assert frames == {}
+
+
+def test_merge_updates_records_in_place_and_appends_new_ones(config, synced, mock_api):
+    path = config['base_data_path'] + '/transactions.parquet'
+    before = pl.read_parquet(path)
+    mock_api.advance(edits=20, deletes=5, new_transactions=3)
+    synced()
+    after = pl.read_parquet(path)
+
+    assert after['id'].head(before.height).equals(before['id'])
+    assert after.height == before.height + 3
+    expected = {t['id']: t for t in mock_api.budget.iter_transactions()}
+    for row in after.iter_rows(named=True):
+        assert (row['amount'], row['memo'], row['deleted']) == tuple(expected[row['id']][c] for c in ('amount', 'memo', 'deleted'))
@@ -0,0 +1,55 @@
+import logging
+import os
+import sqlite3
+
+import polars as pl
+
+from pipeline.facts import stable_digest
+from pipeline.sqlite_export import SqliteExport
+
+
+def export(config, frame, keys):
+    os.makedirs(config['warehouse_data_path'], exist_ok=True)
+    frame.write_parquet(config['warehouse_data_path'] + '/payees.parquet')
+    config['sqlite_export'] = True
+    config['sqlite_export_tables'] = {'payees': keys}
+    SqliteExport(config)
+    with sqlite3.connect(config['sqlite_export_path']) as connection:
+        rows = connection.execute('SELECT id, name, amount FROM payees ORDER BY id, name').fetchall()
+        table_info = connection.execute('PRAGMA table_info(payees)').fetchall()
+    return rows, [row[1] for row in sorted((row for row in table_info if row[5]), key=lambda row: row[5])]
+
+
+def test_export_upserts_changed_rows_and_deletes_removed_ones(config):
+    first = pl.DataFrame({'id': ['a', 'b', 'c'], 'name': ['A', 'B', 'C'], 'amount': [1.0, 2.0, 3.0]})
+    rows, keys = export(config, first, ['id'])
+    assert rows == [('a', 'A', 1.0), ('b', 'B', 2.0), ('c', 'C', 3.0)]
+    assert keys == ['id']
+
+    second = pl.DataFrame({'id': ['a', 'b', 'd'], 'name': ['A', 'B2', 'D'], 'amount': [1.0, 2.5, 4.0]})
+    rows, _ = export(config, second, ['id'])
+    assert rows == [('a', 'A', 1.0), ('b', 'B2', 2.5), ('d', 'D', 4.0)]
+
+
+def test_export_recreates_the_table_when_the_keys_change(config):
+    export(config, pl.DataFrame({'id': ['a', 'b'], 'name': ['A', 'B'], 'amount': [1.0, 2.0]}), ['id'])
+
+    # the same columns, but id is no longer unique on its own
+    frame = pl.DataFrame({'id': ['a', 'a', 'b'], 'name': ['A', 'A2', 'B'], 'amount': [1.0, 1.5, 2.0]})
+    rows, keys = export(config, frame, ['id', 'name'])
+    assert keys == ['id', 'name']
+    assert rows == [('a', 'A', 1.0), ('a', 'A2', 1.5), ('b', 'B', 2.0)]
+
+
+def test_row_hashes_are_stable_digests_kept_out_of_the_exported_table(config, caplog):
+    frame = pl.DataFrame({'id': ['a', 'b'], 'name': ['A', None], 'amount': [1.0, 2.5]})
+    export(config, frame, ['id'])
+    with sqlite3.connect(config['sqlite_export_path']) as connection:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(payees)')]
+        hashes = dict(connection.execute('SELECT id, _row_hash FROM _row_hashes_payees').fetchall())
+    assert columns == ['id', 'name', 'amount']
+    assert hashes == {'a': stable_digest(['a', 'A', 1.0]), 'b': stable_digest(['b', None, 2.5])}
+
+    with caplog.at_level(logging.INFO):
+        export(config, frame, ['id'])
+    assert 'Upserted 0 and deleted 0 rows of table: payees in SQLite' in caplog.text
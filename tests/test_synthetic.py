@@ -0,0 +1,42 @@
+import requests
+
+from synthetic.generator import SyntheticBudget
+from synthetic.mock_api import MockYnabServer
+
+
+def test_snapshot_is_not_changed_by_advance():
+    budget = SyntheticBudget(transactions=300)
+    frozen = budget.snapshot()
+    budget.advance(edits=50, deletes=5, new_transactions=20)
+
+    frozen_transactions = list(frozen.iter_transactions())
+    assert len(frozen_transactions) == 300
+    assert not any((t['memo'] or '').startswith('edited') for t in frozen_transactions)
+    assert len(list(budget.iter_transactions())) == 320
+
+
+def test_mock_api_serves_full_and_delta_syncs():
+    budget = SyntheticBudget(transactions=500)
+    with MockYnabServer(budget) as server:
+        headers = {'Authorization': 'Bearer test'}
+        full = requests.get(f'{server.base_url}/b/transactions?last_knowledge_of_server=0', headers=headers).json()['data']
+        assert len(full['transactions']) == 500
+        assert full['server_knowledge'] == 1
+
+        server.advance(edits=10, deletes=0, new_transactions=5)
+        delta = requests.get(f'{server.base_url}/b/transactions?last_knowledge_of_server=1', headers=headers).json()['data']
+        assert delta['server_knowledge'] == 2
+        assert 5 <= len(delta['transactions']) <= 15
+
+        account_id = budget.accounts[0]['id']
+        shard = requests.get(f'{server.base_url}/b/accounts/{account_id}/transactions?last_knowledge_of_server=0',
+                             headers=headers).json()['data']
+        assert shard['transactions']
+        assert all(t['account_id'] == account_id for t in shard['transactions'])
+
+
+def test_mock_api_enforces_the_rate_limit():
+    with MockYnabServer(SyntheticBudget(transactions=10), rate_limit=2) as server:
+        headers = {'Authorization': 'Bearer test'}
+        statuses = [requests.get(f'{server.base_url}/b/accounts', headers=headers).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]